@@ -49,6 +49,7 @@ from p2p.testsuite_p2p import testsuite_p2p
 
 from bgcvaltools.dataset import dataset
 from bgcvaltools.configparser import AnalysisKeyParser, GlobalSectionParser
+from bgcvaltools.scheduler import JobScheduler
 
 from html.makeReportConfig import htmlMakerFromConfig
 
@@ -57,170 +58,191 @@ import matplotlib
 matplotlib.use('Agg')
 
 
-parrallel = False
-if parrallel:
-	try:	from multiprocessing import Pool
-	except: parrallel = False
-
-
 def evaluateFromConfig( akp,
 			model	= '',
 			jobID	= '',
 			year	= '',
 			scenario= '',
 			key	= ''):
-
-	if akp.dimensions in  [1,]:			
-		metricList = ['metricless',]
-	if akp.dimensions in  [2, 3]:
-		metricList = ['mean','median', '10pc','20pc','30pc','40pc','50pc','60pc','70pc','80pc','90pc','min','max']
+	"""
+	Runs all the analyses switched on for a single analysis key.
+	"""
 	#####
 	# Time series plots		
 	if akp.makeTS: 
-	        tsa = timeseriesAnalysis(
-	                modelFiles	= akp.modelFiles_ts,
-	                dataFile 	= akp.dataFile,
-	                jobID           = akp.jobID,
-	                dataType        = akp.name,
-	                workingDir      = akp.postproc_ts,
-	                imageDir        = akp.images_ts,
-	                metrics         = metricList,
-	                modelcoords     = akp.modelcoords,
-	                modeldetails    = akp.modeldetails,
-	                datacoords      = akp.datacoords,
-	                datadetails     = akp.datadetails,
-	                datasource      = akp.datasource,
-	                model           = akp.model,
-			scenario        = akp.scenario,						                
-			timerange       = akp.timerange,
-	                layers          = akp.layers,
-	                regions         = akp.regions,
-	                grid            = akp.modelgrid,
-	                gridFile        = akp.gridFile,
-	                clean           = akp.clean,
-	        )
-
-
-    	
+		evaluateTimeSeries(akp)
+	
 	#####
 	# Profile plots (only works for 3 Dimensional data.)
 	if akp.makeProfiles and akp.dimensions == 3:
-		profa = profileAnalysis(
-			modelFiles 	= akp.modelFiles_ts,
-			dataFile	= akp.dataFile,
-			jobID           = akp.jobID,
-			dataType        = akp.name,
-			workingDir      = akp.postproc_pro,
-			imageDir        = akp.images_pro,
-			modelcoords     = akp.modelcoords,
-			modeldetails    = akp.modeldetails,
-			datacoords      = akp.datacoords,
-			datadetails     = akp.datadetails,
-			datasource      = akp.datasource,
-			model           = akp.model,
-			scenario        = akp.scenario,	
-			timerange       = akp.timerange,						
-			regions         = akp.regions,
-			grid            = akp.modelgrid,
-			gridFile        = akp.gridFile,
-			layers	 	= list(np.arange(102)),		# 102 because that is the number of layers in WOA Oxygen
-			metrics	 	= ['mean',],								
-			clean 		= akp.clean,
-		)
-		
+		evaluateProfiles(akp)
+
 	#####
 	# Point to point plots
 	print 'p2p:',akp.modelFile_p2p
 	print 'ts :',akp.modelFiles_ts	
 	if akp.makeP2P and  akp.dimensions not in [1,]:
-	    	testsuite_p2p(
-	                modelFile	= akp.modelFile_p2p,
-	                dataFile 	= akp.dataFile,    		
-			model 		= akp.model,
-			scenario        = akp.scenario,								
-			jobID 		= akp.jobID,
-	    		dataType        = akp.name,						
-			year  		= akp.year,
-			modelcoords     = akp.modelcoords,
-	                modeldetails    = akp.modeldetails,
-	                datacoords      = akp.datacoords,
-	                datadetails     = akp.datadetails,
-	                datasource      = akp.datasource,
-			plottingSlices	= akp.regions,		# set this so that testsuite_p2p reads the slice list from the av.
-			layers		= akp.layers,
-			workingDir 	= akp.postproc_p2p, 
-			imageFolder	= akp.images_p2p,
-	                grid            = akp.modelgrid,			
-			gridFile	= akp.gridFile,	# enforces custom gridfile.
-			noPlots		= False,	# turns off plot making to save space and compute time.
-			annual		= True,
-			noTargets	= True,
-	                clean           = akp.clean,				
-	 	)
-		 	
-jobsDict = {}
-def parrallelEval(index):
+		evaluateP2P(akp)
+
+
+def evaluateTimeSeries(akp):
+	if akp.dimensions in  [1,]:			
+		metricList = ['metricless',]
+	if akp.dimensions in  [2, 3]:
+		metricList = ['mean','median', '10pc','20pc','30pc','40pc','50pc','60pc','70pc','80pc','90pc','min','max']
+
+        tsa = timeseriesAnalysis(
+                modelFiles	= akp.modelFiles_ts,
+                dataFile 	= akp.dataFile,
+                jobID           = akp.jobID,
+                dataType        = akp.name,
+                workingDir      = akp.postproc_ts,
+                imageDir        = akp.images_ts,
+                metrics         = metricList,
+                modelcoords     = akp.modelcoords,
+                modeldetails    = akp.modeldetails,
+                datacoords      = akp.datacoords,
+                datadetails     = akp.datadetails,
+                datasource      = akp.datasource,
+                model           = akp.model,
+		scenario        = akp.scenario,						                
+		timerange       = akp.timerange,
+                layers          = akp.layers,
+                regions         = akp.regions,
+                grid            = akp.modelgrid,
+                gridFile        = akp.gridFile,
+                clean           = akp.clean,
+                nproc           = akp.nproc,
+                timeChunk       = akp.timeChunk,
+                pointCacheDir   = akp.pointCacheDir,
+        )
+
+
+def evaluateProfiles(akp):
+	profa = profileAnalysis(
+		modelFiles 	= akp.modelFiles_ts,
+		dataFile	= akp.dataFile,
+		jobID           = akp.jobID,
+		dataType        = akp.name,
+		workingDir      = akp.postproc_pro,
+		imageDir        = akp.images_pro,
+		modelcoords     = akp.modelcoords,
+		modeldetails    = akp.modeldetails,
+		datacoords      = akp.datacoords,
+		datadetails     = akp.datadetails,
+		datasource      = akp.datasource,
+		model           = akp.model,
+		scenario        = akp.scenario,	
+		timerange       = akp.timerange,						
+		regions         = akp.regions,
+		grid            = akp.modelgrid,
+		gridFile        = akp.gridFile,
+		layers	 	= list(np.arange(102)),		# 102 because that is the number of layers in WOA Oxygen
+		metrics	 	= ['mean',],								
+		clean 		= akp.clean,
+		pointCacheDir	= akp.pointCacheDir,
+	)
+
+
+def evaluateP2P(akp):
+    	testsuite_p2p(
+                modelFile	= akp.modelFile_p2p,
+                dataFile 	= akp.dataFile,    		
+		model 		= akp.model,
+		scenario        = akp.scenario,								
+		jobID 		= akp.jobID,
+    		dataType        = akp.name,						
+		year  		= akp.year,
+		modelcoords     = akp.modelcoords,
+                modeldetails    = akp.modeldetails,
+                datacoords      = akp.datacoords,
+                datadetails     = akp.datadetails,
+                datasource      = akp.datasource,
+		plottingSlices	= akp.regions,		# set this so that testsuite_p2p reads the slice list from the av.
+		layers		= akp.layers,
+		workingDir 	= akp.postproc_p2p, 
+		imageFolder	= akp.images_p2p,
+                grid            = akp.modelgrid,			
+		gridFile	= akp.gridFile,	# enforces custom gridfile.
+		noPlots		= False,	# turns off plot making to save space and compute time.
+		annual		= True,
+		noTargets	= True,
+                clean           = akp.clean,				
+                nproc           = akp.nproc,
+ 	)
+
+
+def estimateCost(akp, files):
 	"""
-	Parralllelise the evaluation of a specific job.
+	Estimates the relative cost of a job, as the number of input files times the number of dimensions.
 	"""
-	[(model,jobID,year,scenario,key),akp] = jobsDict[index]
-	print "parrallelEval:",model,jobID,year,scenario,key
-	evaluateFromConfig( akp,
-		model	= model,
-		jobID	= jobID,
-		year	= year,
-		scenario= scenario,
-		key	= key)	
-				
+	if isinstance(files, (list, tuple)):	nfiles = len(files)
+	elif files in ['', None]:		nfiles = 0
+	else: 					nfiles = 1
+	try:	dims = int(akp.dimensions)
+	except:	dims = 1
+	return max(nfiles, 1) * max(dims, 1)
+
+
 def analysis_parser(
 			configfile = 'runconfig.ini',
+			nproc = None,
 			):
+	"""
+	Parses the config file and runs the analysis.
 	
+	Each analysis stage of each (model, jobID, year, scenario, key) is a separate job,
+	run on a pool of nproc processes, most expensive first.
+	The number of processes is taken from the nproc argument, or the nproc option in the [Global] section.
+	The comparison plots and the CSV files only start after all the time series jobs are finished, 
+	and the html report is made last.
+	The config file is only parsed once, and the parsed config is passed to each stage.
+	A failed job is reported at the end, but does not stop the other jobs.
+	"""
 	#####
 	# Load global level keys from the config file.
 	gk =  GlobalSectionParser(configfile)
-	#print gk
-	#assert 0
+	if nproc is None: nproc = gk.nproc
+	
+	scheduler = JobScheduler(nproc = nproc)
 
 	#####
-	# Run the evaluation for each True boolean key in the config file section [ActiveKeys].	
-	if parrallel:
-		global jobsDict
-		
-		i = 0
-		for (model,jobID,year,scenario,key),akp in gk.AnalysisKeyParser.items():
-			jobsDict[i] = [(model,jobID,year,scenario,key),akp]
-			i+=1
-		
-		nproc = 6
-		pool = Pool(processes=nproc)              	# start nproc worker processes
-		pool.map(parrallelEval, sorted(jobsDict.keys()))# Map processes onto jobDict 
-		pool.close()					# end
-	else:
-		for (model,jobID,year,scenario,key),akp in gk.AnalysisKeyParser.items():
-			evaluateFromConfig( akp,
-				model	= model,
-				jobID	= jobID,
-				year	= year,
-				scenario= scenario,
-				key	= key)
-		
+	# Add the evaluation jobs for each True boolean key in the config file section [ActiveKeys].
+	tsjobs = []
+	for (model,jobID,year,scenario,key),akp in sorted(gk.AnalysisKeyParser.items()):
+		if akp.makeTS:
+			name = (model,jobID,year,scenario,key,'timeseries')
+			scheduler.add(name, evaluateTimeSeries, args = (akp,), cost = estimateCost(akp, akp.modelFiles_ts))
+			tsjobs.append(name)
+		if akp.makeProfiles and akp.dimensions == 3:
+			name = (model,jobID,year,scenario,key,'profile')
+			scheduler.add(name, evaluateProfiles, args = (akp,), cost = estimateCost(akp, akp.modelFiles_ts))
+		if akp.makeP2P and akp.dimensions not in [1,]:
+			name = (model,jobID,year,scenario,key,'p2p')
+			scheduler.add(name, evaluateP2P, args = (akp,), cost = estimateCost(akp, akp.modelFile_p2p))
+	
 	#####
 	# Comparison Plots.
 	if gk.makeComp:	
-	    	comparisonAnalysis(configfile)
-
+		scheduler.add('comparisonAnalysis', comparisonAnalysis, args = (gk,), dependencies = tsjobs)
+		
 	#####
 	# Make CSV's	    	
 	if gk.makeCSV:
-	    	makeCSV(configfile)			 	
+		scheduler.add('makeCSV', makeCSV, args = (gk,), dependencies = tsjobs)
 
 	#####
 	# Make HTML Report
 	if gk.makeReport:
-		htmlMakerFromConfig(configfile)
+		scheduler.add('htmlMakerFromConfig', htmlMakerFromConfig, args = (gk,), dependencies = scheduler.order[:])
 	else:
 		print "analysis_parser:\tReport maker  is switched Off. To turn it on, use the makeReport boolean flag in "
+	
+	status = scheduler.run()
+	if len(scheduler.failed()):
+		print "analysis_parser:\t", len(scheduler.failed()), "of", len(status), "jobs failed."
+	return status
+
 
 def main():
         try: 	configfn = argv[1]
@@ -228,8 +250,14 @@ def main():
 		configfn = 'runconfig.ini'
 		print "run.py:\tNo config file provided, using default: ", configfn
 
+	#####
+	# Optional number of processes, overrides the nproc option in the [Global] section.
+	try:	nproc = int(argv[2])
+	except:	nproc = None
+
 	analysis_parser(
 		configfile= configfn,
+		nproc	= nproc,
 		)
 		
 	
@@ -0,0 +1,105 @@
+#!/usr/bin/ipython
+
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license. 
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: flattening
+   :platform: Unix
+   :synopsis: A benchmark of the loop and vectorised DataLoader layer flattening methods.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+import numpy as np
+from sys import argv
+from time import time
+
+#####
+# Load specific local code:
+from timeseries.timeseriesTools import flattenLayer, flattenLayerLoop
+
+
+def makeSyntheticLayer(nt=12, ny=332, nx=362, landFraction=0.3, seed=0):
+	"""
+	:param nt: Number of time steps.
+	:param ny: Number of latitude points (332 for ORCA1).
+	:param nx: Number of longitude points (362 for ORCA1).
+	:param landFraction: The fraction of the grid that is masked as land.
+
+	Creates a masked data layer, with ORCA-like 2D nav_lat and nav_lon arrays.
+	The land mask is the same at each time step, as it would be in a model.
+	"""
+	rng = np.random.RandomState(seed)
+	lat1d = np.linspace(-78., 89.5, ny)
+	lon1d = np.linspace(-180., 180., nx, endpoint=False)
+	lon2d, lat2d = np.meshgrid(lon1d, lat1d)
+
+	#####
+	# Add a small distortion, so that the grid is irregular, like ORCA.
+	lat2d = lat2d + 0.1*np.sin(np.radians(lon2d))
+	lon2d = lon2d + 0.1*np.cos(np.radians(lat2d))
+
+	land = rng.rand(ny, nx) < landFraction
+	data = np.ma.array(rng.rand(nt, ny, nx)*10., mask = np.tile(land, (nt,1,1)))
+	return data, lat2d, lon2d
+
+
+def compressOutput(out):
+	"""
+	Applies the same final masking as DataLoader.createOneDDataArray.
+	"""
+	arr = np.ma.masked_invalid(np.ma.array(out[0]))
+	mask = np.ma.masked_where((arr>1E20) + arr.mask,arr).mask
+	return [np.ma.masked_where(mask, a).compressed() for a in [arr,] + list(out[1:])]
+
+
+def benchmarkFlattening(nt=12, ny=332, nx=362, dims = ('time_counter','y','x')):
+	"""
+	Times the loop and vectorised flattening methods on a synthetic ORCA1 sized field,
+	and checks that they produce identical output.
+	"""
+	data, lat, lon = makeSyntheticLayer(nt=nt, ny=ny, nx=nx)
+	print "benchmarkFlattening:\tfield shape:", data.shape, '\tunmasked points:', data.count()
+
+	t0 = time()
+	loopOut = compressOutput(flattenLayerLoop(data, lat, lon, dims, name = 'benchmark'))
+	loopTime = time() - t0
+
+	t0 = time()
+	vectOut = compressOutput(flattenLayer(data, lat, lon, dims, name = 'benchmark'))
+	vectTime = time() - t0
+
+	for name, a, b in zip(['arr','arr_t','arr_z','arr_lat','arr_lon','arr_j','arr_i'], loopOut, vectOut):
+		if a.dtype != b.dtype or not np.array_equal(a, b):
+			raise AssertionError("benchmarkFlattening:\tOutputs differ: "+name)
+
+	print "benchmarkFlattening:\tloop:      ", round(loopTime,3), 's'
+	print "benchmarkFlattening:\tvectorised:", round(vectTime,3), 's'
+	print "benchmarkFlattening:\tspeed up:  ", round(loopTime/max(vectTime, 1.E-9),1), 'x'
+	return {'loop': loopTime, 'vectorised': vectTime, 'points': data.count()}
+
+
+if __name__=="__main__":
+	try:	nt = int(argv[1])
+	except:	nt = 12
+	benchmarkFlattening(nt = nt)
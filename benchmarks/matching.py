@@ -0,0 +1,161 @@
+#!/usr/bin/ipython
+
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license.
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: matching
+   :platform: Unix
+   :synopsis: A check and benchmark of the batched p2p matching against the original point by point loop.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+import numpy as np
+from sys import argv
+from time import time
+from types import InstanceType
+
+#####
+# Load specific local code:
+from bgcvaltools import bgcvalpython as bvp
+from p2p.matchDataAndModel import matchDataAndModel, matchDepths, matchTimes
+
+
+def matchPointsLoop(points, is_t, is_index_t, is_z, la_arr, lo_arr, depthcc, tdict, matches, imatches, maremask):
+	"""
+	The original point by point matching of matchDataAndModel._matchModelToData_,
+	after the lat and lon indices are found.
+	matches, imatches and maremask are updated in place.
+	"""
+	zdict = {}
+	for n,i in enumerate(points):
+		la,lo = la_arr[n], lo_arr[n]
+		if la == lo == -1: continue
+
+		#####
+		#Match Depth
+		wz = is_z[n]
+		try:	z = zdict[wz]
+		except:
+			z = bvp.getORCAdepth(wz,depthcc,debug=False)
+			zdict[wz] = z
+
+		#####
+		#Match Time
+		try: 	t = tdict[is_index_t[n]]
+		except:	t = tdict[is_t[n]]
+
+		#####
+		# Add match into array
+		if (t,z,la,lo) in matches:
+			maremask[i] = matches[(t,z,la,lo)][0]
+			matches[(t,z,la,lo)].append(i)
+		else:
+			matches[(t,z,la,lo)] = [i,]
+			maremask[i] = i
+		imatches[i] = (t,z,la,lo)
+
+
+def matchPointsBatch(match, points, is_t, is_index_t, is_z, la_arr, lo_arr, depthcc, tdict):
+	"""
+	The batched matching, as in matchDataAndModel._matchModelToData_.
+	"""
+	found = (la_arr > -1) * (lo_arr > -1)
+	points, la, lo, is_z, is_t, is_index_t = points[found], la_arr[found], lo_arr[found], is_z[found], is_t[found], is_index_t[found]
+	z = matchDepths(is_z, depthcc)
+	t = matchTimes(is_index_t, is_t, tdict)
+	match.addMatches(points, t, z, la, lo)
+
+
+def makeSyntheticPoints(n, ny = 149, nx = 182, seed = 0):
+	"""
+	Random in situ points on an ORCA2 sized grid, with repeated locations,
+	depths between the model levels and some points that are not found.
+	"""
+	rng = np.random.RandomState(seed)
+	depthcc = np.array([5.,15.,25.,50.,100.,200.,500.,1000.,2000.,4000.])
+	is_index_t = rng.randint(0,12,n)
+	is_t = is_index_t.astype(float)
+	is_z = rng.choice([0., 5., 10., 20., 20.5, 300., 1500., 3500., 10.], n)
+	la_arr = rng.randint(0,ny,n)
+	lo_arr = rng.randint(0,nx,n)
+	missing = rng.rand(n) < 0.01
+	la_arr[missing] = -1
+	lo_arr[missing] = -1
+	tdict = {i:i for i in xrange(12)}
+	return is_t, is_index_t, is_z, la_arr, lo_arr, depthcc, tdict
+
+
+def newMatch(n):
+	"""
+	An empty matchDataAndModel, without running the matching, to hold the matches.
+	"""
+	match = InstanceType(matchDataAndModel)
+	match.matches = {}
+	match.imatches = {}
+	match.maremask = np.zeros(n)
+	return match
+
+
+def benchmarkMatching(n = 400000):
+	"""
+	Checks that the batched matching gives the same matches, imatches and maremask as the loop,
+	in one go and when resuming from a half matched run, then times both.
+	"""
+	is_t, is_index_t, is_z, la_arr, lo_arr, depthcc, tdict = makeSyntheticPoints(n)
+	points = np.arange(n)
+	print "benchmarkMatching:\tpoints:", n
+
+	loop = newMatch(n)
+	t0 = time()
+	matchPointsLoop(points, is_t, is_index_t, is_z, la_arr, lo_arr, depthcc, tdict, loop.matches, loop.imatches, loop.maremask)
+	loopTime = time() - t0
+
+	batch = newMatch(n)
+	t0 = time()
+	matchPointsBatch(batch, points, is_t, is_index_t, is_z, la_arr, lo_arr, depthcc, tdict)
+	batchTime = time() - t0
+
+	#####
+	# Resume from a half matched run.
+	half = n//2
+	resumed = newMatch(n)
+	for s in [slice(0,half), slice(half,n)]:
+		matchPointsBatch(resumed, points[s], is_t[s], is_index_t[s], is_z[s], la_arr[s], lo_arr[s], depthcc, tdict)
+
+	for name, match in [('batch', batch), ('resumed', resumed)]:
+		if match.matches != loop.matches:	raise AssertionError("benchmarkMatching:\t"+name+" matches differ from the loop.")
+		if match.imatches != loop.imatches:	raise AssertionError("benchmarkMatching:\t"+name+" imatches differ from the loop.")
+		if (match.maremask != loop.maremask).any():	raise AssertionError("benchmarkMatching:\t"+name+" maremask differs from the loop.")
+	print "benchmarkMatching:\tbatch and resumed matches are identical to the loop:", len(loop.matches), 'locations'
+
+	print "benchmarkMatching:\tloop: ", round(loopTime,3), 's'
+	print "benchmarkMatching:\tbatch:", round(batchTime,3), 's'
+	print "benchmarkMatching:\tspeed up:", round(loopTime/max(batchTime, 1.E-9),1), 'x'
+	return {'loop': loopTime, 'batch': batchTime, 'points': n}
+
+
+if __name__=="__main__":
+	try:	n = int(argv[1])
+	except:	n = 400000
+	benchmarkMatching(n = n)
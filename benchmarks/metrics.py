@@ -0,0 +1,98 @@
+#!/usr/bin/ipython
+
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license. 
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: metrics
+   :platform: Unix
+   :synopsis: A benchmark of the per-time and grouped single pass time series metric calculations.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+import numpy as np
+from sys import argv
+from time import time
+
+#####
+# Load specific local code:
+from bgcvaltools import bgcvalpython as bvp
+from timeseries.timeseriesTools import groupedMetrics
+from benchmarks.flattening import makeSyntheticLayer
+
+
+def perTimeMetrics(layerdata, weights, timesIndex, times, percentiles):
+	"""
+	The metrics, calculated with one mask and one sort per time step, 
+	as extractFileMetrics did before groupedMetrics.
+	"""
+	out = {}
+	for t,meantime in enumerate(times):
+		ts_layerdata = np.ma.masked_where(timesIndex != t, layerdata).compressed()
+		ts_weights   = np.ma.masked_where(timesIndex != t, weights  ).compressed()
+		out[(t,'mean')] = np.ma.average(ts_layerdata,weights=ts_weights)
+		out[(t,'sum')]  = np.ma.sum(ts_layerdata)
+		out[(t,'min')]  = np.ma.min(ts_layerdata)
+		out[(t,'max')]  = np.ma.max(ts_layerdata)
+		for pc,dat in zip(percentiles, bvp.weighted_percentiles(ts_layerdata, percentiles, weights = ts_weights)):
+			out[(t,pc)] = dat
+	return out
+
+
+def benchmarkMetrics(nt=12, ny=332, nx=362, percentiles = [1.,5.,10.,20.,30.,40.,50.,60.,70.,80.,90.,95.,99.]):
+	"""
+	Times the per-time and grouped metric calculations on a synthetic ORCA1 sized field,
+	and checks that they produce the same values.
+	"""
+	data, lat, lon = makeSyntheticLayer(nt=nt, ny=ny, nx=nx)
+	area = np.random.RandomState(1).rand(ny,nx) + 0.5
+	index = np.nonzero(~np.ma.getmaskarray(data))
+	layerdata = np.ma.getdata(data)[index]
+	timesIndex = index[0]
+	weights = area[index[1],index[2]]
+	times = np.arange(nt)/12.
+	print "benchmarkMetrics:\tpoints:", len(layerdata), '\ttimes:', nt, '\tpercentiles:',len(percentiles)
+
+	t0 = time()
+	loopOut = perTimeMetrics(layerdata, weights, timesIndex, times, percentiles)
+	loopTime = time() - t0
+
+	t0 = time()
+	groups, groupOut = groupedMetrics(layerdata, weights, timesIndex, percentiles = percentiles)
+	groupTime = time() - t0
+
+	for g,t in enumerate(groups):
+		for m in ['mean','sum','min','max',] + percentiles:
+			if not np.allclose(loopOut[(t,m)], groupOut[m][g], rtol=1.E-10, atol=0.):
+				raise AssertionError("benchmarkMetrics:\tOutputs differ: "+str((t,m,loopOut[(t,m)],groupOut[m][g])))
+
+	print "benchmarkMetrics:\tper time:", round(loopTime,3), 's'
+	print "benchmarkMetrics:\tgrouped: ", round(groupTime,3), 's'
+	print "benchmarkMetrics:\tspeed up:", round(loopTime/max(groupTime, 1.E-9),1), 'x'
+	return {'perTime': loopTime, 'grouped': groupTime, 'points': len(layerdata)}
+
+
+if __name__=="__main__":
+	try:	nt = int(argv[1])
+	except:	nt = 12
+	benchmarkMetrics(nt = nt)
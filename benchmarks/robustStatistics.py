@@ -0,0 +1,119 @@
+#!/usr/bin/ipython
+
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license. 
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: robustStatistics
+   :platform: Unix
+   :synopsis: A check and benchmark of the robust scale estimators against their explicit versions.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+import numpy as np
+from sys import argv
+from time import time
+
+#####
+# Load specific local code:
+from bgcvaltools import RobustStatistics as rs
+
+absoluteDistance = lambda a,b: abs(a-b)
+
+#####
+# The fast estimators, and the explicit versions that they are checked against.
+# Each is called with one or two samples.
+estimators = [	('MID',		lambda x,y: rs.MID(x),			lambda x,y: rs.MIDExplicit(x)),
+		('Sn',		lambda x,y: rs.Sn(x),			lambda x,y: rs.SnExplicit(x)),
+		('Qn',		lambda x,y: rs.Qn(x),			lambda x,y: rs.QnExplicit(x)),
+		('Sdist',	lambda x,y: rs.Sdist(x,y),		lambda x,y: rs.SdistExplicit(x,y,absoluteDistance)),
+		('Qdist',	lambda x,y: rs.Qdist(x,y),		lambda x,y: rs.QdistExplicit(x,y,absoluteDistance)),
+		('Sdist(distFun)',lambda x,y: rs.Sdist(x,y,absoluteDistance),lambda x,y: rs.SdistExplicit(x,y,absoluteDistance)),
+		('Qdist(distFun)',lambda x,y: rs.Qdist(x,y,absoluteDistance),lambda x,y: rs.QdistExplicit(x,y,absoluteDistance)),
+		]
+
+
+def makeSample(rng, n, dtype=np.float64):
+	"""
+	A heavy tailed sample, rounded so that it has many ties.
+	"""
+	x = rng.standard_cauchy(n)*rng.choice([1.,10.,1000.])
+	return x.round(rng.randint(0,3)).astype(dtype)
+
+
+def checkRobustStatistics(trials=300, maxSize=80, seed=0):
+	"""
+	Checks that the fast estimators give exactly the same values as the explicit versions,
+	on small samples of different sizes and types, and that masked points are ignored.
+	"""
+	rng = np.random.RandomState(seed)
+	for trial in range(trials):
+		dtype = [np.float32,np.float64,np.int64][trial%3]
+		x = makeSample(rng, rng.randint(1,maxSize), dtype)
+		y = makeSample(rng, rng.randint(1,maxSize), dtype)
+		for name, fast, explicit in estimators:
+			a, b = fast(x,y), explicit(x,y)
+			if a != b:
+				raise AssertionError("checkRobustStatistics:\t"+name+" differs from the explicit version: "+str((a,b,len(x),len(y),dtype)))
+
+		#####
+		# Masked points are ignored.
+		mask = rng.rand(len(x))<0.3
+		if mask.all(): continue
+		mx = np.ma.masked_where(mask,x)
+		for name, fast, explicit in estimators[:5]:
+			if fast(mx,y) != fast(mx.compressed(),y):
+				raise AssertionError("checkRobustStatistics:\t"+name+" uses the masked points.")
+	print "checkRobustStatistics:\t",trials,"trials match the explicit versions."
+
+
+def benchmarkRobustStatistics(sizes=[10**3,10**4,10**5,10**6], explicitSize=1000, seed=0):
+	"""
+	Times the fast estimators on increasing sample sizes,
+	and the explicit versions on a sample of explicitSize points.
+	"""
+	rng = np.random.RandomState(seed)
+	times = {}
+	x, y = makeSample(rng, explicitSize), makeSample(rng, explicitSize)
+	for name, fast, explicit in estimators[:5]:
+		t0 = time()
+		explicit(x,y)
+		times[(name,'explicit',explicitSize)] = time() - t0
+	for n in sizes:
+		x, y = makeSample(rng, n), makeSample(rng, n)
+		for name, fast, explicit in estimators[:5]:
+			t0 = time()
+			fast(x,y)
+			times[(name,'fast',n)] = time() - t0
+
+	print "benchmarkRobustStatistics:\testimator\texplicit ("+str(explicitSize)+")\tfast:", '\t'.join([str(n) for n in sizes])
+	for name, fast, explicit in estimators[:5]:
+		print "benchmarkRobustStatistics:\t", name,'\t', round(times[(name,'explicit',explicitSize)],3), 's\t', '\t'.join([str(round(times[(name,'fast',n)],3)) for n in sizes])
+	return times
+
+
+if __name__=="__main__":
+	try:	maxSize = int(float(argv[1]))
+	except:	maxSize = 10**6
+	checkRobustStatistics()
+	benchmarkRobustStatistics(sizes = [n for n in [10**3,10**4,10**5,10**6,10**7] if n<=maxSize])
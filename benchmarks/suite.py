@@ -0,0 +1,379 @@
+#!/usr/bin/ipython
+
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license.
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: suite
+   :platform: Unix
+   :synopsis: A benchmark suite of the time series, p2p and profile hot paths, on synthetic ORCA files.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+Usage, from the bgc-val folder:
+
+	python -m benchmarks.suite ORCA1 [folder] [stage1,stage2...]
+	python -m benchmarks.suite compare old.json new.json
+
+Each stage is run in a new python process, so that its peak memory (RSS) is measured on its own.
+The results are saved as json in the folder, named after the grid and the git commit,
+so that the results of two commits can be compared.
+"""
+
+import os
+import sys
+import json
+import shutil
+import socket
+import resource
+import subprocess
+import tempfile
+from datetime import datetime
+from time import time
+import numpy as np
+
+#####
+# Load specific local code:
+from benchmarks import synthetic
+
+#####
+# The regions used by the benchmarks: a mix of simple latitude cuts and spatial regions.
+benchmarkRegions = ['Global', 'SouthernOcean', 'ArcticOcean', 'Equator10', 'Remainder', 'NorthernSubpolarAtlantic', 'NorthernSubpolarPacific', 'ignoreInlandSeas', ]
+
+#####
+# The stages, in the order that they are run.
+stageNames = ['DataLoader', 'loadModelWeights', 'makeMask', 'weighted_percentiles', 'p2p', 'profileAnalysis.loadModel', ]
+
+repoFolder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def peakRSS():
+	"""
+	The peak resident memory of this process, in MB. (ru_maxrss is in kB on linux.)
+	"""
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def gitCommit():
+	try:	return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = repoFolder).strip()
+	except:	return 'unknown'
+
+
+#####
+# The stages.
+# Each stage takes the dictionairy of synthetic files and the grid name,
+# and returns a dictionairy with the number of items processed ('count') and their 'unit'.
+# Stages can also return 'substages', a dictionairy of name: (wall time, count, unit).
+
+def benchDataLoader(files, grid):
+	"""
+	DataLoader: flattening and masking the Surface and 500m layers of the model file in every region.
+	"""
+	from timeseries import timeseriesTools as tst
+	layers = ['Surface', '500m',]
+	dl = tst.DataLoader(files['model'], '', synthetic.modelCoords, synthetic.modelDetails, regions = benchmarkRegions, layers = layers)
+	nt = len(dl.timedict)
+	nz, ny, nx = synthetic.gridShapes[grid]
+	return {'count': nt*ny*nx*len(layers), 'unit': 'cells'}
+
+
+def benchLoadModelWeights(files, grid):
+	"""
+	timeseriesAnalysis.loadModelWeights: the area and volume of every model grid cell.
+	"""
+	from timeseries.timeseriesAnalysis import timeseriesAnalysis
+	class weightsLoader: pass
+	loader = weightsLoader()
+	loader.gridFile = files['grid']
+	loader.debug = False
+	timeseriesAnalysis.loadModelWeights.im_func(loader)
+	return {'count': loader.modelVolume.size, 'unit': 'cells'}
+
+
+def benchMakeMask(files, grid):
+	"""
+	makeMask: every region mask, for every ocean point of the model surface.
+	The region mask cache is emptied first, so that the masks are calculated.
+	"""
+	from regions.makeMask import loadMaskMakers, makeMask, maskCacheDir
+	from bgcvaltools.dataset import dataset
+	if os.path.exists(maskCacheDir): shutil.rmtree(maskCacheDir)
+	nc = dataset(files['grid'], 'r')
+	ocean = nc.variables['tmask'][0] > 0
+	lat = nc.variables['nav_lat'][:][ocean]
+	lon = nc.variables['nav_lon'][:][ocean]
+	nc.close()
+	zeros = np.zeros_like(lat)
+	data = np.ones_like(lat)
+	regions, maskingfunctions = loadMaskMakers(regions = benchmarkRegions)
+	for region in regions:
+		makeMask(maskingfunctions, synthetic.modelDetails['name'], region, zeros, zeros, lat, lon, data)
+	return {'count': len(lat)*len(regions), 'unit': 'points'}
+
+
+def benchWeightedPercentiles(files, grid):
+	"""
+	bvp.weighted_percentiles: area weighted percentiles of the model surface, once per month.
+	"""
+	from bgcvaltools import bgcvalpython as bvp
+	from bgcvaltools.dataset import dataset
+	nc = dataset(files['grid'], 'r')
+	area = nc.variables['e1t'][:] * nc.variables['e2t'][:]
+	nc.close()
+	nc = dataset(files['model'], 'r')
+	nt = len(nc.variables['time_counter'])
+	count = 0
+	for t in range(nt):
+		surface = nc.variables['CHL'][t,0]
+		ocean = ~np.ma.getmaskarray(surface)
+		bvp.weighted_percentiles(np.ma.getdata(surface)[ocean], [1.,5.,10.,20.,30.,40.,50.,60.,70.,80.,90.,95.,99.], weights = area[ocean])
+		count += ocean.sum()
+	nc.close()
+	return {'count': count, 'unit': 'points'}
+
+
+def benchP2P(files, grid):
+	"""
+	The point to point matching of the in situ surface layer to the model:
+	convertToOneDNC of the in situ data, _matchModelToData_ and convertToOneDNC of the model.
+	Each step is timed as a substage.
+	"""
+	from p2p.matchDataAndModel import matchDataAndModel
+	from bgcvaltools.dataset import dataset
+	workingDir = os.path.abspath('p2p')+'/'
+	if os.path.exists(workingDir): shutil.rmtree(workingDir)
+
+	#####
+	# The steps are run by hand, to time each one.
+	class timedMatch(matchDataAndModel):
+	  def run(self,): pass
+	match = timedMatch(files['insitu'], files['model'],
+			dataType	= 'chl',
+			workingDir	= workingDir,
+			modelcoords	= synthetic.modelCoords,
+			modeldetails	= synthetic.modelDetails,
+			datacoords	= synthetic.dataCoords,
+			datadetails	= synthetic.dataDetails,
+			datasource	= 'synthetic',
+			model		= 'synthetic',
+			jobID		= grid,
+			year		= '2000',
+			layer		= 'Surface',
+			grid		= grid,
+			gridFile	= files['grid'],
+			debug		= False,)
+	substages = {}
+	for name, step in [	('calculateModelYearIndex',	match._calculateModelYearIndex_),
+				('pruneModelAndData',		match._pruneModelAndData_),
+				('convertDataToOneDNC',		match._convertDataTo1D_),
+				('matchModelToData',		match._matchModelToData_),
+				('convertModelToOneDNC',	match._convertModelToOneD_),]:
+		start = time()
+		step()
+		substages[name] = time() - start
+
+	nc = dataset(match.DataFile1D, 'r')
+	points = len(nc.variables['index'])
+	nc.close()
+	out = {'count': points, 'unit': 'points'}
+	out['substages'] = {name: {'wall': wall, 'count': points, 'unit': 'points'} for name, wall in substages.items()}
+	return out
+
+
+def benchProfileLoadModel(files, grid):
+	"""
+	profileAnalysis.loadModel: the mean and median profile of every region for every month, on every model level.
+	"""
+	from timeseries.profileAnalysis import profileAnalysis
+	workingDir = os.path.abspath('profile')+'/'
+	if os.path.exists(workingDir): shutil.rmtree(workingDir)
+	#####
+	# With no model files, profileAnalysis only saves its settings,
+	# then the files are added, and only loadModel is run.
+	pa = profileAnalysis(modelFiles = '',
+			modelcoords	= synthetic.modelCoords,
+			modeldetails	= synthetic.modelDetails,
+			dataType	= 'chl',
+			jobID		= grid,
+			timerange	= [1950., 2100.],
+			layers		= 'All',
+			regions		= benchmarkRegions,
+			metrics		= ['mean', 'median',],
+			workingDir	= workingDir,
+			grid		= grid,
+			gridFile	= files['grid'],
+			clean		= True,
+			debug		= False,)
+	pa.modelFiles		= [files['model'],]
+	pa.shelvefn		= workingDir+'profile_'+grid+'.shelve'
+	pa._masksLoaded_	= False
+	pa.loadModel()
+	nz, ny, nx = synthetic.gridShapes[grid]
+	nt = len(pa.modeldataD[(benchmarkRegions[0], 0, 'mean')])
+	return {'count': nt*nz*ny*nx*len(benchmarkRegions), 'unit': 'cells'}
+
+
+stages = {	'DataLoader':			benchDataLoader,
+		'loadModelWeights':		benchLoadModelWeights,
+		'makeMask':			benchMakeMask,
+		'weighted_percentiles':		benchWeightedPercentiles,
+		'p2p':				benchP2P,
+		'profileAnalysis.loadModel':	benchProfileLoadModel, }
+
+
+def runStage(stage, grid, folder, outFile):
+	"""
+	Runs a single stage in this process, and saves its results as json in outFile.
+	The working directory is the benchmark folder, so that the caches are made there.
+	"""
+	files = synthetic.makeSyntheticFiles(folder, grid)
+	os.chdir(folder)
+	startRSS = peakRSS()
+	start = time()
+	out = stages[stage](files, grid)
+	out['wall'] = time() - start
+	out['throughput'] = out['count']/max(out['wall'], 1.E-9)
+	out['startRSS'] = startRSS
+	out['peakRSS'] = peakRSS()
+	for name, sub in out.get('substages', {}).items():
+		sub['throughput'] = sub['count']/max(sub['wall'], 1.E-9)
+	with open(outFile, 'w') as f: json.dump(out, f)
+
+
+def runSuite(grid, folder = '', stageList = []):
+	"""
+	:param grid: ORCA2, ORCA1 or ORCA025.
+	:param folder: The folder for the synthetic files, the caches and the json results.
+	:param stageList: A list of stage names, (default: all of stageNames).
+
+	Makes the synthetic files (if needed), then runs each stage in a new python process.
+	Returns the results dictionairy, which is also saved in the folder as json.
+	"""
+	if not folder: folder = os.path.join(tempfile.gettempdir(), 'bgcval_benchmarks')
+	folder = os.path.abspath(folder)+'/'
+	if not len(stageList): stageList = stageNames
+	for stage in stageList:
+		if stage not in stages:
+			raise AssertionError("suite.py:\trunSuite:\tUnknown stage: "+str(stage)+", choose from: "+str(stageNames))
+	files = synthetic.makeSyntheticFiles(folder, grid)
+
+	results = {	'grid':		grid,
+			'shape':	synthetic.gridShapes[grid],
+			'commit':	gitCommit(),
+			'date':		datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+			'host':		socket.gethostname(),
+			'files':	files,
+			'stages':	{}, }
+
+	env = dict(os.environ)
+	env['PYTHONPATH'] = os.pathsep.join([repoFolder, env.get('PYTHONPATH', '')])
+	for stage in stageList:
+		print "benchmarks:\tRunning", stage, 'on', grid
+		outFile = folder+'stage.json'
+		if os.path.exists(outFile): os.remove(outFile)
+		with open(folder+stage+'.log', 'w') as log:
+			returncode = subprocess.call([sys.executable, '-m', 'benchmarks.suite', 'stage', stage, grid, folder, outFile],
+						cwd = folder, env = env, stdout = log, stderr = subprocess.STDOUT)
+		if returncode or not os.path.exists(outFile):
+			print "benchmarks:\tFAILED:\t", stage, ', see the log:', folder+stage+'.log'
+			results['stages'][stage] = {'failed': True}
+			continue
+		with open(outFile, 'r') as f: results['stages'][stage] = json.load(f)
+		os.remove(outFile)
+
+	#####
+	# The stages of a previous run of the same grid and commit are kept, so the stages can be run separately.
+	jsonFile = folder+'benchmark_'+grid+'_'+results['commit']+'.json'
+	if os.path.exists(jsonFile):
+		with open(jsonFile, 'r') as f: previous = json.load(f)
+		for stage, r in previous['stages'].items():
+			if stage not in results['stages']: results['stages'][stage] = r
+
+	report(results)
+	with open(jsonFile, 'w') as f: json.dump(results, f, indent = 1, sort_keys = True)
+	print "benchmarks:\tSaved results:", jsonFile
+	return results
+
+
+def report(results):
+	"""
+	Print the wall time, throughput and peak memory of each stage.
+	"""
+	print "------------------------------------------------------------------"
+	print "benchmarks:\t", results['grid'], results['shape'], 'commit:', results['commit'], results['date']
+	print '{:<40} {:>10} {:>24} {:>12}'.format('stage', 'wall (s)', 'throughput', 'peak RSS (MB)')
+	for stage in stageNames:
+		if stage not in results['stages']: continue
+		r = results['stages'][stage]
+		if r.get('failed', False):
+			print '{:<40} {:>10}'.format(stage, 'FAILED')
+			continue
+		print '{:<40} {:>10.3f} {:>16.4g} {:<7} {:>12.1f}'.format(stage, r['wall'], r['throughput'], r['unit']+'/s', r['peakRSS'])
+		for name in sorted(r.get('substages', {}).keys()):
+			s = r['substages'][name]
+			print '{:<40} {:>10.3f} {:>16.4g} {:<7}'.format('    '+name, s['wall'], s['throughput'], s['unit']+'/s')
+	print "------------------------------------------------------------------"
+
+
+def compareResults(oldFile, newFile, threshold = 0.1):
+	"""
+	:param oldFile: The json results of the reference commit.
+	:param newFile: The json results of the new commit.
+	:param threshold: The fractional change in wall time or peak memory that is reported as a regression.
+
+	Prints the ratio of the wall time and peak memory of each stage, and flags the regressions.
+	Returns the list of stages that regressed.
+	"""
+	with open(oldFile, 'r') as f: old = json.load(f)
+	with open(newFile, 'r') as f: new = json.load(f)
+	if old['grid'] != new['grid']: print "benchmarks:\tWARNING:\tComparing different grids:", old['grid'], new['grid']
+	print "benchmarks:\tComparing", old['commit'], '->', new['commit'], 'on', new['grid']
+	print '{:<40} {:>12} {:>12} {:>12} {:>12}'.format('stage', 'old wall', 'new wall', 'wall ratio', 'RSS ratio')
+	regressions = []
+	for stage in stageNames:
+		if stage not in old['stages'] or stage not in new['stages']: continue
+		o, n = old['stages'][stage], new['stages'][stage]
+		if o.get('failed', False) or n.get('failed', False):
+			print '{:<40} {:>12}'.format(stage, 'FAILED')
+			continue
+		wallRatio = n['wall']/max(o['wall'], 1.E-9)
+		rssRatio = n['peakRSS']/max(o['peakRSS'], 1.E-9)
+		flag = ''
+		if wallRatio > 1.+threshold or rssRatio > 1.+threshold:
+			flag = '<-- regression'
+			regressions.append(stage)
+		print '{:<40} {:>12.3f} {:>12.3f} {:>12.2f} {:>12.2f} {}'.format(stage, o['wall'], n['wall'], wallRatio, rssRatio, flag)
+	return regressions
+
+
+if __name__=="__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == 'stage':
+		runStage(*sys.argv[2:6])
+	elif len(sys.argv) > 1 and sys.argv[1] == 'compare':
+		compareResults(sys.argv[2], sys.argv[3])
+	else:
+		try:	grid = sys.argv[1]
+		except:	grid = 'ORCA2'
+		try:	folder = sys.argv[2]
+		except:	folder = ''
+		try:	stageList = sys.argv[3].split(',')
+		except:	stageList = []
+		runSuite(grid, folder = folder, stageList = stageList)
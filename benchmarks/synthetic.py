@@ -0,0 +1,223 @@
+#!/usr/bin/ipython
+
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license.
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: synthetic
+   :platform: Unix
+   :synopsis: Synthetic ORCA model, grid and in situ netcdf files for the benchmarks.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+import os
+import numpy as np
+from netCDF4 import Dataset
+
+#####
+# Load specific local code:
+from bgcvaltools import bgcvalpython as bvp
+
+#####
+# The (depth, y, x) shape of each grid.
+gridShapes = {	'ORCA2':	(31, 149, 182),
+		'ORCA1':	(75, 332, 362),
+		'ORCA025':	(75, 1021, 1442), }
+
+#####
+# The default number of monthly time steps in the model file.
+# A full ORCA025 year is several GB, so only one month is made by default.
+defaultTimes = {'ORCA2': 12, 'ORCA1': 12, 'ORCA025': 1, }
+
+#####
+# The coordinates and details of the synthetic files, in the same format as the config parser.
+modelCoords	= {'t':'time_counter', 'z':'deptht', 'lat': 'nav_lat', 'lon': 'nav_lon', 'cal': '365_day', 'tdict': bvp.tdicts['ZeroToZero']}
+modelDetails	= {'name': 'SyntheticChl', 'vars': ['CHL',], 'convert': bvp.NoChange, 'units': 'mg Chl/m3'}
+dataCoords	= {'t':'time', 'z':'depth', 'lat': 'lat', 'lon': 'lon', 'cal': 'standard', 'tdict': bvp.tdicts['ZeroToZero']}
+dataDetails	= {'name': 'SyntheticChl', 'vars': ['chl',], 'convert': bvp.NoChange, 'units': 'mg Chl/m3'}
+
+#####
+# The WOA depth levels, used for the in situ file.
+woaDepths = [0., 10., 20., 30., 50., 75., 100., 125., 150., 200., 250., 300., 400., 500., 600., 700., 800.,
+		900., 1000., 1100., 1200., 1300., 1400., 1500., 1750., 2000., 2500., 3000., 3500., 4000., 4500., 5000., 5500.]
+
+
+def syntheticGrid(grid, seed = 0):
+	"""
+	:param grid: ORCA2, ORCA1 or ORCA025.
+
+	Returns the nav_lat, nav_lon, depth, tmask, e1t, e2t and e3t arrays of a synthetic ORCA-like grid.
+	The grid is a slightly distorted regular grid, and the bathymetry is a smooth random field,
+	so that about a third of the surface is land and the number of ocean levels varies.
+	"""
+	nz, ny, nx = gridShapes[grid]
+	rng = np.random.RandomState(seed)
+	lat1d = np.linspace(-78., 89.5, ny)
+	lon1d = np.linspace(-180., 180., nx, endpoint=False)
+	lon2d, lat2d = np.meshgrid(lon1d, lat1d)
+	lat2d = lat2d + 0.1*np.sin(np.radians(lon2d))
+	lon2d = lon2d + 0.1*np.cos(np.radians(lat2d))
+
+	#####
+	# Depths increase from 5m at the surface to 5500m at the bottom, like the ORCA levels.
+	depth = 5. + 5495.*(np.expm1(np.linspace(0.,3.,nz))/np.expm1(3.))
+
+	#####
+	# A smooth random bathymetry.
+	bathy = np.zeros((ny,nx))
+	for k in range(6):
+		a, b, c, d = rng.rand(4)
+		bathy += np.sin(np.radians(lat2d)*(k+1)*4.*a + 6.*b) * np.cos(np.radians(lon2d)*(k+1)*2.*c + 6.*d)
+	bathy = (bathy - np.percentile(bathy,33.)) / (bathy.max() - np.percentile(bathy,33.))
+	nlevels = np.clip(np.ceil(bathy*nz), 0, nz).astype(int)
+	tmask = (np.arange(nz)[:,None,None] < nlevels[None,:,:]).astype(np.int8)
+
+	#####
+	# The cell sizes in metres.
+	dlat = 111195. * (lat1d[1]-lat1d[0])
+	dlon = 111195. * (lon1d[1]-lon1d[0])
+	e1t = dlon * np.cos(np.radians(lat2d))
+	e2t = dlat * np.ones_like(lat2d)
+	e3t = np.diff(np.concatenate([[0.,], depth]))[:,None,None] * np.ones((nz,ny,nx))
+	return lat2d, lon2d, depth, tmask, e1t, e2t, e3t
+
+
+def syntheticField(lat2d, depth, month, seed = 0):
+	"""
+	A smooth field, that decreases with depth and varies with latitude and season, with some noise.
+	"""
+	rng = np.random.RandomState(seed + month)
+	surface = 0.5 + 0.4*np.cos(np.radians(lat2d)*2.) + 0.2*np.sin(2.*np.pi*month/12.)*np.sin(np.radians(lat2d))
+	profile = np.exp(-np.asarray(depth)/200.)
+	field = profile[:,None,None] * surface[None,:,:]
+	return (field * (1. + 0.1*rng.rand(*field.shape))).astype(np.float32)
+
+
+def makeGridFile(fn, grid):
+	"""
+	Makes a mesh mask file, with nav_lat, nav_lon, deptht, tmask, e1t, e2t and e3t.
+	"""
+	lat2d, lon2d, depth, tmask, e1t, e2t, e3t = syntheticGrid(grid)
+	nz, ny, nx = tmask.shape
+	nc = Dataset(fn+'.tmp', 'w', format='NETCDF4')
+	nc.createDimension('z', nz)
+	nc.createDimension('y', ny)
+	nc.createDimension('x', nx)
+	nc.createVariable('nav_lat', np.float32, ('y','x'))[:] = lat2d
+	nc.createVariable('nav_lon', np.float32, ('y','x'))[:] = lon2d
+	nc.createVariable('deptht', np.float32, ('z',))[:] = depth
+	nc.createVariable('tmask', np.int8, ('z','y','x'), zlib=True)[:] = tmask
+	nc.createVariable('e1t', np.float64, ('y','x'))[:] = e1t
+	nc.createVariable('e2t', np.float64, ('y','x'))[:] = e2t
+	nc.createVariable('e3t', np.float64, ('z','y','x'), zlib=True)[:] = e3t
+	nc.title = 'Synthetic '+grid+' mesh mask, for the BGC-val benchmarks.'
+	nc.close()
+	os.rename(fn+'.tmp', fn)
+
+
+def makeModelFile(fn, grid, year = 2000, nt = 12):
+	"""
+	Makes a model file with nt monthly means of a 3D field, CHL, in the NEMO format.
+	Land is masked with a 1E20 fill value. The file is written one month at a time.
+	"""
+	lat2d, lon2d, depth, tmask, e1t, e2t, e3t = syntheticGrid(grid)
+	nz, ny, nx = tmask.shape
+	nc = Dataset(fn+'.tmp', 'w', format='NETCDF4')
+	nc.createDimension('time_counter', None)
+	nc.createDimension('deptht', nz)
+	nc.createDimension('y', ny)
+	nc.createDimension('x', nx)
+	times = nc.createVariable('time_counter', np.float64, ('time_counter',))
+	times.units = 'seconds since 1950-01-01 00:00:00'
+	times.calendar = '365_day'
+	nc.createVariable('nav_lat', np.float32, ('y','x'))[:] = lat2d
+	nc.createVariable('nav_lon', np.float32, ('y','x'))[:] = lon2d
+	nc.createVariable('deptht', np.float32, ('deptht',))[:] = depth
+	chl = nc.createVariable('CHL', np.float32, ('time_counter','deptht','y','x'), fill_value = 1E20)
+	chl.units = 'mg Chl/m3'
+	monthStarts = np.cumsum([0,31,28,31,30,31,30,31,31,30,31,30])
+	for t in range(nt):
+		times[t] = ((year-1950)*365. + monthStarts[t%12] + 15.)*86400.
+		chl[t] = np.ma.masked_where(tmask==0, syntheticField(lat2d, depth, t))
+	nc.title = 'Synthetic '+grid+' model file, for the BGC-val benchmarks.'
+	nc.close()
+	os.rename(fn+'.tmp', fn)
+
+
+def makeInsituFile(fn, coverage = 0.5, seed = 0):
+	"""
+	Makes a one degree, monthly, in situ file in the WOA format, with a fraction of the points observed.
+	"""
+	rng = np.random.RandomState(seed)
+	lat = np.arange(-89.5, 90., 1.)
+	lon = np.arange(-179.5, 180., 1.)
+	lon2d, lat2d = np.meshgrid(lon, lat)
+	nz, ny, nx = len(woaDepths), len(lat), len(lon)
+	nc = Dataset(fn+'.tmp', 'w', format='NETCDF4')
+	nc.createDimension('time', None)
+	nc.createDimension('depth', nz)
+	nc.createDimension('lat', ny)
+	nc.createDimension('lon', nx)
+	times = nc.createVariable('time', np.float64, ('time',))
+	times.units = 'months since 0000-01-01 00:00:00'
+	times.calendar = '360_day'
+	nc.createVariable('lat', np.float32, ('lat',))[:] = lat
+	nc.createVariable('lon', np.float32, ('lon',))[:] = lon
+	nc.createVariable('depth', np.float32, ('depth',))[:] = woaDepths
+	chl = nc.createVariable('chl', np.float32, ('time','depth','lat','lon'), fill_value = 1E20)
+	chl.units = 'mg Chl/m3'
+	for t in range(12):
+		times[t] = t + 0.5
+		field = syntheticField(lat2d, woaDepths, t, seed = seed+100)
+		chl[t] = np.ma.masked_where(rng.rand(nz,ny,nx) > coverage, field)
+	nc.title = 'Synthetic in situ file, for the BGC-val benchmarks.'
+	nc.close()
+	os.rename(fn+'.tmp', fn)
+
+
+def makeSyntheticFiles(folder, grid, nt = None, year = 2000):
+	"""
+	:param folder: The folder where the files are made.
+	:param grid: ORCA2, ORCA1 or ORCA025.
+	:param nt: The number of monthly time steps in the model file (see defaultTimes).
+
+	Makes the synthetic grid, model and in situ files, unless they already exist.
+	Returns a dictionairy of the file paths.
+	"""
+	if grid not in gridShapes:
+		raise AssertionError("synthetic.py:\tmakeSyntheticFiles:\tUnknown grid: "+str(grid)+", choose from: "+str(sorted(gridShapes.keys())))
+	if nt is None: nt = defaultTimes[grid]
+	folder = bvp.folder(folder)
+	files = {	'grid':		folder+'mesh_mask_synthetic_'+grid+'.nc',
+			'model':	folder+'synthetic_'+grid+'_'+str(year)+'_'+str(nt)+'months.nc',
+			'insitu':	folder+'synthetic_insitu_1deg.nc', }
+	if not os.path.exists(files['grid']):
+		print "makeSyntheticFiles:\tMaking", files['grid']
+		makeGridFile(files['grid'], grid)
+	if not os.path.exists(files['model']):
+		print "makeSyntheticFiles:\tMaking", files['model']
+		makeModelFile(files['model'], grid, year = year, nt = nt)
+	if not os.path.exists(files['insitu']):
+		print "makeSyntheticFiles:\tMaking", files['insitu']
+		makeInsituFile(files['insitu'])
+	return files
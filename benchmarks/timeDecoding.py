@@ -0,0 +1,104 @@
+#!/usr/bin/ipython
+
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license. 
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: timeDecoding
+   :platform: Unix
+   :synopsis: A check and benchmark of decimalYears against DOYarr(num2date(...)).
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+The reference num2date comes from netCDF4, which uses cftime.
+On python 2.7, this was run with netCDF4 1.4.2 and cftime 1.0.4 (the last cftime release for python 2).
+"""
+
+import numpy as np
+from sys import argv
+from time import time
+from netCDF4 import num2date
+
+#####
+# Load specific local code:
+from bgcvaltools import bgcvalpython as bvp
+
+calendars = ['360_day', '365_day', 'noleap', 'all_leap', 'gregorian', 'standard', 'proleptic_gregorian', 'julian', ]
+timeUnits = ['days since 1950-01-01 00:00:00', 'days since 1950-01-01 00:00:00 UTC', 'hours since 1850-01-01', 
+		'seconds since 2000-01-01 12:00:00', 'days since 1-1-1', ]
+
+
+def sampleTimes(seed=0):
+	"""
+	Time axes of each type that appear in model and data files: 
+	integer, float64 and float32, with whole, half and random fractional days.
+	"""
+	rng = np.random.RandomState(seed)
+	return [np.arange(0, 100, 1).astype(np.int32), 
+		np.arange(0, 20000, 15.5),
+		np.array([-30.5, 0.25]),
+		np.arange(0, 100000, 365.25).astype(np.float32),
+		np.array([82894.0, 15.5, 45.25, 12345.7], dtype=np.float32),
+		(rng.rand(200)*1e5).astype(np.float32), ]
+
+
+def checkDecimalYears():
+	"""
+	Checks that decimalYears gives exactly the same values as DOYarr(num2date(...)),
+	whenever it does not fall back to them by returning None.
+	"""
+	checked, fallBack = 0, 0
+	for cal in calendars:
+		for units in timeUnits:
+			for times in sampleTimes():
+				new = bvp.decimalYears(times, units, cal)
+				if new is None:
+					fallBack += 1
+					continue
+				old = bvp.DOYarr(num2date(times, units, calendar=cal))
+				if not np.array_equal(new, old):
+					raise AssertionError("checkDecimalYears:\tDiffers from DOYarr: "+' '.join([cal, units, str(times.dtype), str(np.abs(new-old).max())]))
+				checked += 1
+	print "checkDecimalYears:\t", checked, "time axes match DOYarr,", fallBack, "fall back to num2date."
+
+
+def benchmarkDecimalYears(nt=2400, cal='365_day', units='days since 1950-01-01 00:00:00'):
+	"""
+	Times decimalYears and DOYarr(num2date(...)) on a monthly time axis of nt steps.
+	"""
+	times = np.arange(nt)*(365./12.) + 15.
+	t0 = time()
+	bvp.DOYarr(num2date(times, units, calendar=cal))
+	oldTime = time() - t0
+	t0 = time()
+	bvp.decimalYears(times, units, cal)
+	newTime = time() - t0
+	print "benchmarkDecimalYears:\tnum2date:    ", round(oldTime,4), 's'
+	print "benchmarkDecimalYears:\tdecimalYears:", round(newTime,4), 's'
+	print "benchmarkDecimalYears:\tspeed up:    ", round(oldTime/max(newTime, 1.E-9),1), 'x'
+	return {'num2date': oldTime, 'decimalYears': newTime, 'times': nt}
+
+
+if __name__=="__main__":
+	try:	nt = int(argv[1])
+	except:	nt = 2400
+	checkDecimalYears()
+	benchmarkDecimalYears(nt = nt)
@@ -27,12 +27,13 @@
 .. moduleauthor:: Momme Butenschon <momm@pml.ac.uk>
 
 """
-from numpy import median,empty,logical_or,arange
+from numpy import median,empty,logical_or,arange,array,asarray,zeros,sort,partition,searchsorted,\
+     cumsum,nonzero,maximum,minimum,where,result_type,column_stack,concatenate,floor
 from numpy.ma import getmaskarray,getdata,masked_where
+from numpy.random import RandomState
 #from numpyXtns import nearest
 from scipy.misc import comb
 from scipy.stats.mstats import mquantiles
-from itertools import izip
 
 nearest = lambda x: x<0 and int(x-.5) or int(x+.5)
 anearest = lambda x: where(x<0,(x-.5).astype(int),(x+.5).astype(int))
@@ -55,9 +56,174 @@ def flatCompressSamples(s1,s2):
    s2=masked_where(Mask,s2).ravel().compressed()
    return s1,s2
 
+def _snCorrection(n):
+    """Small sample correction factor of Sn (Croux & Rousseeuw 1992)."""
+    if n<10:
+	return {2:.743,3:1.851,4:.954,5:1.351,6:.993,7:1.198,8:1.005,9:1.131}[n]
+    if n%2==1: return n/(n-.9)
+    return 1.
+
+def _qnCorrection(n):
+    """Small sample correction factor of Qn (Croux & Rousseeuw 1992)."""
+    if n<10:
+	return {2:.399,3:.994,4:.512,5:.844,6:.611,7:.857,8:.669,9:.872}[n]
+    if n%2==1: return n/(n+1.4)
+    return n/(n+3.8)
+
+def _countBelow(value,rows,lo,hi,trial,orEqual=False):
+    """Number of elements of each sorted row, between the columns lo and hi,
+    that are lesser than (or equal to) trial. Found by a bisection of all the rows at once."""
+    lo=lo.copy()
+    hi=hi.copy()
+    start=lo.copy()
+    while True:
+	a=nonzero(lo<hi)[0]
+	if len(a)==0: break
+	mid=(lo[a]+hi[a])//2
+	v=value(rows[a],mid)
+	if orEqual: below=v<=trial
+	else: below=v<trial
+	lo[a[below]]=mid[below]+1
+	hi[a[~below]]=mid[~below]
+    return lo-start
+
+def _selectSortedRows(value,lengths,k):
+    """Computes the k-th smallest element (counting from 1) of a set of sorted rows.
+    value(rows,cols) returns the elements, and each row is non-decreasing along its columns.
+    The candidate columns of each row are narrowed down to those between two pivots, 
+    taken from a random sample of the candidates either side of the expected rank 
+    (as in the Floyd & Rivest selection algorithm), until they can be sorted directly."""
+    lengths=asarray(lengths,dtype=int)
+    left=zeros(len(lengths),dtype=int)
+    right=lengths.copy()
+    random=RandomState(0)
+    spread=3.
+    while True:
+	rows=nonzero(right>left)[0]
+	weight=right[rows]-left[rows]
+	total=weight.sum()
+	kk=k-left.sum()
+	if total<=4*len(rows)+64: break
+	nSample=int(min(total,max(4096,len(rows)//4)))
+	ends=cumsum(weight)
+	pos=sort(minimum((random.random_sample(nSample)*total).astype(int),total-1))
+	r=searchsorted(ends,pos,side='right')
+	sample=sort(value(rows[r],left[rows[r]]+pos-(ends-weight)[r]))
+	expected=kk*float(nSample)/total
+	lowTrial=sample[int(max(0,expected-spread*nSample**.5))]
+	highTrial=sample[int(min(nSample-1,expected+spread*nSample**.5))]
+	below=_countBelow(value,rows,left[rows],right[rows],lowTrial)
+	belowEq=_countBelow(value,rows,left[rows],right[rows],highTrial,orEqual=True)
+	if kk<=below.sum():
+	    right[rows]=left[rows]+below
+	elif kk>belowEq.sum():
+	    left[rows]+=belowEq
+	elif lowTrial==highTrial:
+	    return lowTrial
+	else:
+	    #####
+	    # If the pivots do not narrow down the candidates (ie many ties), 
+	    # the next pivot is a single element at the expected rank.
+	    if below.sum()==0 and belowEq.sum()==total: spread=0.
+	    right[rows]=left[rows]+belowEq
+	    left[rows]+=below
+    cols=left[rows].repeat(weight)+arange(total)-(cumsum(weight)-weight).repeat(weight)
+    candidates=value(rows.repeat(weight),cols)
+    return partition(candidates,kk-1)[kk-1]
+
+def _nextOrderStatistic(value,lengths,k,vk):
+    """Computes the (k+1)-th smallest element of a set of sorted rows, given vk, the k-th."""
+    lengths=asarray(lengths,dtype=int)
+    belowEq=_countBelow(value,arange(len(lengths)),zeros(len(lengths),dtype=int),lengths,vk,orEqual=True)
+    if belowEq.sum()>k: return vk
+    rows=nonzero(belowEq<lengths)[0]
+    return value(rows,belowEq[rows]).min()
+
+def _mergedOrderStatistic(left,right,nLeft,nRight,m):
+    """For each row, computes the m-th smallest element (counting from 1) of the union of 
+    two sorted lists, left(rows,cols) and right(rows,cols), of lengths nLeft and nRight.
+    The number of elements taken from the left list is found by a bisection of all the rows at once."""
+    lo=maximum(0,m-nRight)
+    hi=minimum(m,nLeft)
+    while True:
+	a=nonzero(lo<hi)[0]
+	if len(a)==0: break
+	mid=(lo[a]+hi[a])//2
+	enough=left(a,mid)>=right(a,m[a]-mid-1)
+	hi[a[enough]]=mid[enough]
+	lo[a[~enough]]=mid[~enough]+1
+    out=None
+    for side,count in ((left,lo),(right,m-lo)):
+	rows=nonzero(count>0)[0]
+	v=side(rows,count[rows]-1)
+	if out is None:
+	    out=empty(len(m),dtype=v.dtype)
+	    out[rows]=v
+	    filled=zeros(len(m),dtype=bool)
+	    filled[rows]=True
+	else:
+	    out[rows]=where(filled[rows],maximum(out[rows],v),v)
+    return out
+
+def _pairwiseDifferences(y):
+    """The interpoint differences y[j]-y[i], i<j, of the sorted sample y, as n-1 sorted rows."""
+    n=y.shape[0]
+    value=lambda rows,cols: y[rows+1+cols]-y[rows]
+    return value,n-1-arange(n-1)
+
+def _absoluteDistances(a,b):
+    """The distances |ai-bj| between the sample a and the sorted sample b, as 2 sorted rows 
+    for each ai: the points of b below ai (nearest first) and above ai."""
+    n=a.shape[0]
+    p=searchsorted(b,a,side='right')
+    below=lambda rows,cols: a[rows]-b[p[rows]-1-cols]
+    above=lambda rows,cols: b[p[rows]+cols]-a[rows]
+    return below,above,p,b.shape[0]-p
+
+def _stackRows(first,second,nFirst):
+    """Joins two sets of sorted rows, so that the rows of second follow the nFirst rows of first."""
+    def value(rows,cols):
+	isFirst=rows<nFirst
+	v1=first(rows[isFirst],cols[isFirst])
+	v2=second(rows[~isFirst]-nFirst,cols[~isFirst])
+	out=empty(len(rows),dtype=result_type(v1,v2))
+	out[isFirst]=v1
+	out[~isFirst]=v2
+	return out
+    return value
+
 def MID(data):
     """Median Interpoint Difference:
-        MID=med|xi-xj|,i<j"""
+        MID=med|xi-xj|,i<=j
+    As in MIDExplicit, the n zero distances of each point to itself are included.
+    The interpoint differences of the sorted sample are not built, but the order statistics 
+    are selected from them directly in O(n log n) memory and time."""
+    y=sort(flatCompress(data))
+    n=y.shape[0]
+    if n<2:
+	if n==1:
+	    return 0.
+	else:
+	    return None
+    value,lengths=_pairwiseDifferences(y)
+    N=n*(n+1)//2
+    #####
+    # The median is the mean of the two middle distances when N is even.
+    r=(N+1)//2
+    if r<=n: d=[y[0]-y[0],]
+    else: d=[_selectSortedRows(value,lengths,r-n),]
+    if N%2==0:
+	if r<n: d.append(y[0]-y[0])
+	elif r==n: d.append(_selectSortedRows(value,lengths,1))
+	else: d.append(_nextOrderStatistic(value,lengths,r-n,d[0]))
+    return median(array(d,dtype=result_type(y.dtype,d[-1])))
+
+def MIDExplicit(data):
+    """Median Interpoint Difference:
+        MID=med|xi-xj|,i<=j
+    In this version the mathematical definition was directly translated
+    into code. This is highly inefficient (time and memory) and should only
+    be used for checks."""
     d=[]
     for n,x in enumerate(data.ravel()):
         for y in data.ravel()[n:]:
@@ -67,7 +233,9 @@ def MID(data):
 def Sn(data):
     """ Robust Scale measure:
     Sn = 1.1926 lowmed(i=1,n)( highmed(j=1,n)(|xi - xj|) )
-    Optimised Version
+    Optimised Version, identical to SnExplicit.
+    For each point of the sorted sample, the distances to the points below and above it 
+    are two sorted lists, so the highmed is found by a bisection of all the points at once.
     See:
     Rousseeuw, P. J. & Croux
     C. Alternatives to the Median Absolute Deviation 
@@ -77,104 +245,21 @@ def Sn(data):
     Time-efficient algorithms for two highly robust estimators of scale 
     Computational Statistics
     1992, 1 """
-    y=data.flatten()
-    if y.shape[0]<2:
-	if y.shape[0]==1:
+    y=sort(flatCompress(data))
+    n=y.shape[0]
+    if n<2:
+	if n==1:
 	    return 0.
 	else:
 	    return None
-    n=y.shape[0]
-    nlm=(n+1)//2 #low median index
-    y.sort()
-    a2=empty(y.shape)
-    a2[0]=y[n//2]-y[0]
-    for i,yy in izip(arange(1,nlm),y[1:nlm]):
-	nA=i
-	nB=n-i-1
-	diff=nB-nA
-	leftA=1
-	leftB=1
-	rightA=nB
-	rightB=nB
-	Amin=diff//2+1
-	Amax=diff//2+nA
-	while leftA<rightA:
-	    length=rightA-leftA+1
-	    even=1-length%2
-	    half=(length-1)//2
-	    tryA=leftA+half
-	    tryB=leftB+half
-	    if tryA<Amin:
-		rightB=tryB
-		leftA=tryA+even
-	    elif tryA>Amax:
-		rightA=tryA
-		leftB=tryB+even
-	    else:
-		medA=yy-y[i-1-tryA+Amin]
-		medB=y[tryB+i]-yy
-		if medA>=medB:
-		    rightA=tryA
-		    leftB=tryB+even
-		else:
-		    rightB=tryB
-		    leftA=tryA+even
-	if leftA>Amax:
-	    a2[i]=y[leftB+i]-yy
-	else:
-	    medA=yy-y[i-1-leftA+Amin]
-	    medB=y[leftB+i]-yy
-	    a2[i]=min(medA,medB)
-    for i,yy in izip(arange(nlm,n-1),y[nlm:n-1]):
-	nA=n-i-1
-	nB=i
-	diff=nB-nA
-	leftA=1
-	leftB=1
-	rightA=nB
-	rightB=nB
-	Amin=diff//2+1
-	Amax=diff//2+nA
-	while leftA<rightA:
-	    length=rightA-leftA+1
-	    even=1-length%2
-	    half=(length-1)//2
-	    tryA=leftA+half
-	    tryB=leftB+half
-	    if tryA<Amin:
-		rightB=tryB
-		leftA=tryA+even
-	    elif tryA>Amax:
-		rightA=tryA
-		leftB=tryB+even
-	    else:
-		medA=y[i+tryA-Amin+1]-yy
-		medB=yy-y[i-tryB]
-		if medA>=medB:
-		    rightA=tryA
-		    leftB=tryB+even
-		else:
-		    rightB=tryB
-		    leftA=tryA+even
-	if leftA>Amax:
-	    a2[i]=yy-y[i-leftB]
-	else:
-	    medA=y[i+1+leftA-Amin]-yy
-	    medB=yy-y[i-leftB]
-	    a2[i]=min(medA,medB)
-    a2[n-1]=y[n-1]-y[nlm-1]
-    if n<10:
-	if n==2: cn=.743
-	elif n==3: cn=1.851
-	elif n==4: cn=.954
-	elif n==5: cn=1.351
-	elif n==6: cn=.993
-	elif n==7: cn=1.198
-	elif n==8: cn=1.005
-	elif n==9: cn=1.131
-    elif n%2==1:cn=n/(n-.9)
-    else: cn=1.
-    return cn*1.1926*orderStatistic(a2,nlm,n)
+    i=arange(n)
+    below=lambda rows,cols: y[rows]-y[rows-1-cols]
+    above=lambda rows,cols: y[rows+1+cols]-y[rows]
+    #####
+    # The distance of each point to itself is the smallest, so the highmed, 
+    # the (n/2+1)th distance, is the (n/2)th distance to the other points.
+    a2=_mergedOrderStatistic(below,above,i,n-1-i,zeros(n,dtype=int)+n//2).astype(float)
+    return _snCorrection(n)*1.1926*orderStatistic(a2,(n+1)//2,n)
 
 def SnExplicit(data,c=1.1926):
    """ Robust Scale measure:
@@ -216,8 +301,34 @@ def SnExplicit(data,c=1.1926):
 	else: cn=1.
    return cn*c*orderStatistic(dists,(nsize+1)//2,nsize)
 
-def Sdist(s1,s2,distFun):
-   """Computes distance scale between to sets of samples based on Sn scale."""
+def Sdist(s1,s2,distFun=None):
+   """Computes distance scale between to sets of samples based on Sn scale:
+       Sdist=med(i)( med(j)( distFun(s1i,s2j) ) )
+   With the default distance, |s1i-s2j|, the distances of each s1i to the points of the 
+   sorted s2 below and above it are two sorted lists, so the inner medians are found 
+   by a bisection of all the s1i at once, in O((n+m) log m) time.
+   Any other distFun is called with each s1i and the whole of s2."""
+   s1=flatCompress(s1)
+   s2=flatCompress(s2)
+   if 0 in [s1.shape[0],s2.shape[0]]: return None
+   if distFun is not None:
+       dists1=empty(s1.shape)
+       for n,d1 in enumerate(s1):
+           dists1[n]=median(asarray(distFun(d1,s2),dtype=float))
+       return median(dists1)
+   s2=sort(s2)
+   m=s2.shape[0]
+   below,above,nBelow,nAbove=_absoluteDistances(s1,s2)
+   ranks=zeros(s1.shape[0],dtype=int)
+   lower=_mergedOrderStatistic(below,above,nBelow,nAbove,ranks+(m+1)//2)
+   upper=_mergedOrderStatistic(below,above,nBelow,nAbove,ranks+m//2+1)
+   return median(median(column_stack((lower,upper)).astype(float),axis=1))
+
+def SdistExplicit(s1,s2,distFun):
+   """Computes distance scale between to sets of samples based on Sn scale.
+   In this version the definition was directly translated
+   into code. This is highly inefficient and should only
+   be used for checks."""
    dists1=empty(s1.shape) 
    for n,d1 in enumerate(s1):
        dists2=empty(s2.shape) 
@@ -276,7 +387,10 @@ def Qn(data):
     Qn = c*dn*{|xi-xj|;i<j}_(k), i.e.
     the kth order statistic of the ( n over 2 ) interpoint distances.
     k=(n/2+1 over 2) 
-    Optimised Version.
+    Optimised Version, identical to QnExplicit.
+    The interpoint distances of the sorted sample are n-1 sorted rows, and the kth 
+    order statistic is selected from them with the weighted median of the row medians,
+    without building the distances.
     See:
     Rousseeuw, P. J. & Croux
     C. Alternatives to the Median Absolute Deviation 
@@ -286,84 +400,56 @@ def Qn(data):
     Time-efficient algorithms for two highly robust estimators of scale 
     Computational Statistics
     1992, 1"""
-    y=data.flatten()
-    if y.shape[0]<2:
-	if y.shape[0]==1:
+    y=sort(flatCompress(data))
+    n=y.shape[0]
+    if n<2:
+	if n==1:
 	    return 0.
 	else:
 	    return None
-    n=y.shape[0]
     h=n//2+1
     k=h*(h-1)//2
-    y.sort()
-    left=n+1 -arange(n)
-    right=arange(n)+1
-    jhelp=n*(n+1)//2
-    knew=k+jhelp
-    nL=jhelp
-    nR=n*n
-    found=False
-    P=empty(n,dtype=int)
-    Q=empty(n,dtype=int)
-    weight=empty(n,dtype=int)
-    work=empty(n)
-    while (nR-nL>n) and not found:
-	j=0
-	for i,l,r,yy in izip(arange(1,n),left[1:],right[1:],y[1:]):
-	    if l<=r:
-		w=r-l+1
-		jhelp=l+w//2
-		weight[j]=w
-		work[j]=yy-y[n-jhelp]
-		j+=1
-        trial=_whimed(work[:j],weight[:j])
-	j=0
-	for i,yy in izip(arange(n-1,-1,-1),y[::-1]):
-	    while j<n and yy-y[n-j-1]<trial:
-		j+=1
-	    P[i]=j
-	j=n+1
-	for i,yy in izip(arange(n),y):
-	    while yy-y[n-j+1]>trial:
-		j-=1
-	    Q[i]=j
-	sumP=P.sum()
-	sumQ=(Q-1).sum()
-	if knew<=sumP:
-	    right=P.copy()
-	    nR=sumP
-	else:
-	    if knew>sumQ:
-		left=Q.copy()
-		nL=sumQ
-	    else:
-		qn=trial
-		found=True
-    if not found:
-	j=0
-	for i,l,r,yy in izip(arange(1,n),left[1:],right[1:],y[1:]):
-	    if l<=r:
-		for jj in arange(l,r+1):
-		    work[j]=yy-y[n-jj]
-		    j+=1
-	qn=orderStatistic(work,knew-nL,j)
-    if n<10:
-	if n==2: dn=.399
-	elif n==3: dn=.994
-	elif n==4: dn=.512
-	elif n==5: dn=.844
-	elif n==6: dn=.611
-	elif n==7: dn=.857
-	elif n==8: dn=.669
-	elif n==9: dn=.872
-    else:
-	if n%2==1: dn=n/(n+1.4)
-	else: dn=n/(n+3.8)
-    return dn*2.2219*qn
+    value,lengths=_pairwiseDifferences(y)
+    qn=float(_selectSortedRows(value,lengths,k))
+    return _qnCorrection(n)*2.2219*qn
+
+def Qdist(s1,s2,distFun=None):
+   """Computes distance scale between to sets of samples based on Qn scale,
+   the first quartile of all the distances distFun(s1i,s2j).
+   With the default distance, |s1i-s2j|, the distances are not built, but the 
+   order statistics are selected from the sorted rows of distances 
+   of each s1i to the points of the sorted s2 below and above it.
+   Any other distFun is called with s1 and s2 as a column and a row."""
+   s1=flatCompress(s1)
+   s2=flatCompress(s2)
+   if 0 in [s1.shape[0],s2.shape[0]]: return None
+   if distFun is not None:
+       dists=asarray(distFun(s1[:,None],s2[None,:]),dtype=float).ravel()
+       return mquantiles(dists,[.25,])[0]
+   s2=sort(s2)
+   n=s1.shape[0]
+   N=n*s2.shape[0]
+   if N==1: return float(abs(s1[0]-s2[0]))
+   below,above,nBelow,nAbove=_absoluteDistances(s1,s2)
+   value=_stackRows(below,above,n)
+   lengths=concatenate((nBelow,nAbove))
+   #####
+   # The same interpolation as mquantiles, with the default alphap=betap=.4
+   p=array([.25,])
+   m=.4+p*(1.-.4-.4)
+   aleph=(N*p+m)
+   k=floor(aleph.clip(1,N-1)).astype(int)
+   gamma=(aleph-k).clip(0,1)
+   xk=_selectSortedRows(value,lengths,k[0])
+   x=array([xk,_nextOrderStatistic(value,lengths,k[0],xk)],dtype=float)
+   return ((1.-gamma)*x[[0]]+gamma*x[[1]])[0]
 
-def Qdist(s1,s2,distFun):
-   """Computes distance scale between to sets of samples based on Sn scale."""
-   dists=empty(s1.shape[0]*s2,shape[0])
+def QdistExplicit(s1,s2,distFun):
+   """Computes distance scale between to sets of samples based on Qn scale.
+   In this version the definition was directly translated
+   into code. This is highly inefficient and should only
+   be used for checks."""
+   dists=empty(s1.shape[0]*s2.shape[0])
    k=0
    for d1 in s1:
        for d2 in s2:
@@ -371,7 +457,6 @@ def Qdist(s1,s2,distFun):
            k+=1
    return mquantiles(dists,[.25,])[0]
  
-
 def MAD(data,c=1.4826):
    """Computes Median Absolute Deviation:
        MAD=c*med|xi-med(xi)|"""
@@ -400,44 +485,3 @@ def orderStatistic(data,nq,n):
     x=data.ravel()[:n]
     x.sort()
     return x[nq-1]
-
-def _whimed(a,iw):
-    nn=a.shape[0]
-    acand=empty(nn)
-    iwcand=empty(nn)
-    wtotal=iw.sum()
-    wrest=0
-    while True:
-      trial=orderStatistic(a,nn//2+1,nn)
-      wleft=0
-      wmid=0
-      wright=0
-      for i,aa,w in izip(arange(nn),a[:nn],iw[:nn]):
-	if aa<trial:
-	    wleft+=w
-	elif aa>trial:
-	    wright+=w
-	else:
-	    wmid+=w
-      if 2*wrest+2*wleft>wtotal:
-	kcand=0
-	for i,aa,w in izip(arange(nn),a[:nn],iw[:nn]):
-	    if aa<trial:
-		acand[kcand]=aa
-		iwcand[kcand]=w
-		kcand+=1
-	nn=kcand
-      elif 2*wrest+2*wleft+2*wmid>wtotal:
-	return trial
-      else:
-	kcand=0
-	for i,aa,w in izip(arange(nn),a[:nn],iw[:nn]):
-	    if (aa>trial):
-		    acand[kcand]=aa
-		    iwcand[kcand]=w
-		    kcand+=1
-	nn=kcand
-	wrest+=wleft+wmid
-      for i,aa,w in izip(arange(nn),acand[:nn],iwcand[:nn]):
-	a[i]=aa
-	iw[i]=w
@@ -32,7 +32,9 @@ from string import join
 from os.path  import exists,getmtime
 from os import mkdir, makedirs
 import os
+import re
 import math
+import hashlib
 from glob import glob
 from itertools import product,izip
 import numpy as np
@@ -195,13 +197,10 @@ def listFiles(a, want=100, listType = 'even' ,first = 30,last = 30):
 
 
 	
-def getDates(nc, coords):
+def loadTimeCoordinate(nc, coords):
 	"""
-	Loads the times from the netcdf.
+	Loads the time values, the units and the calendar from the netcdf.
 	"""
-	if type(nc) == type('filename'):
-		nc = dataset(nc,'r')
-
 	units = nc.variables[coords['t']].units
 	#if cal.lower() in ['auto','guess']:
 		
@@ -209,8 +208,17 @@ def getDates(nc, coords):
 	except:	
 		cal  = coords['cal']		
 		print "getDates was unable to load Calendar, using config calendar:",cal
+	return nc.variables[coords['t']][:], units, cal
 	
-	dtimes = num2date(nc.variables[coords['t']][:], units,calendar=cal)[:]
+def getDates(nc, coords):
+	"""
+	Loads the times from the netcdf.
+	"""
+	if type(nc) == type('filename'):
+		nc = dataset(nc,'r')
+
+	times, units, cal = loadTimeCoordinate(nc, coords)
+	dtimes = num2date(times, units,calendar=cal)[:]
 	return dtimes
 	
 def DOYarr(dates,debug=False):
@@ -229,14 +237,148 @@ def DOYarr(dates,debug=False):
 		ts.append(float(d.year) + float(tdelta.days)/365. + float(tdelta.seconds)/(365.*60.*60.))
 	if debug: print "DOYarr time array (timedelta method):",ts
 	return np.array(ts)
-		
+
+#####
+# The length of the CF time units in microseconds.
+timeUnitLengths = {	'microseconds':	1, 'microsecond': 1, 'us': 1,
+			'milliseconds':	1000, 'millisecond': 1000, 'ms': 1000,
+			'seconds':	1000000, 'second': 1000000, 'secs': 1000000, 'sec': 1000000, 's': 1000000,
+			'minutes':	60000000, 'minute': 60000000, 'mins': 60000000, 'min': 60000000,
+			'hours':	3600000000, 'hour': 3600000000, 'hrs': 3600000000, 'hr': 3600000000, 'h': 3600000000,
+			'days':		86400000000, 'day': 86400000000, 'd': 86400000000, }
+
+#####
+# The reference date of the CF time units: YYYY-MM-DD, with an optional hh:mm:ss time and a UTC time zone.
+timeUnitsRefDate = re.compile('^(-?\d+)-(\d{1,2})-(\d{1,2})(?:[ T](\d{1,2}):(\d{1,2})(?::(\d{1,2})(?:\.(\d{1,6}))?)?)?\s*(?:Z|UTC|[+-]0{1,2}(?::?00)?)?$')
+
+#####
+# The calendars with a fixed number of days in each year, and the length of their months.
+fixedCalendars = {	'360_day':	[30,]*12,
+			'365_day':	[31,28,31,30,31,30,31,31,30,31,30,31],
+			'noleap':	[31,28,31,30,31,30,31,31,30,31,30,31],
+			'366_day':	[31,29,31,30,31,30,31,31,30,31,30,31],
+			'all_leap':	[31,29,31,30,31,30,31,31,30,31,30,31], }
+
+def parseTimeUnits(units):
+	"""
+	Splits a CF time units string, ie "days since 1950-01-01 00:00:00", into the length of the unit in microseconds,
+	and the reference date as a list of integers: [year, month, day, hour, minute, second, microsecond].
+	Returns None if the units are not understood.
+	"""
+	try:	unit, ref = str(units).strip().split(' since ')
+	except:	return None
+	unit = unit.strip().lower()
+	if unit not in timeUnitLengths: return None
+	match = timeUnitsRefDate.match(ref.strip())
+	if match is None: return None
+	ref = [int(v) if v else 0 for v in match.groups()[:6]]
+	ref.append(int((match.groups()[6] or '').ljust(6,'0')))
+	return timeUnitLengths[unit], ref
+
+def decimalYears(times, units, calendar):
+	"""
+	:param times: The numerical values of the time coordinate.
+	:param units: The CF time units, ie "days since 1950-01-01 00:00:00".
+	:param calendar: The CF calendar, ie 360_day, 365_day, gregorian or proleptic_gregorian.
+
+	A vectorised version of DOYarr(num2date(times, units, calendar)), using integer arithmetic
+	instead of creating a datetime object for each time.
+	The times are converted into the same decimal years as DOYarr, including which of
+	the two methods in DOYarr applies to the datetimes that num2date returns for this calendar.
+
+	Returns None if the units or calendar are not supported, or if any time is masked,
+	in which case the times should be decoded by num2date and DOYarr.
+	"""
+	if np.ma.is_masked(times): return None
+	times = np.ma.getdata(times)
+	if times.ndim != 1 or not len(times) or times.dtype.kind not in 'iuf': return None
+	parsed = parseTimeUnits(units)
+	if parsed is None: return None
+	unitLength, (year, month, day, hour, minute, second, microsec) = parsed
+	calendar = str(calendar).lower()
+	dayLength = 86400000000
+
+	#####
+	# The times in microseconds since the reference date.
+	if times.dtype.kind in 'iu':	offsets = times.astype(np.int64) * unitLength
+	else:
+		if not np.isfinite(times).all(): return None
+		#####
+		# Scaled in float64, as num2date does, as a float32 product loses up to a minute.
+		offsets = np.around(times.astype(np.float64) * unitLength).astype(np.int64)
+	refTime = ((hour*60 + minute)*60 + second)*1000000 + microsec
+
+	if calendar in fixedCalendars:
+		monthLengths = fixedCalendars[calendar]
+		if not 1 <= month <= 12 or not 1 <= day <= monthLengths[month-1]: return None
+		yearLength = sum(monthLengths)
+		refDay = year*yearLength + sum(monthLengths[:month-1]) + day - 1
+		absolute = refDay*dayLength + refTime + offsets
+		days = absolute // dayLength
+		years = days // yearLength
+		dayOfYear = days % yearLength
+		secs = (absolute % dayLength) // 1000000
+
+	elif calendar in ['proleptic_gregorian', 'gregorian', 'standard']:
+		#####
+		# numpy datetime64 uses the proleptic gregorian calendar.
+		# The gregorian calendar is only the same after the switch from the julian calendar in 1582.
+		try:	ref = np.datetime64('%04d-%02d-%02d' % (year, month, day), 'D').astype('M8[us]')
+		except:	return None
+		if year < 1: return None
+		dates = ref + (offsets + refTime).astype('m8[us]')
+		if calendar != 'proleptic_gregorian' and (ref < np.datetime64('1582-10-15') or dates.min() < np.datetime64('1582-10-15')): return None
+		dayDates = dates.astype('M8[D]')
+		yearDates = dates.astype('M8[Y]')
+		years = yearDates.astype(np.int64) + 1970
+		dayOfYear = (dayDates - yearDates.astype('M8[D]')).astype(np.int64)
+		secs = (dates - dayDates).astype('m8[s]').astype(np.int64)
+		if years.min() < 1 or years.max() > 9999: return None
+	else: return None
+
+	#####
+	# num2date returns datetime objects that DOYarr converts with either the dayofyr method or the timedelta method.
+	try:	dayofyrMethod = hasattr(num2date(times[:1], units, calendar=calendar)[0], 'dayofyr')
+	except:	return None
+	if dayofyrMethod: return years.astype(np.float64) + (dayOfYear+1)/365.
+	return years.astype(np.float64) + dayOfYear.astype(np.float64)/365. + secs.astype(np.float64)/(365.*60.*60.)
+
+#####
+# The decimal year times of each file and time coordinate, see getTimes.
+decimalYearsCache = {}
+
+def timesCacheKey(nc, coords):
+	"""
+	The key of the times of this file in the decimalYearsCache, or None if the file can not be identified.
+	The key includes the size and modification time of the file, so that changed files are decoded again.
+	"""
+	if type(nc) == type('filename'):	fn = nc
+	else:
+		try:	fn = nc.filename
+		except:
+			try:	fn = nc.filepath()
+			except:	return None
+	try:	st = os.stat(fn)
+	except:	return None
+	return (os.path.abspath(fn), coords['t'], str(coords.get('cal','')), st.st_size, st.st_mtime)
+
 def getTimes(nc, coords):
 	"""
 	Loads the times as a string of floats from the netcdf.
+	The times are decoded by decimalYears where possible, and cached for each file and time coordinate.
 	"""
-	dtimes = getDates(nc, coords)	
-	ts = DOYarr(dtimes)
-	return ts
+	key = timesCacheKey(nc, coords)
+	if key is not None and key in decimalYearsCache: return decimalYearsCache[key].copy()
+
+	if type(nc) == type('filename'):
+		nc = dataset(nc,'r')
+	times, units, cal = loadTimeCoordinate(nc, coords)
+	ts = decimalYears(times, units, cal)
+	if ts is None:
+		dtimes = num2date(times, units,calendar=cal)[:]
+		ts = DOYarr(dtimes)
+	if key is not None: decimalYearsCache[key] = ts
+	return ts.copy()
 	
 	
 
@@ -465,6 +607,101 @@ def shouldIMakeFile(fin,fout,debug = True):
 	return False
 
 
+def _updateFingerprint_(md5, obj):
+	"""
+	Adds the contents of obj to the md5 hash. 
+	Dictionaries, lists and tuples are walked recursively, numerical arrays are hashed by value and mask.
+	"""
+	if isinstance(obj, dict):
+		md5.update('dict'+str(len(obj)))
+		for k in sorted(obj.keys()):
+			_updateFingerprint_(md5, k)
+			_updateFingerprint_(md5, obj[k])
+		return
+	if isinstance(obj, (list, tuple, np.ndarray)):
+		arr = None
+		if isinstance(obj, np.ndarray) or not any(o is np.ma.masked for o in obj):
+			try:	arr = np.ma.array(obj)
+			except:	pass
+		if arr is None or arr.dtype.kind not in 'biuf':
+			md5.update('list'+str(len(obj)))
+			for o in obj: _updateFingerprint_(md5, o)
+			return
+		obj = arr
+	if isinstance(obj, np.ndarray):
+		obj = np.ma.array(obj)
+		md5.update(str(obj.dtype)+str(obj.shape))
+		md5.update(np.ascontiguousarray(obj.filled(0)).tostring())
+		md5.update(np.ascontiguousarray(np.ma.getmaskarray(obj)).tostring())
+		return
+	md5.update(type(obj).__name__+repr(obj))
+
+
+def plotFingerprint(*args, **kwargs):
+	"""
+	:param args: The inputs of a figure: times, values, titles, etc.
+	:param kwargs: The style options of the figure.
+	
+	Returns an md5 hex digest of the contents of everything that goes into a figure.
+	If the fingerprint is the same as the last time that the figure was made, then the figure 
+	does not need to be made again, even if the shelve that it came from has changed.
+	"""
+	md5 = hashlib.md5()
+	_updateFingerprint_(md5, args)
+	_updateFingerprint_(md5, kwargs)
+	return md5.hexdigest()
+
+
+def plotFingerprintFilename(fout):
+	"""
+	The fingerprint of each figure is saved in a hidden file next to the figure.
+	"""
+	folder, fn = os.path.split(fout)
+	return os.path.join(folder, '.'+fn+'.md5')
+
+
+def shouldIMakePlot(fout, fingerprint, debug = True):
+	""" 
+	:param fout: The figure filename.
+	:param fingerprint: The plotFingerprint of the figure inputs.
+	
+	Answers the question should I Make this Plot?
+	returns: True: make the plot, or  False: Don't make the plot.
+	
+	If the figure doesn't exist, or it was made from different inputs, the answer is yes.
+	"""
+	if not exists(fout): 
+		if debug: print 'shouldIMakePlot: figure doesn\'t exist and should be made.'
+		return True
+	fpfn = plotFingerprintFilename(fout)
+	if not exists(fpfn):
+		if debug: print 'shouldIMakePlot: no fingerprint for ',fout,', you should make it.'	
+		return True
+	try:	oldfingerprint = open(fpfn,'r').read().strip()
+	except:	return True
+	if oldfingerprint != fingerprint:
+		if debug: print 'shouldIMakePlot: the inputs of ',fout,' have changed, you should make it.'	
+		return True
+	if debug: print 'shouldIMakePlot: the inputs of ',fout,' are unchanged, you shouldn\'t make it.'	
+	return False
+
+
+def savePlotFingerprint(fout, fingerprint):
+	"""
+	:param fout: The figure filename.
+	:param fingerprint: The plotFingerprint of the figure inputs.
+	
+	Saves the fingerprint once the figure has been made. 
+	"""
+	if not exists(fout): return
+	fpfn = plotFingerprintFilename(fout)
+	tmpfn = fpfn+'.tmp'
+	f = open(tmpfn,'w')
+	f.write(fingerprint)
+	f.close()
+	os.rename(tmpfn, fpfn)
+
+
 
 def getAxesAspectRatio(ax):
 	"""
@@ -1047,22 +1284,16 @@ def makeLatSafe(lat):
 def makeLonSafeArr(lon):
 	"""
 	Makes sure that the entire array is between -180 and 180.
+	The array is changed in place, in the same steps as makeLonSafe, but without looping over each value.
 	"""
-	
-	if lon.ndim == 3:
-	 for (l,ll,lll,) , lo in np.ndenumerate(lon):
-		lon[l,ll,lll] = makeLonSafe(lo)
-	 return lon	 	  
-	if lon.ndim == 2:
-	 for l,lon1 in enumerate(lon):
-	  for ll,lon2 in enumerate(lon1):
-	   lon[l,ll] = makeLonSafe(lon2)
-	 return lon
-	if lon.ndim == 1:
-	 for l,lon1 in enumerate(lon):
-	   lon[l] = makeLonSafe(lon1)
-	 return lon	 	 
-	assert False
+	if lon.ndim not in [1,2,3]: assert False
+	arr = np.ma.getdata(lon)
+	while True:
+		high = arr > 180.
+		low  = arr <= -180.
+		if not high.any() and not low.any(): return lon
+		arr[high] -= 360.
+		arr[low]  += 360.
 
 def sensibleLonBox(lons):
 	""" Takes a small list of longitude coordinates, and makes sure that they're all together.
@@ -40,18 +40,101 @@ from functions.stdfunctions import std_functions
 from bgcvaltools.tdicts import tdicts
     
     
+class configModel:
+  """
+  A read-only and picklable copy of a parsed config file.
+  
+  It has the same reading methods as the ConfigParser (sections, options, get, getint, getboolean, etc),
+  so it can be used anywhere that a ConfigParser was used.
+  The values are interpolated once, when the file is read.
+  """
+  def __init__(self, filename, Config):
+	sections = []
+	for section in Config.sections():
+		options = []
+		for option in Config.options(section):
+			try:	value = Config.get(section, option)
+			except:	value = Config.get(section, option, raw=True)
+			options.append((option, value))
+		sections.append((section, tuple(options)))
+		
+	self.__dict__['filename']	= filename
+	self.__dict__['__sections__']	= tuple(sections)
+	self.__dict__['__lookup__']	= {section:dict(options) for section, options in sections}
+
+  def __setattr__(self, name, value):
+	raise AttributeError("configModel:\tThe config is read only, can not set: "+str(name))
+
+  def __repr__(self): return "configModel("+str(self.filename)+")"
+  
+  def sections(self):
+	return [section for section, options in self.__sections__]
+
+  def has_section(self, section):
+	return section in self.__lookup__
+  	
+  def options(self, section):
+	if section not in self.__lookup__: raise ConfigParser.NoSectionError(section)
+	return [option for sec, options in self.__sections__ if sec == section for option, value in options]
+
+  def has_option(self, section, option):
+	return option.lower() in self.__lookup__.get(section, {})
+
+  def get(self, section, option, raw=False):
+	if section not in self.__lookup__: raise ConfigParser.NoSectionError(section)
+	try:	return self.__lookup__[section][option.lower()]
+	except KeyError: raise ConfigParser.NoOptionError(option, section)
+
+  def items(self, section):
+	if section not in self.__lookup__: raise ConfigParser.NoSectionError(section)
+	return list([options for sec, options in self.__sections__ if sec == section][0])
+		
+  def getint(self, section, option):
+	return int(self.get(section, option))
+
+  def getfloat(self, section, option):
+	return float(self.get(section, option))
+
+  def getboolean(self, section, option):
+	value = self.get(section, option)
+	if value.lower() not in ConfigParser.RawConfigParser._boolean_states:
+		raise ValueError('Not a boolean: %s' % value)
+	return ConfigParser.RawConfigParser._boolean_states[value.lower()]
+
+
+#####
+# The config files are only read once (or again if they change on disk), 
+# and the wildcard file paths are only globbed once per pattern.
+loadedConfigs = {}
+globCache = {}
+
 def checkConfig(Config,debug=False):
 	"""
-	If it's a string, it opens it as a ConfigParser.
+	If it's a string, it opens it as a read only configModel.
+	Each file is only read and parsed once.
 	"""
 	if type(Config) == type('string'):
-		if debug: print "Reading", Config
-		Config1 = ConfigParser.ConfigParser()
-		Config1.read(Config)
-		Config = Config1
+		key = os.path.abspath(Config)
+		try:	mtime = os.path.getmtime(key)
+		except:	mtime = None
+		if key not in loadedConfigs or loadedConfigs[key][0] != mtime:
+			if debug: print "Reading", Config
+			Config1 = ConfigParser.ConfigParser()
+			Config1.read(Config)
+			loadedConfigs[key] = (mtime, configModel(Config, Config1))
+		Config = loadedConfigs[key][1]
 	return Config
 
 
+def cachedGlob(pattern):
+	"""
+	A memoized glob, so that each file path pattern is only searched once, 
+	however many keys use it.
+	"""
+	if pattern not in globCache: globCache[pattern] = glob(pattern)
+	return globCache[pattern][:]
+
+
 def parseBooleanSection(Config,section='ActiveKeys'):
 	"""
 	This is for parsing a list of boolean swithces for the evaluation suite.
@@ -129,8 +212,8 @@ def parseFilepath(Config,section, option,expecting1=True,optional=True):
 	outputFiles = []
 	if len(filepath.split(' '))>1:
 		for fn in filepath.split(' '):
-			outputFiles.extend(glob(fn))
-	else:	outputFiles.extend(glob(filepath))
+			outputFiles.extend(cachedGlob(fn))
+	else:	outputFiles.extend(cachedGlob(filepath))
 
 	if len(filepath) >0 and len(outputFiles)==0:
 		print "parseFilepath:\tfilepath:",filepath, "\n\t\toutputFiles:",outputFiles
@@ -294,6 +377,12 @@ def parseBoolean(Config, section, option, default= True):
 	try:	return Config.getboolean(section, option)
 	except:	return default
 
+def parseInt(Config, section, option, default= 1):
+	"""
+	This tool parses an integer, but returns the defult, if an integer is not found. 
+	"""
+	try:	return Config.getint(section, option)
+	except:	return default
 
 
 
@@ -308,7 +397,7 @@ class GlobalSectionParser:
 		print "------------------------------------------------------------------"
 		print "GlobalKeyParser:\tBeginning to call GlobalSectionParser for ", fn
 	self.__cp__ = checkConfig(fn)
-	self.__fn__ = fn
+	self.__fn__ = getattr(self.__cp__, 'filename', fn)
 
 	self.ActiveKeys 	= linkActiveKeys(self.__cp__)
 	
@@ -332,6 +421,8 @@ class GlobalSectionParser:
 	self.makeComp 		= parseBoolean(self.__cp__, defaultSection, 'makeComp',		default=True)
 	self.clean 		= parseBoolean(self.__cp__, defaultSection, 'clean',		default=False)
 	self.makeCSV 		= parseBoolean(self.__cp__, defaultSection, 'makeCSV',		default=True)	
+	self.nproc 		= parseInt(self.__cp__, defaultSection, 'nproc',		default=1)
+	self.timeChunk 		= parseInt(self.__cp__, defaultSection, 'timeChunk',		default=0)
 	
 	self.basedir_model	= self.parseFilepath( 'basedir_model', 	expecting1=True, optional=True,)
 	self.basedir_obs	= self.parseFilepath( 'basedir_obs', 	expecting1=True, optional=True,)	
@@ -345,9 +436,9 @@ class GlobalSectionParser:
 	self.modelgrid		= parseOptionOrDefault(self.__cp__, defaultSection, 'modelgrid')	
 	self.gridFile 		= self.parseFilepath('gridFile',  	expecting1=True, optional=True)
 					
-	self.AnalysisKeyParser = {}	
-	for (m,j,y,s,k) in product(self.models,self.jobIDs, self.years, self.scenarios,self.ActiveKeys):
-		self.AnalysisKeyParser[(m,j,y,s,k)] = AnalysisKeyParser(fn,model = m,	jobID = j, year  = y, scenario=s, key = k,)
+	#####
+	# The AnalysisKeyParsers are only created when they are first needed.
+	self.AnalysisKeyParser = lazyAnalysisKeyParsers(self.__cp__, product(self.models,self.jobIDs, self.years, self.scenarios,self.ActiveKeys))
 
 	if debug:self.__print__()
 				
@@ -362,6 +453,8 @@ class GlobalSectionParser:
 	print "scenarios:			", self.scenarios	
 	print "makeReport:			", self.makeReport
 	print "makeComp:			", self.makeComp	
+	print "nproc:				", self.nproc
+	print "timeChunk:			", self.timeChunk
 	print "reportdir:			", self.reportdir							
 	print "images_comp:			", self.images_comp							
 	print "basedir_model:			", self.basedir_model 
@@ -424,8 +517,8 @@ class GlobalSectionParser:
 	# Looking for files which have to exist already
 	if len(filepath.split(' '))>1:
 		for fn in filepath.split(' '):
-			outputFiles.extend(glob(fn))
-	else:	outputFiles.extend(glob(filepath))
+			outputFiles.extend(cachedGlob(fn))
+	else:	outputFiles.extend(cachedGlob(filepath))
 
 	if len(filepath) >0 and len(outputFiles)==0:
 		print "GlobalSectionParser:\tparseFilepath:\tfilepath:",filepath, "\n\t\toutputFiles:",outputFiles
@@ -447,6 +540,40 @@ class GlobalSectionParser:
   	
 
   
+
+class lazyAnalysisKeyParsers(dict):
+  """
+  A dictionary of (model, jobID, year, scenario, key) : AnalysisKeyParser,
+  where each AnalysisKeyParser is only created when it is first used.
+  """
+  def __init__(self, config, keys):
+	dict.__init__(self, [(key, None) for key in keys])
+	self.__config__ = config
+	
+  def __getitem__(self, key):
+	akp = dict.__getitem__(self, key)
+	if akp is None:
+		(m,j,y,s,k) = key
+		akp = AnalysisKeyParser(self.__config__, model = m, jobID = j, year  = y, scenario=s, key = k,)
+		dict.__setitem__(self, key, akp)
+	return akp
+	
+  def get(self, key, default = None):
+	if key not in self: return default
+	return self[key]
+	
+  def values(self): 	return [self[key] for key in self.keys()]
+  def items(self): 	return [(key, self[key]) for key in self.keys()]
+
+
+def loadGlobalSectionParser(config, debug=True):
+	"""
+	Returns a GlobalSectionParser for this config, 
+	so that the downstream stages can be given either a config filename or the parsed config.
+	"""
+	if isinstance(config, GlobalSectionParser): return config
+	return GlobalSectionParser(config, debug=debug)
+
   	
 class AnalysisKeyParser:
   def __init__(self,fn,
@@ -456,11 +583,11 @@ class AnalysisKeyParser:
   		scenario='',
   		key   = '',
   		debug=True):
-	self.__fn__ = fn
 	if debug: 
 		print "------------------------------------------------------------------"
 		print "AnalysisKeyParser:\tBeginning to call AnalysisKeyParser for ", key
 	self.__cp__ = checkConfig(fn)  
+	self.__fn__ = getattr(self.__cp__, 'filename', fn)
 
 	self.section 	= key
 	self.model 	= model
@@ -483,6 +610,9 @@ class AnalysisKeyParser:
 	self.makeP2P 		= parseOptionOrDefault(self.__cp__, self.section, 'makeP2P',		parsetype='bool')	
 	self.makeTS	 	= parseOptionOrDefault(self.__cp__, self.section, 'makeTS',		parsetype='bool')
 	self.makeCSV	 	= parseOptionOrDefault(self.__cp__, self.section, 'makeCSV',		parsetype='bool')
+	self.nproc	 	= parseInt(self.__cp__, self.section, 'nproc',		default=parseInt(self.__cp__, 'Global', 'nproc', default=1))
+	self.timeChunk	 	= parseInt(self.__cp__, self.section, 'timeChunk',	default=parseInt(self.__cp__, 'Global', 'timeChunk', default=0))
+	self.pointCacheDir	= parseOptionOrDefault(self.__cp__, self.section, 'pointCacheDir')
 
 		
 	self.datasource		= parseOptionOrDefault(self.__cp__, self.section, 'datasource')
@@ -577,8 +707,8 @@ class AnalysisKeyParser:
 	# Looking for files which have to exist already
 	if len(filepath.split(' '))>1:
 		for fn in filepath.split(' '):
-			outputFiles.extend(glob(fn))
-	else:	outputFiles.extend(glob(filepath))
+			outputFiles.extend(cachedGlob(fn))
+	else:	outputFiles.extend(cachedGlob(filepath))
 
 	if len(filepath) >0 and len(outputFiles)==0:
 		print "parseFilepath:\tfilepath:",filepath, "\n\t\toutputFiles:",outputFiles
@@ -640,6 +770,9 @@ class AnalysisKeyParser:
 	print "makeP2P:		", self.makeP2P
 	print "makeTS:		", self.makeTS
 	print "makeCSV:		", self.makeCSV
+	print "nproc:		", self.nproc
+	print "timeChunk:	", self.timeChunk
+	print "pointCacheDir:	", self.pointCacheDir
 								
 	print "model Files (ts):", self.modelFiles_ts
 	print "model Files (p2p):", self.modelFile_p2p
@@ -44,6 +44,7 @@ import numpy as np
 # local imports
 from bgcvaltools import bgcvalpython as bvp 
 from bgcvaltools.alwaysInclude import depthNames
+from bgcvaltools.transectPath import transectLines, loadTransectPath
 from functions.stdfunctions import extractData
 
 	
@@ -79,6 +80,29 @@ def determineZ(nc,coords,details):
 		if dim in depthNames: return d
 	raise AssertionError("determineZ:\tERROR:\tNot able to find the depth in the dimensions:"+str(dims)+"\n\t\tdepthNames:"+str(depthNames)+"\n\t\tPlease add your depth to alwaysInclude.py:depthsNames")
 
+def layerDepthIndex(nc,coords,details,layer):
+	"""
+	Returns the index of the single depth level that extractLayer would use for this layer,
+	(a numbered layer, 'Surface' or a depth like '100m'), or None if the layer needs more than one level.
+	This allows the data to be read one depth level at a time, (see functions.stdfunctions.extractDataChunks).
+	"""
+	try:	zdim = determineZ(nc,coords,details)
+	except:	return None
+	if coords['z'] not in nc.variables.keys(): return None
+	depths = nc.variables[coords['z']][:]
+	if depths.ndim != 1 or len(depths) < 2: return None
+	if len(nc.dimensions.keys()) == 1: return None 
+
+	if type(layer) in [type(0),np.int64,np.int,]:
+		if 0 <= layer < len(depths): return int(layer)
+		return None
+		
+	if type(layer) != type('string'): return None
+	if layer == 'Surface': 	return bvp.getORCAdepth(0.,depths,debug=False)
+	try:	customLayerValue = float(layer.replace('m', ''))
+	except: return None
+	return bvp.getORCAdepth(customLayerValue,depths,debug=False)
+
 def drawLine(lat1,lat2,lon1,lon2,numpoints=1000):
 	"""
 	draw a list of points in a coordinately straight line between two points.
@@ -204,43 +228,10 @@ def extractLayer(nc,coords,details,layer,data = '',maskWanted=False):
 		print "extractLayer:\tSpecific depth field requested",details['name'], layer,[k],nc.variables[coords['z']][k], data.shape
 		return ApplyDepthSlice(nc,coords,details,k,data,maskWanted=maskWanted)		
 
-	####
-	# extract data along a specific longitude (ie North South transect)
-	if customLayerType == 'lon': 
-		transectcoords	= drawLine(-89.,89.99,customLayerValue,customLayerValue,)
-	####
-	# extract data along a specific latitude (ie East West transect)
-	if customLayerType == 'lat':	
-		transectcoords	= drawLine(customLayerValue,customLayerValue,-360.,360.,)			
-	####
-	#Some special transects.
-	if layer == 'ArcTransect':
-		lon = 0.
-		minlat = 50.
-		maxlat = 90.
-		transectcoords	= drawLine(minlat,maxlat,lon,lon,numpoints=200)
-
-		lon = -165.
-		minlat = 60.
-		maxlat = 90.
-		transectcoords.extend(drawLine(minlat,maxlat,lon,lon,numpoints=200))
-		
-	if layer == 'CanRusTransect':
-		lon = 83.5
-		minlat = 65.
-		maxlat = 90.
-		transectcoords = drawLine(minlat,maxlat,lon,lon,numpoints=200)
-
-		lon = -96.
-		minlat = 60.
-		maxlat = 90.
-		transectcoords.extend(drawLine(minlat,maxlat,lon,lon,numpoints=200))
-	
-	if layer == 'AntTransect':
-		lon = 0.
-		minlat = -89.9
-		maxlat = -40.
-		transectcoords = drawLine(minlat,maxlat,lon,lon,)
+	#####
+	# Transects, along a specific longitude or latitude, or one of the special transects.
+	if transectLines(layer) is None:
+		raise NameError('extractLayer:\tERROR:\tUnable to define the transect coordinates.\t layer:'+str(layer))
 		
 	lats = nc.variables[coords['lat']][:]
 	lons = nc.variables[coords['lon']][:]
@@ -249,16 +240,15 @@ def extractLayer(nc,coords,details,layer,data = '',maskWanted=False):
 	else:	lon2d,lat2d = lons,lats
 
 	mmask = np.ones_like(data)
+	
+	#####
+	# The ordered grid cells along the transect are only calculated once per grid, (see transectPath.py).
+	# nc is the model or data file, not a grid file, so the nearest index is made from lat2d and lon2d, 
+	# rather than saved next to the file.
+	path = loadTransectPath(layer, lat2d, lon2d, gridFile = '', lat = coords['lat'], lon = coords['lon'])
+	print 'extractLayer:\tlayer:',layer, len(path), 'grid cells'
 	mask2d = np.ones_like(lon2d)	
-	try : 	transectcoords
-	except:	raise NameError('extractLayer:\tERROR:\tUnable to define the transect coordinates.\t layer:'+str(layer))
-
-	counts = len(transectcoords)	
-	print 'layer',layer
-	for i, (lat,lon) in enumerate(transectcoords):
-		print i,'/',counts,'\t',
-		la,lo = bvp.getOrcaIndexCC(lat, lon, lat2d, lon2d, debug=True,)
-		mask2d[la,lo] = 0	
+	mask2d[path.j, path.i] = 0
 
 
 	if mmask.ndim == 3:
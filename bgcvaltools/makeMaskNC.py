@@ -35,7 +35,7 @@ from bgcvaltools import bgcvalpython as bvp
 import numpy as np
 from bgcvaltools.changeNC import changeNC, AutoVivification
 #import paths
-from regions.makeMask import makeMask,loadMaskMakers
+from regions.makeMask import makeMask,loadMaskMakers,isSpatialMask
 from bgcvaltools.dataset import dataset
 
 
@@ -43,11 +43,50 @@ from bgcvaltools.dataset import dataset
 	this code is needed for profileAnalysis.py
 """
 
-def makeMaskNC(outFile, regions, grid,coords, gridfn=''):
-
-	#if grid in ['eORCA1',]:
-	#	orcaGridfn 	= '/data/euryale7/scratch/ledm/UKESM/MEDUSA/mesh_mask_eORCA1_wrk.nc'	
-	#	orcaGridfn	= paths.orcaGridfn
+def loadExistingMasks(outFile):
+	"""
+	:param outFile: The path to a mask netcdf made by makeMaskNC.
+	
+	Returns a dictionary of all the region masks in this file, (the variables with the long_name: "region mask"),
+	so that they do not need to be recalculated, and so that they are kept when the file is rewritten.
+	"""
+	existing = {}
+	if not os.path.exists(outFile): return existing
+	try:	nc = dataset(outFile,'r')
+	except:
+		print "makeMaskNC:\tloadExistingMasks:\tUnable to open", outFile
+		return existing
+	for r in nc.variables.keys():
+		if getattr(nc.variables[r], 'long_name', '') != r+' mask': continue
+		existing[r] = np.array(nc.variables[r][:])
+	nc.close()
+	return existing
+
+
+def makeMaskNC(outFile, regions, grid,coords, gridfn='',plotting=True):
+	"""
+	:param outFile: The path to the output mask netcdf.
+	:param regions: A list of region names, from regions/makeMask.py
+	:param grid: The name of the model grid.
+	:param coords: The model coordinates dictionary.
+	:param gridfn: The path to the mesh file, with the tmask.
+	
+	Makes a mask for each region on the model tmask grid and saves them all 
+	in one compressed netcdf. 
+	The region functions are evaluated once on the arrays of all ocean points 
+	(or only on the surface columns, for masks that only depend on latitude and longitude), 
+	and the result is scattered back into the 3D grid with boolean indexing.
+	Regions that are already in the outFile are reused and are not recalculated, 
+	and the other regions in the outFile are kept.
+	"""
+	#####
+	# Reuse the masks that already exist.
+	existing = loadExistingMasks(outFile)
+	newregions = [r for r in regions if r not in existing.keys()]
+	if len(newregions) == 0:
+		print "makeMaskNC:\tAll regions are already in", outFile
+		return
+		
 	#####
 	# load mask and coordinates.
 	ncmesh = dataset(gridfn,)#'r')
@@ -55,8 +94,6 @@ def makeMaskNC(outFile, regions, grid,coords, gridfn=''):
 	maskdims = ncmesh.variables['tmask'].dimensions
 	lats 	 = ncmesh.variables[coords['lat']][:]
 	lons 	 = ncmesh.variables[coords['lon']][:]
-	depths 	 = ncmesh.variables[coords['z']][:]
-	floattype = ncmesh.variables[coords['lat']][:].dtype
 	inttype = np.int16
 	ncmesh.close()
 	
@@ -66,97 +103,71 @@ def makeMaskNC(outFile, regions, grid,coords, gridfn=''):
 	elif landmask.ndim ==3:	masked_value  	= landmask[0,0,0]
 	elif landmask.ndim ==2:	masked_value  	= landmask[0,0]
 	else:	raise AssertionError("land mask has strange dimensions:"+str( landmask.ndim))
-								
+
 	landmask = np.ma.masked_where(landmask==masked_value,landmask)
+	if landmask.ndim ==4: landmask = landmask[0]
+	maskdims = maskdims[-landmask.ndim:]
 	
 	#####
-	# Create Temporary Output Arrays.
-	arr 	= []
-	arr_lat = []
-	arr_lon = []
-	arr_t 	= []  	  		
-	arr_z 	= []  
-	arr_y 	= []  
-	arr_x 	= []  
-
-	######
-	# Make 1D arrays of coordinates
-	print 'Make 1D arrays of coordinates from ', landmask.shape, 'landmask'
-	print 'landmask', landmask.min(), landmask.mean(),landmask.max()
-	for index,v in bvp.maenumerate(landmask):
-		if v == masked_value:	continue	
-		if np.isnan(v): 	continue
-		if np.isinf(v): 	continue		
-		
-		if len(index) == 3: (z,y,x) 	= index 
-		if len(index) == 2: (y,x) 	= index 		
-		t = 0
-
-		if lats.ndim ==2:
-			la = lats[y,x]
-			lo = lons[y,x]
-		if lats.ndim ==1:
-			la = lats[y]
-			lo = lons[x]
-
-		arr.append(v)
-		arr_t.append(t)
-		arr_z.append(z)
-		arr_y.append(y)
-		arr_x.append(x)	
-		arr_lat.append(la)
-		arr_lon.append(lo)
-
-	arr_t 	= np.array(arr_t)
-	arr_z	= np.array(arr_z)
-	arr_lat	= np.array(arr_lat)
-	arr_lon = np.array(arr_lon)
-	arr 	= np.array(arr)
-	ones    = np.ones_like(arr)
+	# The ocean points: unmasked, finite values in the tmask.
+	landdata = np.ma.getdata(landmask)
+	ocean = ~np.ma.getmaskarray(landmask) * np.isfinite(landdata)
 	
-	######
-	# Calculate 1D mask
-	oneDmasks = {}	
-	regions, maskingfunctions = loadMaskMakers(regions = regions)
-	for r in regions:
-		print 'Calculate 1D mask',r, len(arr)
-		mask = makeMask(
-				maskingfunctions,
-				'mask name', 
-				r, 
-  				arr_t,
-  				arr_z,
-  				arr_lat,
-  				arr_lon,
-  				arr)
-
-  		oneDmasks[r] = np.ma.masked_where( mask, ones )
+	#####
+	# Broadcast the coordinates onto the 2D horizontal grid and the 3D mask grid.
+	shape2d = landmask.shape[-2:]
+	lats = np.ma.getdata(lats).squeeze()
+	lons = np.ma.getdata(lons).squeeze()
+	if lats.ndim ==1:
+		lats, lons = np.broadcast_to(lats[:,None],shape2d), np.broadcast_to(lons[None,:],shape2d)
+	if landmask.ndim ==3:
+		levels = np.broadcast_to(np.arange(landmask.shape[0])[:,None,None], landmask.shape)
+		surface = ocean.any(axis=0)
+	else:	
+		levels = np.zeros(landmask.shape,dtype=int)
+		surface = ocean
+	
+	print 'makeMaskNC:\tMaking',len(newregions),'new masks from', landmask.shape, 'landmask, with', ocean.sum(),'ocean points'
+	
+	#####
+	# One dimensional arrays of the ocean points.
+	arr_lat = np.broadcast_to(lats, landmask.shape)[ocean]
+	arr_lon = np.broadcast_to(lons, landmask.shape)[ocean]
+	arr_z	= levels[ocean]
+	arr 	= landdata[ocean]
+	arr_t 	= np.zeros_like(arr_z)
+	
+	#####
+	# One dimensional arrays of the ocean surface columns, for spatial masks.
+	surf_lat = lats[surface]
+	surf_lon = lons[surface]
+	surf_arr = np.ones(surf_lat.shape)
+	surf_zeros = np.zeros(surf_lat.shape, dtype=int)
 	
-	for r in oneDmasks.keys():
-		print r, oneDmasks[r].mean(), oneDmasks[r].min(),oneDmasks[r].max(), 'sum:',np.sum(oneDmasks[r]), '%cover',np.sum(oneDmasks[r])/float(len(oneDmasks[r]))
-		
 	######
-	# Convert 1D mask to 3D
+	# Calculate the 3D masks.
 	threeDmasks={}
-	for r in regions:
-		print 'Convert 1D mask to 3D',r, len(oneDmasks[r]), sum(oneDmasks[r])
-		mask = np.zeros_like(np.array(landmask),dtype=inttype)
-		for i,m in enumerate(oneDmasks[r]):
-			#print r, i, m, arr_z[i],arr_y[i],arr_x[i]
-			if m == 0: continue
-			if np.ma.is_masked(m):continue
-			if   landmask.ndim ==3:	mask[arr_z[i],arr_y[i],arr_x[i]] = 1
-			elif landmask.ndim ==2:	mask[arr_y[i],arr_x[i]] 	 = 1		
-			else:	assert 0
-		threeDmasks[r] = mask
+	newregions, maskingfunctions = loadMaskMakers(regions = newregions)
+	for r in newregions:
+		mask = np.zeros(landmask.shape,dtype=inttype)
+		if isSpatialMask(maskingfunctions[r]):
+			m = makeMask(maskingfunctions, 'mask name', r, surf_zeros, surf_zeros, surf_lat, surf_lon, surf_arr)
+			inregion = np.zeros(shape2d,dtype=bool)
+			inregion[surface] = ~(np.zeros(surf_arr.shape,dtype=bool) + m)
+			mask[:] = inregion * ocean
+		else:
+			m = makeMask(maskingfunctions, 'mask name', r, arr_t, arr_z, arr_lat, arr_lon, arr)
+			mask[ocean] = ~(np.zeros(arr.shape,dtype=bool) + m)
+		
+		print 'makeMaskNC:\t',r, 'sum:',mask.sum(), '%cover',mask.sum()/float(ocean.sum())
 		if mask.sum() == 0: 
 			raise AssertionError("Mask is 100%"+r)
-			
-	plotting = 1
+		threeDmasks[r] = mask
+	
 	if plotting:
 		from matplotlib import pyplot
-		for r in regions:
-			pyplot.pcolormesh(threeDmasks[r].sum(0),cmap='jet')
+		for r in newregions:
+			pyplot.pcolormesh(threeDmasks[r].reshape((-1,)+shape2d).sum(0),cmap='jet')
 			pyplot.colorbar()
 			pyplot.title(r + ' '+ os.path.basename(gridfn))
 			filename = bvp.folder('images/makeMaskNC/')+os.path.basename(gridfn).replace('.nc', '') + '_'+r+'.png'
@@ -166,7 +177,7 @@ def makeMaskNC(outFile, regions, grid,coords, gridfn=''):
 			except: pass
 			pyplot.close()
 		     	
-		pyplot.pcolormesh(landmask.sum(0),cmap='jet')
+		pyplot.pcolormesh(landmask.reshape((-1,)+shape2d).sum(0),cmap='jet')
 		pyplot.colorbar()
 		pyplot.title('landmask '+ os.path.basename(gridfn))
 		filename = bvp.folder('images/makeMaskNC/')+os.path.basename(gridfn).replace('.nc', '') + '_landmask.png'
@@ -176,21 +187,28 @@ def makeMaskNC(outFile, regions, grid,coords, gridfn=''):
 		except: pass
 		pyplot.close()		
 	
+	#####
+	# Write the existing and the new masks in one pass.
+	threeDmasks.update(existing)
 	av = AutoVivification()
-	for r in regions:
+	for r in threeDmasks.keys():
 		av['newVar'][r]['name']		= r
 		av['newVar'][r]['long_name']	= r+ ' mask'
 		av['newVar'][r]['units']	= ''
 		av['newVar'][r]['newDims']	= maskdims
 		av['newVar'][r]['dtype']	= inttype
-		av['newVar'][r]['newData']	= threeDmasks[r][:]#.mask	
+		av['newVar'][r]['newData']	= threeDmasks[r].reshape(landmask.shape)
 
 	removes = [u'e1f', u'e1t', u'e1u', u'e1v', u'e2f', u'e2t', u'e2u', u'e2v', u'ff', u'fmask', u'fmaskutil', u'gdepu', u'gdepv', u'glamf', u'glamt', u'glamu', u'glamv', u'gphif', u'gphit', u'gphiu', u'gphiv', u'isfdraft',  u'misf',   u'tmaskutil',u'umaskutil',  u'vmaskutil', u'e3t', u'e3u', u'e3v', u'e3w', u'e3t_0', u'e3w_0', u'gdept,', u'gdepw', u'gdept_0', u'gdepw_0']
 	for rem in removes:
 		av[rem]['name']='False'
 	print "makeMaskNC:\tmaking new mask file", outFile
 	
-	c = changeNC(gridfn, outFile, av)
+	#####
+	# Write to a temporary file, as the outFile may be open in the existing masks.
+	tmpFile = outFile+'.tmp'
+	c = changeNC(gridfn, tmpFile, av)
+	os.rename(tmpFile, outFile)
 
 	
 	
@@ -35,6 +35,9 @@ from re import findall
 from bgcvaltools import bgcvalpython as bvp 
 from bgcvaltools.mergeNC import mergeNC
 
+try:	from multiprocessing import Pool, current_process
+except:	Pool = None
+
 
 def getYearFromFile(fn):
 	""" 
@@ -111,13 +114,73 @@ def getAnnualFilename(files, outfolder,year):
 	return 	filenameOut	
 
 
-def mergeMonthlyFiles(files,outfolder='',cal='360_day',timeAverage=False,expectedNumberOfFiles=12):
+def mergeYearWorker(job):
+	"""
+	Merges the files of one year into one file.
+	The file is written to a temporary filename and moved into place when it is complete,
+	so that an interupted run does not leave a partial file that looks up to date.
+	
+	Returns filenameOut, or None if the merged file was not created.
+	"""
+	yearFiles, filenameOut, cal, timeAverage = job
+	tmpfn = filenameOut+'.tmp'
+	
+	#####
+	# A temporary file from an interupted run is not complete, so it is removed first.
+	if os.path.exists(tmpfn): os.remove(tmpfn)
+	try:
+		mergeNC( yearFiles, tmpfn, [], timeAverage=timeAverage,debug=True,calendar=cal)
+		failed = not os.path.exists(tmpfn)
+	except Exception as e:
+		print "mergeMonthlyFiles:\tmergeYearWorker:\tERROR:\tmergeNC failed:", type(e).__name__, e
+		failed = True
+		
+	if failed:
+		if os.path.exists(tmpfn): os.remove(tmpfn)
+		try:	yr = getYearFromFile(yearFiles[0])
+		except:	yr = '?'
+		print "mergeMonthlyFiles:\tmergeYearWorker:\tERROR:\tUnable to merge year", yr, ",", len(yearFiles), "files into", filenameOut
+		return None
+	os.rename(tmpfn, filenameOut)
+	return filenameOut
+
+
+def mergeYears(jobs, nproc = 1):
+	"""
+	:param jobs: A list of (yearFiles, filenameOut, cal, timeAverage) tuples.
+	:param nproc: The number of processes. The years are independent, so they can be merged in parallel.
+
+	Runs mergeYearWorker on each job. 
+	With nproc <= 1, if multiprocessing is not available, or inside a daemonic worker process,
+	the years are merged serially.
+	
+	Returns the list of output files that could not be made.
+	"""
+	nproc = min(nproc, len(jobs))
+	if Pool is None or current_process().daemon: nproc = 1
+	if nproc > 1:
+		print "mergeMonthlyFiles:\tmergeYears:\tmerging", len(jobs), "years with", nproc, "processes."
+		pool = Pool(processes = nproc)
+		results = pool.map(mergeYearWorker, jobs)
+		pool.close()
+		pool.join()
+	else:
+		results = [mergeYearWorker(job) for job in jobs]
+		
+	failed = [job[1] for job,result in zip(jobs,results) if result is None]
+	for filenameOut in failed:
+		print "mergeMonthlyFiles:\tmergeYears:\tWARNING:\tFailed to make:", filenameOut
+	return failed
+
+
+def mergeMonthlyFiles(files,outfolder='',cal='360_day',timeAverage=False,expectedNumberOfFiles=12,nproc=1):
 	#####
 	# This assuemd that the files have already been split up using the moo filter tool
 	# done in the the bgcvalTools/downloadFromMass.py
 	
 	filesOut=[]
 	years = {}
+	jobs = []
 
 	#####
 	# Load file
@@ -137,18 +200,20 @@ def mergeMonthlyFiles(files,outfolder='',cal='360_day',timeAverage=False,expecte
 		filenameOut = getAnnualFilename(yearFiles, outfolder,yr)
 		
 		if  bvp.shouldIMakeFile(yearFiles,filenameOut): 
-			m = mergeNC( years[yr], filenameOut, [], timeAverage=timeAverage,debug=True,calendar=cal)
+			jobs.append((years[yr], filenameOut, cal, timeAverage))
 		
 		filesOut.append(filenameOut)
-	return filesOut
+	failed = mergeYears(jobs, nproc)
+	return [fn for fn in filesOut if fn not in failed]
 
 	
-def meanDJF(files,outfolder='',cal='360_day',timeAverage=False,):
+def meanDJF(files,outfolder='',cal='360_day',timeAverage=False,nproc=1):
 	#####
 	# This assuemd that the files have already been split up using the moo filter tool
 	# done in the the bgcvalTools/downloadFromMass.py
 	filesOut=[]
 	years = {}
+	jobs = []
 
 	#####
 	# Load file
@@ -173,10 +238,11 @@ def meanDJF(files,outfolder='',cal='360_day',timeAverage=False,):
 
 		filenameOut = getAnnualFilename(yearFiles, outfolder,yr)
 		if  bvp.shouldIMakeFile(yearFiles,filenameOut): 
-			m = mergeNC( years[yr], filenameOut, [], timeAverage=timeAverage,debug=True,calendar=cal)
+			jobs.append((years[yr], filenameOut, cal, timeAverage))
 		
 		filesOut.append(filenameOut)
-	return filesOut
+	failed = mergeYears(jobs, nproc)
+	return [fn for fn in filesOut if fn not in failed]
 
 	
 
@@ -31,7 +31,7 @@ from datetime import date
 from getpass import getuser
 from os.path import exists
 from numpy.ma import array,masked_all
-from numpy import  append,mean,int32,int16
+from numpy import  mean,int32,int16
 import numpy as np
 from glob import glob 
 from alwaysInclude import alwaysInclude as alwaysIncludList, timeNames
@@ -195,11 +195,21 @@ class mergeNC:
 		except:nco.variables[var][:] = nci.variables[var][:]
 	nci.close()
 	
+	#####
+	# The input files are streamed into the output file, one at a time, so that the memory footprint
+	# does not grow with the number of files:
+	#   Without time averaging, each slab is written straight into the output variable, at the end of its record.
+	#   With time averaging, a running sum and count of the unmasked values are kept for each variable.
+	# The time values are small, so they are still collected in a.
 	a={}
 	for t in tvars:	a[t] = []
 	for var in save:
 		if var in alwaysInclude: continue
 		a[var]=[]
+	dataVars = [var for var in a.keys() if var not in tvars]
+	offsets = {var:0 for var in a.keys()}
+	sums = {}
+	counts = {}
 
 	for t,fni in enumerate(self.fnsi):
 		if self.debug: print 'mergeNC:\tINFO:\tOpening ', fni, ' ...', t   
@@ -209,57 +219,72 @@ class mergeNC:
 		for t in tvars:
 			try:
 			  tval = num2date(nci.variables[t][:],nci.variables[t].units,calendar=self.cal)		
-			  a[t].extend( date2num(tval,nco.variables[t].units,calendar=self.cal))
+			  tval = date2num(tval,nco.variables[t].units,calendar=self.cal)
 			except:
-			  a[t].extend(nci.variables[t][:])
+			  tval = nci.variables[t][:]
+			tval = np.atleast_1d(tval)
+			a[t].extend(tval)
+			if not self.timeAverage:
+				nco.variables[t][offsets[t]:offsets[t]+len(tval)] = tval
+				offsets[t] += len(tval)
 		
 		if self.debug: print 'mergeNC:\tINFO:\tTIME:',t, tvar, array(a[tvar]).shape
-
+		if tvar in nci.variables.keys(): nt = max(nci.variables[tvar].size, 1)
+		else: nt = 1
+		
 		# not time:
-		for var in a.keys():
-		  #if var in time:continue
-		  if var in tvars:continue # there may be more than one time variable: ie time and month.		  
+		for var in dataVars:
 		  if var in nci.variables.keys(): arr = nci.variables[var][:]
 		  else:
-	  	    	print 'mergeNC:\tWARNING:', fni,' is missing variable:',var, nco.variables[var][0,:].shape
-	  	    	arr = masked_all(nco.variables[var][0,:].shape)
+			shape = nco.variables[var].shape[1:]
+			print 'mergeNC:\tWARNING:', fni,' is missing variable:',var, shape
+			arr = masked_all((nt,)+shape)
+		  
 		  if not self.timeAverage:
-		    	if not len(a[var]): a[var]=arr
-		    	else:    a[var] = append(a[var], arr, axis=0)
+			#####
+			# Variables with a record dimension are written at the end of the record,
+			# and variables without one are written from the first file only.
+			ncvar = nco.variables[var]
+			if arr.ndim and nco.dimensions[ncvar.dimensions[0]].isunlimited():
+				ncvar[offsets[var]:offsets[var]+len(arr)] = arr
+				offsets[var] += len(arr)
+			elif not offsets[var]:
+				ncvar[:] = arr
+				offsets[var] = 1
+			else:
+				print 'mergeNC:\tWARNING:', var,' has no time dimension, only the first file is saved:',ncvar.dimensions
 		  else:
-		  	if not len(a[var]): a[var]=arr
-			else:   a[var] = append(a[var], arr, axis=0)
+			#####
+			# The sum is accumulated one time step at a time, in the same order and precision
+			# as the sum along the first axis of the merged array, so the mean is unchanged.
+			arr = np.ma.array(arr)
+			arr = np.ma.masked_where(arr.mask +(arr > 9.969e+36),arr)
+			arr = np.ma.atleast_1d(arr)
+			filled = arr.filled(0)
+			valid = ~np.ma.getmaskarray(arr)
+			if var not in sums:
+				sums[var] = np.zeros(filled.shape[1:], dtype=filled[:1].sum(0).dtype)
+				counts[var] = np.zeros(filled.shape[1:], dtype=int)
+			for i in range(len(filled)):
+				sums[var] += filled[i]
+				counts[var] += valid[i]
 						
-		  if self.debug: print 'mergeNC:\tINFO\tvar:', t, var, 'len:',len(a[var]), arr.shape,array(a[var]).shape
+		  if self.debug: print 'mergeNC:\tINFO\tvar:', t, var, arr.shape
 
 		nci.close()
 	
 	if self.timeAverage: 
 	    for var in a.keys():
 		if self.debug: print "mergeNC:\tINFO\tTime Average:", var 
-		if var in timeNames:
-			nco.variables[tvar][:] = [array(a[var]).mean(),]	
+		if var in tvars:
+			if var in timeNames: 	nco.variables[tvar][:] = [array(a[var]).mean(),]	
+			else:			nco.variables[var][:] = [array(a[var]).mean(),]
 		else:
-			#nco.variables[var][:] = array(a[var])[None,:]/float(len(self.fnsi)) # assumes one month per file.
 			if self.debug: print "mergeNC:\tINFO\tTime Average: shape shift: ", var
-			#if self.debug: print "mergeNC:\tINFO\tTime Average: shape shift: ", array(a[var]).shape , '-->',array(a[var]).mean(0)[None,:].shape
-			try:	
-				
-				timeAverageArr = np.ma.array(a[var])
-				timeAverageArr = np.ma.masked_where(timeAverageArr.mask +(timeAverageArr > 9.969e+36),timeAverageArr)
-				nco.variables[var][:] = timeAverageArr.mean(0)[None,:]
-			except:
-				assert 0
-				if tvar not in nco.variables[var].dimensions:
-			  	    	print 'mergeNC:\tWARNING:', var,' has no time dimension:',nco.variables[var].dimensions 			
-					nco.variables[var][:] = array(a[var])
-			if self.debug: print "mergeNC:\tINFO\tTime Average:", var, nco.variables[var][:].shape,array(a[var]).shape, nco.variables[var].dimensions 
+			timeAverageArr = np.ma.masked_where(counts[var]==0, sums[var]*1./np.maximum(counts[var],1))
+			nco.variables[var][:] = timeAverageArr[None,:]
+			if self.debug: print "mergeNC:\tINFO\tTime Average:", var, nco.variables[var][:].shape, nco.variables[var].dimensions 
 			if self.debug: print "mergeNC:\tINFO\tTime Average: min-max range", var,  	nco.variables[var][:].min(),'-->',nco.variables[var][:].max()
-						
-	else: # No time averaging.
-	    for var in a.keys():
-		if self.debug: print 'mergeNC:\tINFO:\tsaving ', var, ' ...',nco.variables[var][:].shape,array(a[var]).shape, nco.variables[var].dimensions #, a[var][0]
-		nco.variables[var][:] = array(a[var])
 		
 	# Close output netcdfs:
 	nco.close()
@@ -0,0 +1,144 @@
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license. 
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: nearestIndex
+   :platform: Unix
+   :synopsis: A spherical nearest neighbour index, to find the closest grid cell to many points at once.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+import os
+import numpy as np
+from scipy.spatial import cKDTree
+
+try:	import cPickle as pickle
+except:	import pickle
+
+from bgcvaltools.dataset import dataset
+
+earthRadius = 6367. 	# km, same as in matchDataAndModel.myhaversine
+
+
+def latLonToXYZ(lat, lon):
+	"""
+	Converts latitude and longitude (in degrees) into cartesian coordinates on the unit sphere.
+	Returns an array with shape (n,3).
+	"""
+	lat = np.radians(np.ma.filled(np.ma.array(lat, dtype=np.float64), np.nan).ravel())
+	lon = np.radians(np.ma.filled(np.ma.array(lon, dtype=np.float64), np.nan).ravel())
+	coslat = np.cos(lat)
+	return np.column_stack([coslat*np.cos(lon), coslat*np.sin(lon), np.sin(lat)])
+
+
+class nearestIndex:
+  """
+  A nearest neighbour index for a (lat,lon) grid.
+  
+  The grid cell centres are placed on the unit sphere and stored in a cKDTree,
+  so that the closest cell to any number of points is found in a single call,
+  without any problems at the dateline or at the poles.
+  1D lat and lon arrays are treated as a regular grid, with shape (lat,lon).
+  """
+  def __init__(self, lats, lons, debug = True):
+	lats = np.ma.array(lats).squeeze()
+	lons = np.ma.array(lons).squeeze()
+	if lats.ndim == 1 and lons.ndim == 1:
+		lons, lats = np.meshgrid(lons, lats)
+	if lats.shape != lons.shape:
+		raise AssertionError("nearestIndex.py:\tnearestIndex:\tlat and lon shapes do not match: "+str(lats.shape)+' '+str(lons.shape))
+	self.shape = lats.shape
+	
+	#####
+	# Masked or non finite grid points are left out of the tree.
+	xyz = latLonToXYZ(lats, lons)
+	self.cells = np.flatnonzero(np.isfinite(xyz).all(axis=1))
+	self.tree = cKDTree(xyz[self.cells])
+	if debug: print "nearestIndex:\tMade index of", len(self.cells), "grid cells, grid shape:", self.shape
+	
+  def query(self, lat, lon, maxDistance = None):
+	"""
+	Find the closest grid cell to each (lat, lon) point.
+	
+	Returns a tuple of index arrays, one per grid dimension (ie: la, lo).
+	Points that are masked, or further than maxDistance (km) from any grid cell, get the index -1.
+	If lat and lon are scalars, the indices are returned as integers.
+	"""
+	scalar = np.ndim(lat) == 0 and np.ndim(lon) == 0
+	xyz = latLonToXYZ(lat, lon)
+	valid = np.isfinite(xyz).all(axis=1)
+	
+	if maxDistance is None:	upperBound = np.inf
+	else:			upperBound = 2.*np.sin(min(maxDistance/(2.*earthRadius), np.pi/2.))	# great circle to chord distance
+	
+	found = np.zeros(len(xyz), dtype=np.int64) + len(self.cells)
+	if valid.any():
+		distance, found[valid] = self.tree.query(xyz[valid], distance_upper_bound = upperBound)
+	missing = found == len(self.cells)
+	
+	indices = np.unravel_index(self.cells[np.where(missing, 0, found)], self.shape)
+	indices = tuple([np.where(missing, -1, ind) for ind in indices])
+	if scalar: return tuple([int(ind[0]) for ind in indices])
+	return indices
+
+
+#####
+# Indices that were already loaded by this process.
+loadedIndices = {}
+
+def getIndexCacheFn(gridFile, lat, lon):
+	"""
+	The name of the on-disk copy of the index, next to the grid file.
+	"""
+	return os.path.splitext(gridFile)[0]+'_'+lat+'_'+lon+'_nearestIndex.pkl'
+	
+def loadNearestIndex(gridFile, lat = 'nav_lat', lon = 'nav_lon', debug = True):
+	"""
+	Loads the nearestIndex for the lat and lon fields of a grid netcdf.
+	The index is kept in memory, and is also saved next to the grid file so that it only needs to be built once.
+	The saved index is rebuilt if the grid file is newer.
+	"""
+	key = (os.path.abspath(gridFile), lat, lon)
+	if key in loadedIndices: return loadedIndices[key]
+	
+	cacheFn = getIndexCacheFn(gridFile, lat, lon)
+	index = None
+	if os.path.exists(cacheFn) and os.path.getmtime(cacheFn) >= os.path.getmtime(gridFile):
+		try:
+			with open(cacheFn, 'rb') as f: index = pickle.load(f)
+			if debug: print "loadNearestIndex:\tLoaded index from:", cacheFn
+		except:
+			print "loadNearestIndex:\tWARNING:\tUnable to load index from:", cacheFn
+			index = None
+	if index is None:
+		nc = dataset(gridFile, 'r')
+		index = nearestIndex(nc.variables[lat][:], nc.variables[lon][:], debug = debug)
+		nc.close()
+		try:
+			with open(cacheFn, 'wb') as f: pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+			if debug: print "loadNearestIndex:\tSaved index to:", cacheFn
+		except:
+			print "loadNearestIndex:\tWARNING:\tUnable to save index to:", cacheFn
+			
+	loadedIndices[key] = index
+	return index
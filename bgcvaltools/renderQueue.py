@@ -0,0 +1,231 @@
+#!/usr/bin/ipython
+
+#
+# Copyright 2015, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license.
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: renderQueue
+   :platform: Unix
+   :synopsis: A queue that renders figures on a pool of worker processes.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+#####
+# Load Standard Python modules:
+import os
+import shutil
+import tempfile
+import traceback
+from time import time
+import numpy as np
+
+try:	from multiprocessing import Pool, current_process, cpu_count
+except:	Pool = None
+
+from bgcvaltools import bgcvalpython as bvp
+from bgcvaltools.scheduler import jobProcessLimit
+
+
+class memmapArray:
+  """
+  A placeholder for a large array that is saved as a .npy file, so that the worker
+  processes read it as a memory map instead of receiving a pickled copy.
+  """
+  def __init__(self, datafn, maskfn = ''):
+	self.datafn = datafn
+	self.maskfn = maskfn
+
+  def load(self):
+	#####
+	# Copy on write, so that the plotting functions can still change their arrays in place.
+	data = np.load(self.datafn, mmap_mode = 'c')
+	if self.maskfn: return np.ma.array(data, mask = np.load(self.maskfn, mmap_mode = 'c'))
+	return data
+
+
+def loadMemmaps(obj):
+	"""
+	Replaces the memmapArray placeholders in the arguments of a plot with the arrays.
+	"""
+	if isinstance(obj, memmapArray): 	return obj.load()
+	if isinstance(obj, dict):	return {k:loadMemmaps(v) for k,v in obj.items()}
+	if isinstance(obj, list):	return [loadMemmaps(v) for v in obj]
+	if isinstance(obj, tuple):	return tuple([loadMemmaps(v) for v in obj])
+	return obj
+
+
+def plotFilename(args, kwargs):
+	"""
+	Guesses the output filename of a plot, from the filename keyword or the first .png argument.
+	"""
+	if 'filename' in kwargs: return kwargs['filename']
+	for a in args:
+		if isinstance(a, basestring) and a.find('.png')>-1: return a
+	return ''
+
+
+def renderPlot(function, args, kwargs, fingerprint = ''):
+	"""
+	Renders a single plot and catches any exception, so that a broken plot is reported
+	instead of stopping the other plots.
+	If a fingerprint is provided, it is saved with the figure (see bvp.shouldIMakePlot).
+	Returns a tuple: (function name, filename, success, message, render time).
+	"""
+	start = time()
+	filename = plotFilename(args, kwargs)
+	try:
+		function(*loadMemmaps(args), **loadMemmaps(kwargs))
+		if fingerprint: bvp.savePlotFingerprint(filename, fingerprint)
+	except:
+		return function.__name__, filename, False, traceback.format_exc(), time()-start
+	return function.__name__, filename, True, '', time()-start
+
+
+def initRenderWorker():
+	"""
+	Each worker process renders with the non-interactive Agg backend.
+	"""
+	import matplotlib
+	matplotlib.use('Agg')
+	from matplotlib import pyplot
+	pyplot.switch_backend('Agg')
+
+
+class renderQueue:
+  """
+  Renders figures on a pool of worker processes, so that the analysis does not wait for matplotlib.
+
+  Plots are submitted as a plot spec: a module level plotting function, its arguments and keyword arguments.
+  Numpy arrays larger than minMemmapSize bytes are saved once as .npy files in a temporary folder (inside memmapDir, if set)
+  and are read by the workers as memory maps, so they are not pickled for each plot.
+  The wait method waits for the queue to drain and reports the render time of each plot.
+
+  With nproc <= 1, if multiprocessing is not available, or inside a daemonic worker process,
+  the plots are rendered in the current process as they are submitted.
+  Inside a JobScheduler job, nproc is capped at the processes given to that job (see scheduler.jobProcessLimit).
+  """
+  def __init__(self, nproc = None, minMemmapSize = 1000000, memmapDir = '', debug = True):
+	if nproc is None:
+		try:	nproc = cpu_count()
+		except:	nproc = 1
+	nproc = jobProcessLimit(nproc)
+	if Pool is None or current_process().daemon: nproc = 1
+	self.nproc		= nproc
+	self.minMemmapSize	= minMemmapSize
+	self.memmapDir		= memmapDir
+	self.tmpDir		= ''
+	self.debug		= debug
+	self.pool		= None
+	self.jobs		= []
+	self.results		= []
+	self.memmaps		= {}
+
+	if self.nproc > 1:
+		self.pool = Pool(processes = self.nproc, initializer = initRenderWorker)
+		if self.debug: print "renderQueue:\tStarted", self.nproc, "render processes."
+
+  def __memmap__(self, obj):
+	"""
+	Replaces large arrays in the plot arguments with memmapArray placeholders.
+	Each array is only saved once, however many plots use it.
+	"""
+	if isinstance(obj, dict):	return {k:self.__memmap__(v) for k,v in obj.items()}
+	if isinstance(obj, list):	return [self.__memmap__(v) for v in obj]
+	if isinstance(obj, tuple):	return tuple([self.__memmap__(v) for v in obj])
+	if not isinstance(obj, np.ndarray) or obj.nbytes < self.minMemmapSize or obj.dtype.hasobject: return obj
+
+	if id(obj) in self.memmaps: return self.memmaps[id(obj)][1]
+	if not self.tmpDir: 
+		if self.memmapDir:	self.tmpDir = tempfile.mkdtemp(prefix = 'renderQueue_', dir = bvp.folder(self.memmapDir))
+		else:			self.tmpDir = tempfile.mkdtemp(prefix = 'renderQueue_')
+
+	datafn = os.path.join(self.tmpDir, str(len(self.memmaps))+'.npy')
+	np.save(datafn, np.ma.getdata(obj))
+	maskfn = ''
+	if isinstance(obj, np.ma.MaskedArray):
+		maskfn = datafn.replace('.npy', '_mask.npy')
+		np.save(maskfn, np.ma.getmaskarray(obj))
+
+	#####
+	# Keep a reference to the array, so that its id is not reused while the queue is open.
+	self.memmaps[id(obj)] = (obj, memmapArray(datafn, maskfn))
+	return self.memmaps[id(obj)][1]
+
+  def submit(self, function, args = (), kwargs = {}, fingerprint = ''):
+	"""
+	:param function: A module level plotting function, ie tsp.percentilesPlot.
+	:param args: The arguments of the function.
+	:param kwargs: The keyword arguments of the function.
+	:param fingerprint: An optional bvp.plotFingerprint, saved once the figure is made.
+
+	Add a plot to the queue.
+	"""
+	if self.pool is None:
+		self.__record__(renderPlot(function, args, kwargs, fingerprint))
+		return
+	job = self.pool.apply_async(renderPlot, (function, self.__memmap__(tuple(args)), self.__memmap__(dict(kwargs)), fingerprint))
+	self.jobs.append(job)
+
+  def plot(self, function, *args, **kwargs):
+	"""
+	Add a plot to the queue, using the same call as the plotting function itself.
+	ie: queue.plot(robinPlotQuad, lons, lats, data1, data2, filename, titles = titles)
+	"""
+	self.submit(function, args, kwargs)
+
+  def __record__(self, result):
+	self.results.append(result)
+	name, filename, success, message, runtime = result
+	if not success: print "renderQueue:\tFAILED:\t", name, filename, '\n', message
+
+  def wait(self):
+	"""
+	Wait for all the plots to be rendered, then report the render time of each plot.
+	Returns the list of (function name, filename, success, message, render time).
+	"""
+	if self.pool is not None:
+		self.pool.close()
+		for job in self.jobs: self.__record__(job.get())
+		self.pool.join()
+		self.pool = None
+		self.jobs = []
+
+	if self.tmpDir and os.path.exists(self.tmpDir): shutil.rmtree(self.tmpDir)
+	self.tmpDir	= ''
+	self.memmaps	= {}
+
+	if self.debug: self.report()
+	return self.results
+
+  def report(self):
+	"""
+	Print the render time of each plot, slowest first.
+	"""
+	if not len(self.results): return
+	print "------------------------------------------------------------------"
+	print "renderQueue:\tRendered", len(self.results), "plots with", self.nproc, "processes, total render time: %.1f s" % sum([r[4] for r in self.results])
+	for name, filename, success, message, runtime in sorted(self.results, key = lambda r: -r[4]):
+		if success:	status = 'done'
+		else:		status = 'failed'
+		print "renderQueue:\t", status, "\t%.2f s\t" % runtime, name, "\t", filename
+	print "------------------------------------------------------------------"
@@ -0,0 +1,211 @@
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license. 
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: scheduler
+   :platform: Unix
+   :synopsis: A small dependency-aware process pool job scheduler.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+#####
+# Load Standard Python modules:
+import sys
+import traceback
+from time import time
+from Queue import Empty
+
+try:	from multiprocessing import Process, Queue
+except:	Process = None
+
+#####
+# The number of processes that the current job may use for its own pools.
+# This is set in each job process started by a JobScheduler, so that nproc jobs
+# that each start a pool of nproc processes do not run nproc*nproc processes.
+# (None: not running in a scheduler job process.)
+jobProcesses = None
+
+
+def jobProcessLimit(nproc):
+	"""
+	Returns nproc, capped at the number of processes that the current scheduler job may use.
+	"""
+	if jobProcesses is None: return nproc
+	return max(1, min(nproc, jobProcesses))
+
+
+def runJob(name, function, args, kwargs):
+	"""
+	Runs a single job and catches any exception, so that a failed job
+	is reported back to the scheduler instead of killing the worker or the run.
+	Returns a tuple: (name, success, message, run time).
+	"""
+	start = time()
+	try:
+		function(*args, **kwargs)
+	except:
+		return name, False, traceback.format_exc(), time()-start
+	return name, True, '', time()-start
+
+def queueJob(queue, name, function, args, kwargs, processes = 1):
+	"""
+	Runs a single job in a child process, and puts the result on the queue.
+	processes is the number of processes that the job may use for its own pools (see jobProcessLimit).
+	"""
+	global jobProcesses
+	jobProcesses = processes
+	queue.put(runJob(name, function, args, kwargs))
+
+
+class JobScheduler:
+  """
+  Runs a set of jobs in separate processes, at most nproc at a time,
+  respecting the dependencies between jobs.
+
+  Jobs are added with a name, a function, its arguments, an estimated cost
+  and a list of jobs that need to be finished before it can start.
+  Ready jobs are submitted in decreasing order of cost, so that the
+  most expensive jobs start first and the pool is not left waiting for a
+  single long job at the end.
+
+  A job starts when all of its dependencies have finished, whether or not they succeeded.
+  Failed jobs are reported at the end of the run, but do not stop other jobs.
+
+  With nproc <= 1, or if multiprocessing is not available, the jobs are run
+  in the current process, in the same order.
+  Otherwise, the pools started by each job are capped (see jobProcessLimit), so that
+  nproc is shared between the jobs: each job may use nproc / number of jobs processes, (at least 1).
+  """
+  def __init__(self, nproc = 1, debug = True):
+	self.nproc	= nproc
+	self.debug	= debug
+	self.jobs	= {}
+	self.order	= []
+	self.status	= {}
+	self.messages	= {}
+	self.times	= {}
+
+  def add(self, name, function, args = (), kwargs = {}, cost = 1., dependencies = []):
+	"""
+	Add a job to the queue.
+	"""
+	if name in self.jobs:
+		raise AssertionError("scheduler.py:\tadd:\tJob already exists: "+str(name))
+	self.jobs[name] = (function, tuple(args), dict(kwargs), float(cost), list(dependencies))
+	self.order.append(name)
+	self.status[name] = 'waiting'
+
+  def __ready__(self):
+	"""
+	Returns the list of waiting jobs whose dependencies have all finished, most expensive first.
+	"""
+	ready = []
+	for name in self.order:
+		if self.status[name] != 'waiting': continue
+		deps = self.jobs[name][4]
+		if False in [self.status.get(d, 'done') in ['done','failed'] for d in deps]: continue
+		ready.append(name)
+	return sorted(ready, key = lambda n: -self.jobs[n][3])
+
+  def __record__(self, name, success, message, runtime):
+	if success:	self.status[name] = 'done'
+	else:		self.status[name] = 'failed'
+	self.messages[name] = message
+	self.times[name] = runtime
+	if self.debug:
+		print "scheduler.py:\t", self.status[name], "\t", name, "\tin %.1f s" % runtime
+		if not success: print message
+
+  def run(self):
+	"""
+	Run all the jobs. Returns the dictionary of job status.
+	"""
+	for name in self.order:
+		for d in self.jobs[name][4]:
+			if d not in self.jobs:
+				raise AssertionError("scheduler.py:\trun:\tJob "+str(name)+" depends on unknown job: "+str(d))
+
+	if self.nproc <= 1 or Process is None:
+		self.__runSerial__()
+	else:
+		self.__runProcesses__()
+
+	self.report()
+	return self.status
+
+  def __runSerial__(self):
+	ready = self.__ready__()
+	while len(ready):
+		name = ready[0]
+		function, args, kwargs, cost, deps = self.jobs[name]
+		self.status[name] = 'running'
+		self.__record__(*runJob(name, function, args, kwargs))
+		ready = self.__ready__()
+
+  def __runProcesses__(self):
+	#####
+	# Each job runs in its own (non-daemonic) process, so that the memory (and any open figures)
+	# of large jobs are released when they finish, and so that the jobs can start their own pools.
+	finished = Queue()
+	running = {}
+	processes = max(1, self.nproc // max(1, min(self.nproc, len(self.order))))
+	while True:
+		for name in self.__ready__():
+			if len(running) >= self.nproc: break
+			function, args, kwargs, cost, deps = self.jobs[name]
+			self.status[name] = 'running'
+			running[name] = Process(target = queueJob, args = (finished, name, function, args, kwargs, processes))
+			running[name].start()
+		if not len(running): break
+
+		try:	result = finished.get(timeout = 10.)
+		except Empty:
+			#####
+			# queueJob catches everything raised by the job itself, so this only catches 
+			# processes that died without returning a result. (ie: killed, or out of memory)
+			for name, proc in running.items():
+				if proc.is_alive() or proc.exitcode == 0: continue
+				self.__record__(name, False, 'Process exited with code: '+str(proc.exitcode), 0.)
+				del running[name]
+			continue
+		running.pop(result[0]).join()
+		self.__record__(*result)
+
+  def failed(self):
+	return [name for name in self.order if self.status[name] == 'failed']
+
+  def report(self):
+	"""
+	Print a summary of the run.
+	"""
+	print "------------------------------------------------------------------"
+	print "scheduler.py:\tFinished", len(self.order), "jobs with", self.nproc, "processes."
+	for name in self.order:
+		print "scheduler.py:\t", self.status[name], "\t", name, "\t%.1f s" % self.times.get(name, 0.)
+	failed = self.failed()
+	if len(failed):
+		print "scheduler.py:\tThe following jobs failed:"
+		for name in failed:
+			print "scheduler.py:\tFAILED:\t", name
+			print self.messages[name]
+	print "------------------------------------------------------------------"
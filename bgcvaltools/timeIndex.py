@@ -0,0 +1,201 @@
+#!/usr/bin/ipython
+
+#
+# Copyright 2015, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license.
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: timeIndex
+   :platform: Unix
+   :synopsis: A persistent index of the time range of each model file.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+#####
+# Load Standard Python modules:
+import os
+import hashlib
+import numpy as np
+
+from bgcvaltools import bgcvalpython as bvp
+from bgcvaltools.dataset import dataset
+
+#####
+# The columns of the index.
+indexColumns = ['path', 'coords', 'size', 'mtime', 'tmin', 'tmax', 'ntimes', 'calendar']
+
+#####
+# Time index files.
+# One index is shared by every analysis of the same model files (each key, the profiles and each p2p year), 
+# keyed by the hash of the folders that hold the model files.
+timeIndexDir = 'shelves/timeIndex/'
+
+def getTimeIndexFn(files):
+	"""
+	:param files: A list of model file paths.
+	
+	Returns the path of the time index of the folders of these files.
+	"""
+	folders = sorted(set([os.path.dirname(os.path.abspath(fn)) for fn in files]))
+	return timeIndexDir+hashlib.md5(repr(folders)).hexdigest()+'.npz'
+
+
+def fileStat(fn):
+	"""
+	Returns the (size, mtime) of a file, or (-1, -1.) if it does not exist.
+	"""
+	try:	st = os.stat(fn)
+	except:	return -1, -1.
+	return st.st_size, st.st_mtime
+
+
+def coordsKey(coords):
+	"""
+	The times in the index depend on the time coordinate and the calendar in the config.
+	"""
+	return '|'.join([str(coords.get('t','')), str(coords.get('cal',''))])
+
+
+def readFileTimes(fn, coords):
+	"""
+	Opens a model file and returns (tmin, tmax, ntimes, calendar).
+	"""
+	nc = dataset(fn,'r')
+	ts = bvp.getTimes(nc, coords)
+	try: 	cal = nc.variables[coords['t']].calendar
+	except:	cal = coords['cal']
+	nc.close()
+	ts = np.array(ts, dtype=np.float64).ravel()
+	if not len(ts): return np.nan, np.nan, 0, str(cal)
+	return ts.min(), ts.max(), len(ts), str(cal)
+
+
+class timeIndex:
+  """
+  A persistent sidecar index of (path, size, mtime) : (tmin, tmax, ntimes, calendar) for the model files.
+
+  Checking which model files are inside the time range needs the times of each file,
+  which means opening and decoding every file. The index is saved in a .npz file,
+  so each file is only opened once, or again if its size or modification time changes.
+  The time range queries are then a vectorised comparison over the whole index.
+
+  The index file can be shared between analyses (see getTimeIndexFn): before saving, the entries
+  on disk are merged with the new entries, and the file is written via a temporary file.
+  """
+  def __init__(self, indexfn, coords, debug = True):
+	self.indexfn	= indexfn
+	self.coords	= coords
+	self.coordsKey	= coordsKey(coords)
+	self.debug	= debug
+	self.index	= {}	# (path, coordsKey): (size, mtime, tmin, tmax, ntimes, calendar)
+	self.load()
+
+  def load(self):
+	"""
+	Load the index from disk. A missing or broken index is rebuilt.
+	"""
+	self.index.update(self.__read__())
+
+  def __read__(self):
+	index = {}
+	if not os.path.exists(self.indexfn): return index
+	try:
+		npz = np.load(self.indexfn)
+		cols = [npz[c] for c in indexColumns]
+		npz.close()
+	except:
+		print "timeIndex:\tload:\tUnable to read the time index, it will be rebuilt:", self.indexfn
+		return index
+	for path, ckey, size, mtime, tmin, tmax, ntimes, cal in zip(*cols):
+		index[(str(path), str(ckey))] = (int(size), float(mtime), float(tmin), float(tmax), int(ntimes), str(cal))
+	return index
+
+  def save(self):
+	"""
+	Merge with the index on disk, and save it.
+	"""
+	index = self.__read__()
+	index.update(self.index)
+	self.index = index
+
+	keys = sorted(index.keys())
+	cols = {	'path':		np.array([k[0] for k in keys], dtype=str),
+			'coords':	np.array([k[1] for k in keys], dtype=str),
+			'size':		np.array([index[k][0] for k in keys], dtype=np.int64),
+			'mtime':	np.array([index[k][1] for k in keys], dtype=np.float64),
+			'tmin':		np.array([index[k][2] for k in keys], dtype=np.float64),
+			'tmax':		np.array([index[k][3] for k in keys], dtype=np.float64),
+			'ntimes':	np.array([index[k][4] for k in keys], dtype=np.int64),
+			'calendar':	np.array([index[k][5] for k in keys], dtype=str),}
+	folder = os.path.dirname(self.indexfn)
+	if folder: bvp.folder(folder)
+	tmpfn = self.indexfn.replace('.npz','_'+str(os.getpid())+'.tmp.npz')
+	np.savez(tmpfn, **cols)
+	os.rename(tmpfn, self.indexfn)
+
+  def update(self, files):
+	"""
+	Add any new or changed files to the index, and save it if anything changed.
+	"""
+	changed = 0
+	for fn in files:
+		size, mtime = fileStat(fn)
+		entry = self.index.get((fn, self.coordsKey), None)
+		if entry is not None and entry[0] == size and entry[1] == mtime: continue
+		if size < 0: continue
+		try:	tmin, tmax, ntimes, cal = readFileTimes(fn, self.coords)
+		except:
+			print "timeIndex:\tupdate:\tUnable to read the times from:", fn
+			continue
+		self.index[(fn, self.coordsKey)] = (size, mtime, tmin, tmax, ntimes, cal)
+		changed += 1
+	if changed:
+		if self.debug: print "timeIndex:\tupdate:\tAdded", changed, "files to the time index:", self.indexfn
+		self.save()
+
+  def times(self, fn):
+	"""
+	Returns (tmin, tmax, ntimes, calendar) for this file.
+	"""
+	self.update([fn,])
+	size, mtime, tmin, tmax, ntimes, cal = self.index[(fn, self.coordsKey)]
+	return tmin, tmax, ntimes, cal
+
+  def filesInRange(self, files, tmin, tmax):
+	"""
+	:param files: A list of model file paths.
+	:param tmin: The start of the time range (in decimal years)
+	:param tmax: The end of the time range (in decimal years)
+
+	Returns the files which have any times inside the range, in the same order.
+	Files that can not be read are kept, so that they are handled (and reported) as they were before.
+	"""
+	files = list(files)
+	if not len(files): return []
+	self.update(files)
+
+	ranges = np.array([self.index.get((fn, self.coordsKey), (0,0.,np.nan,np.nan,0,''))[2:4] for fn in files], dtype=np.float64)
+	unknown = np.isnan(ranges).any(axis=1)
+	with np.errstate(invalid='ignore'):
+		inside = unknown + ((ranges[:,1] >= tmin) * (ranges[:,0] <= tmax))
+	if self.debug: print "timeIndex:\tfilesInRange:\t", inside.sum(), 'of', len(files), 'files are inside the range', [tmin, tmax]
+	return [fn for fn, ins in zip(files, inside) if ins]
@@ -0,0 +1,210 @@
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license. 
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: transectPath
+   :platform: Unix
+   :synopsis: The ordered grid cells along each transect, calculated once per grid and transect.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+import os
+import hashlib
+import numpy as np
+
+######
+# local imports
+from bgcvaltools import bgcvalpython as bvp 
+from bgcvaltools.nearestIndex import nearestIndex, loadNearestIndex
+from regions.makeMask import coordinateHash
+
+#####
+# The transects are made of straight lines in (lat,lon), each one is:
+# (start latitude, end latitude, start longitude, end longitude, number of points)
+namedTransects = {
+	'ATransect':		[(-89., 89.99, -28., -28., 1000),],
+	'PTransect':		[(-89., 89.99, 200., 200., 1000),],
+	'Equator':		[(0., 0., -360., 360., 1000),],
+	'SOTransect':		[(-60., -60., -360., 360., 1000),],
+	'ArcTransect':		[(50., 90., 0., 0., 200), (60., 90., -165., -165., 200),],
+	'CanRusTransect':	[(65., 90., 83.5, 83.5, 200), (60., 90., -96., -96., 200),],
+	'AntTransect':		[(-89.9, -40., 0., 0., 1000),],
+	}
+
+def transectLines(layer):
+	"""
+	:param layer: A named transect (ie 'ATransect'), or a custom latitude or longitude (ie '28W', '10N').
+
+	Returns the list of straight lines that make up the transect, or None if layer is not a transect.
+	The custom layers are parsed in the same way as in extractLayer.
+	"""
+	if type(layer) != type('string'): return None
+	if layer in namedTransects: return namedTransects[layer]
+
+	customLayerValue = None
+	customLayerType	 = None
+	for z in ['m','N','E','S','W']:
+		try:	customLayerValue = float(layer.replace(z, ''))
+		except:	continue
+		if z == 'm':	customLayerType	= 'z'
+		if z == 'N':	customLayerType	= 'lat'
+		if z == 'E':	customLayerType	= 'lon'
+		if z == 'S':	
+			customLayerType	= 'lat'
+			customLayerValue *= -1.
+		if z == 'W':	
+			customLayerType	= 'lon'
+			customLayerValue *= -1.
+	if customLayerType == 'lon':	return [(-89., 89.99, customLayerValue, customLayerValue, 1000),]
+	if customLayerType == 'lat':	return [(customLayerValue, customLayerValue, -360., 360., 1000),]
+	return None
+
+def transectPoints(lines):
+	"""
+	Returns the arrays of latitude and longitude of the points along the lines, in order.
+	These are the same points as extractLayer.drawLine.
+	"""
+	tlats, tlons = [], []
+	for (lat1, lat2, lon1, lon2, numpoints) in lines:
+		i = np.arange(numpoints)
+		tlats.append(lat1 + i*((lat2-lat1)/numpoints))
+		tlons.append(lon1 + i*((lon2-lon1)/numpoints))
+	return np.concatenate(tlats), np.concatenate(tlons)
+
+
+class transectPath:
+  """
+  The grid cells along a transect, in the order that the transect passes through them.
+  
+  j and i are the grid indices of each cell, and point is the index of the first point
+  of the transect lines that falls in that cell. Cells are only listed once.
+  """
+  def __init__(self, j, i, point, shape):
+	self.j = np.asarray(j, dtype=np.int64)
+	self.i = np.asarray(i, dtype=np.int64)
+	self.point = np.asarray(point, dtype=np.int64)
+	self.shape = tuple(shape)
+
+  def __len__(self): return len(self.j)
+	
+  def mask2d(self, dtype = np.float64):
+	"""
+	Returns a 2D mask on the grid, which is 0 along the transect and 1 elsewhere.
+	"""
+	mask2d = np.ones(self.shape, dtype = dtype)
+	mask2d[self.j, self.i] = 0
+	return mask2d
+
+  def alongTrackIndex(self):
+	"""
+	Returns a 2D array on the grid, with the position of each cell along the transect, or -1 off the transect.
+	This is useful to order the points of a section plot.
+	"""
+	index = np.zeros(self.shape, dtype = np.int64) - 1
+	index[self.j, self.i] = np.arange(len(self.j))
+	return index
+
+	
+def makeTransectPath(lines, index, shape):
+	"""
+	:param lines: The list of lines from transectLines.
+	:param index: A nearestIndex of the grid.
+	:param shape: The shape of the grid.
+	
+	Finds the closest grid cell to every point on the lines in a single query, 
+	and returns the transectPath of the cells, in order.
+	"""
+	tlats, tlons = transectPoints(lines)
+	la, lo = index.query(tlats, tlons)
+	points = np.flatnonzero(la > -1)
+	cells = la[points]*shape[1] + lo[points]
+	
+	#####
+	# Keep the first time that each cell is crossed.
+	cells, first = np.unique(cells, return_index = True)
+	first.sort()
+	points = points[first]
+	return transectPath(la[points], lo[points], points, shape)
+
+
+#####
+# Transect path cache.
+# The paths are stored in memory and on disk, keyed by the hash of the 
+# coordinates, the transect name and the hash of the transect lines.
+transectCacheDir = 'shelves/transectPaths/'
+loadedPaths = {}
+
+def getTransectCacheFn(gridHash, layer, lines):
+	linesHash = hashlib.md5(repr(lines)).hexdigest()[:8]
+	return transectCacheDir+gridHash+'_'+layer+'_'+linesHash+'.npz'
+
+def loadTransectPath(layer, lat2d, lon2d, gridFile = '', lat = 'nav_lat', lon = 'nav_lon', gridHash = '', debug = False):
+	"""
+	:param layer: A named or custom transect (see transectLines).
+	:param lat2d: The 2D latitude of the grid.
+	:param lon2d: The 2D longitude of the grid.
+	:param gridFile: A grid file with the lat and lon fields of the grid, used to load the nearestIndex.
+		If it is not set, the nearestIndex is made from lat2d and lon2d, and it is not saved.
+	:param gridHash: The coordinateHash of lat2d and lon2d, if it is already known.
+	
+	Returns the transectPath of the layer on this grid.
+	The path is calculated once per grid and transect, then reused from memory or disk.
+	"""
+	lines = transectLines(layer)
+	if lines is None:
+		raise AssertionError("transectPath.py:\tloadTransectPath:\tUnable to define the transect coordinates: "+str(layer))
+		
+	if gridHash == '': gridHash = coordinateHash(lat2d, lon2d)
+	fn = getTransectCacheFn(gridHash, layer, lines)
+	if fn in loadedPaths: return loadedPaths[fn]
+
+	if os.path.exists(fn):
+		try:
+			npz = np.load(fn)
+			path = transectPath(npz['j'], npz['i'], npz['point'], npz['shape'])
+			npz.close()
+			if debug: print "transectPath.py:\tloadTransectPath:\tLoaded", layer, 'from', fn
+			loadedPaths[fn] = path
+			return path
+		except: print "transectPath.py:\tloadTransectPath:\tUnable to load", fn, ", remaking it."
+
+	#####
+	# The nearest index is only loaded (and saved) for a real grid file, otherwise it is built from lat2d and lon2d.
+	index = None
+	if gridFile:
+		try:	index = loadNearestIndex(gridFile, lat = lat, lon = lon, debug = debug)
+		except:	index = None
+	if index is None: index = nearestIndex(lat2d, lon2d, debug = debug)
+	path = makeTransectPath(lines, index, np.shape(lat2d))
+	loadedPaths[fn] = path
+
+	#####
+	# Save via a temporary file, so that parallel jobs don't read a partial file.
+	try:
+		bvp.folder(transectCacheDir)
+		tmpfn = fn.replace('.npz','_'+str(os.getpid())+'.tmp.npz')
+		np.savez(tmpfn, j=path.j, i=path.i, point=path.point, shape=np.array(path.shape))
+		os.rename(tmpfn, fn)
+		if debug: print "transectPath.py:\tloadTransectPath:\tSaved", layer, 'to', fn
+	except:	print "transectPath.py:\tloadTransectPath:\tUnable to save", fn
+	return path
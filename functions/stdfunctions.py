@@ -32,6 +32,7 @@
 """
 import numpy as np
 from bgcvaltools import dataset
+from bgcvaltools.alwaysInclude import timeNames, depthNames
 
 
 
@@ -74,6 +75,193 @@ def extractData(nc, details,key = ['',],debug=False):
 
 
 
+#####
+# Chunked reading.
+# The hyperslab classes below behave like a netcdf Dataset, so that the convert functions
+# can be applied unchanged, but they only read part of the time and depth dimensions.
+def slabShape(shape,slab):
+	"""
+	The shape of an array of this shape, after it is indexed by the tuple of slices, slab.
+	"""
+	return tuple([len(range(*sl.indices(n))) for n,sl in zip(shape,slab)])
+
+class hyperslabVariable:
+  """
+  	One variable of a hyperslab. The slab is read once, on the first access,
+  	and the shape, ndim and len are those of the slab, not of the full variable.
+  """
+  def __init__(self,var,slab):
+  	self.var 	= var
+  	self.slab 	= slab
+  	self.shape	= slabShape(var.shape,slab)
+  	self.ndim	= len(self.shape)
+  	self.__data__	= None
+  	
+  def __len__(self):
+  	return self.shape[0]
+  	
+  def __getitem__(self,key):
+  	if self.__data__ is None: self.__data__ = self.var[self.slab]
+  	out = self.__data__[key]
+  	#####
+  	# A copy, as the convert functions may change the data in place, (ie sums).
+  	if isinstance(out,np.ndarray): out = out.copy()
+  	return out
+  	
+  def __getattr__(self,name):
+  	return getattr(self.var,name)
+
+class hyperslabVariables(dict):
+  def __init__(self,nc,tdim,tslice,zdim,zslice):
+  	dict.__init__(self)
+  	self.nc 	= nc
+  	self.tdim 	= tdim
+  	self.tslice 	= tslice
+  	self.zdim 	= zdim
+  	self.zslice 	= zslice
+  	self.slabs	= {}
+  	
+  def __getitem__(self,key):
+  	var = self.nc.variables[key]
+  	dims = var.dimensions
+  	if self.tdim not in dims and self.zdim not in dims: return var
+  	if key in self.slabs: return self.slabs[key]
+  	slab = []
+  	for d in dims:
+  		if d == self.tdim:	slab.append(self.tslice)
+  		elif d == self.zdim:	slab.append(self.zslice)
+  		else:			slab.append(slice(None))
+  	self.slabs[key] = hyperslabVariable(var,tuple(slab))
+  	return self.slabs[key]
+  	
+  def __contains__(self,key):	return key in self.nc.variables
+  def keys(self):		return self.nc.variables.keys()
+
+class hyperslab:
+  """
+  	A read-only view of a netcdf, where every variable with a time or depth dimension 
+  	is limited to the time slice, tslice, and the depth slice, zslice.
+  """
+  def __init__(self,nc,tdim,tslice,zdim='',zslice=slice(None)):
+  	self.nc 	= nc
+  	self.variables 	= hyperslabVariables(nc,tdim,tslice,zdim,zslice)
+  	
+  def __getattr__(self,name):
+  	return getattr(self.nc,name)
+
+def findTimeDepthDims(dims):
+  	"""
+  	Returns the names of the time and depth dimensions in dims, ('' if there is none).
+  	"""
+  	tdim = ''
+  	zdim = ''
+  	for d in dims:
+  		if d in timeNames and tdim == '':	tdim = d
+  		if d in depthNames and zdim == '': 	zdim = d
+  	return tdim, zdim
+
+def chunkable(nc, details, debug=False):
+  	"""
+  	:param nc: An open netcdf Dataset.
+  	:param details: The details dictionairy, as in extractData.
+
+  	Returns True if extractDataChunks can be used with this convert function.
+  	Only the functions in std_functions are known to act on each time and depth independently.
+  	As a check, the convert function is applied to one time step (and one depth level), 
+  	and the result needs to have the shape of that slab.
+  	"""
+  	convert = details['convert']
+  	stdNames = [f.__name__ for f in std_functions.values() if f]
+  	#####
+  	# bgcvalpython has copies of the simple std_functions, (ie bvp.NoChange).
+  	isCopy = getattr(convert,'__module__','') == 'bgcvaltools.bgcvalpython' and getattr(convert,'__name__','') in stdNames
+  	if convert not in std_functions.values() and not isCopy: 
+  		if debug: print "chunkable:\tNot a std_functions convert function:",details['name']
+  		return False
+  	var = nc.variables[details['vars'][0]]
+  	tdim, zdim = findTimeDepthDims(var.dimensions)
+  	if zdim: zslice = slice(0,1)
+  	else:	 zslice = slice(None)
+  	probe = hyperslab(nc,tdim,slice(0,1),zdim,zslice)
+  	expected = probe.variables[details['vars'][0]].shape
+  	shape = extractData(probe,details).shape
+  	if shape != expected:
+  		if debug: print "chunkable:\tThe convert function changes the shape:",details['name'],expected,'->',shape
+  		return False
+  	return True
+
+#####
+# The number of points (of one time chunk and one layer) that are read at once, when the time chunk is not set.
+# Each point takes about 100 bytes once it is flattened by the DataLoader, so this is about 1GB.
+defaultChunkPoints = 10000000
+
+def autoTimeChunk(shape, tindex, zindex = None, level = None, chunkPoints = defaultChunkPoints):
+  	"""
+  	:param shape: The shape of the variable.
+  	:param tindex: The index of the time dimension in the shape.
+  	:param zindex: The index of the depth dimension in the shape, (only needed if a level is read).
+  	
+  	Returns the largest number of time steps where a chunk holds less than chunkPoints points,
+  	(at least one time step, and at most the whole file).
+  	"""
+  	points = 1
+  	for i,n in enumerate(shape):
+  		if i == tindex: continue
+  		if i == zindex and level is not None: continue
+  		points *= n
+  	return int(min(shape[tindex], max(1, chunkPoints // max(points,1))))
+
+def extractDataChunks(nc, details, timeChunk = None, level = None, debug=False):
+  	"""
+  	:param nc: An open netcdf Dataset.
+  	:param details: The details dictionairy, as in extractData.
+  	:param timeChunk: The number of time steps to read at once. 
+  		If None (or zero), the chunk is the whole file, or as many time steps as fit in defaultChunkPoints (see autoTimeChunk).
+  	:param level: The index of a single depth level to read, or None to read every depth.
+
+  	A generator that applies extractData to one time chunk at a time, using netcdf hyperslabs,
+  	so that the memory needed is one time chunk (of one depth level) instead of the full file.
+  	Yields (t0, t1, data), where data covers the time indices t0 to t1 of the file.
+  	If a level is requested, the depth dimension of data is kept, with a length of one.
+  	
+  	Note that this is only valid for convert functions that act on each time and depth independently,
+  	(see chunkable). A chunk where the convert function changed the shape raises an AssertionError.
+  	"""
+  	dims = nc.variables[details['vars'][0]].dimensions
+  	shape = nc.variables[details['vars'][0]].shape
+  	tdim, zdim = findTimeDepthDims(dims)
+  	if level is None: 	zslice = slice(None)
+  	else: 			zslice = slice(level,level+1)
+  	if zdim == '' and level is not None:
+  		raise AssertionError("std_functions:\textractDataChunks:\tNo depth dimension in: "+str(dims))
+  	
+  	if tdim == '':
+  		if debug: print "extractDataChunks:\tNo time dimension in:",dims
+  		yield 0, 1, extractChunk(hyperslab(nc,tdim,slice(None),zdim,zslice),details,debug=debug)
+  		return
+  	
+  	tlen = shape[list(dims).index(tdim)]
+  	if not timeChunk:
+  		if zdim:	zindex = list(dims).index(zdim)
+  		else:		zindex = None
+  		timeChunk = autoTimeChunk(shape, list(dims).index(tdim), zindex = zindex, level = level)
+  	timeChunk = max(1,int(timeChunk))
+  	for t0 in range(0,tlen,timeChunk):
+  		t1 = min(t0+timeChunk,tlen)
+  		if debug: print "extractDataChunks:\tReading",details['name'],'times:',t0,'to',t1,'of',tlen, 'level:',level
+  		yield t0, t1, extractChunk(hyperslab(nc,tdim,slice(t0,t1),zdim,zslice),details,debug=debug)
+
+def extractChunk(slab, details, debug=False):
+  	"""
+  	Applies extractData to a hyperslab, and checks that the data has the shape of the slab.
+  	"""
+  	data = extractData(slab,details,debug=debug)
+  	expected = slab.variables[details['vars'][0]].shape
+  	if data.shape != expected:
+  		raise AssertionError("std_functions:\textractDataChunks:\tThe convert function changed the shape of the chunk: "+str(expected)+' -> '+str(data.shape))
+  	return data
+
+
 
 ####
 # Some functions for maniulating data:
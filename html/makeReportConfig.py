@@ -42,7 +42,8 @@ from bgcvaltools import bgcvalpython as bvp
 from html import htmlTools, htmltables
 from longnames.longnames import getLongName
 
-from bgcvaltools.configparser import AnalysisKeyParser, GlobalSectionParser
+from bgcvaltools.configparser import AnalysisKeyParser, GlobalSectionParser, loadGlobalSectionParser
+from timeseries.resultStore import loadModelData
 
 package_directory = os.path.dirname(os.path.abspath(__file__))
 
@@ -305,17 +306,10 @@ def addTable(
 		scenarios[scenario] 	= True
 		keys[key] 		= True
 								
-		shelvefn 	= bvp.folder(akp.postproc_ts)+'_'.join([jobID,key,])+'.shelve'
 		shelvefn_insitu	= bvp.folder(akp.postproc_ts)+'_'.join([jobID,key,])+'_insitu.shelve'
 		
-		sh = shopen(shelvefn)
-		print sh.keys()
-		try:
-			modeldataD = sh['modeldata']
-			sh.close()			
-		except:	
-			sh.close()
-			continue
+		modeldataD = loadModelData(akp.postproc_ts, jobID, key)
+		if modeldataD is None: continue
 		data[(key,model,scenario, jobID)] = modeldataD
 		print "Loaded model data", (key,model,scenario, jobID)
 		
@@ -728,7 +722,7 @@ def htmlMakerFromConfig(
 		browswer = 'firefox',
 	):
 
-	globalkeys = GlobalSectionParser(configfn)
+	globalkeys = loadGlobalSectionParser(configfn)
 
 	#####
 	# Delete old files, if needed
@@ -48,6 +48,7 @@ from os.path import basename,exists
 from sys import argv
 from shelve import open as shOpen
 from longnames.longnames import getLongName
+from p2p.slicePoints import loadSliceField, pointKeys
 
 purple = [125./256., 38./256., 205./256.]
 
@@ -177,7 +178,7 @@ class makePatternStatsPlots:
 	totalConc = 0.
 	#print 'calcTotalConcentration:',sh['xtype'],key,self.grid,self.gridFile
 	#print self.volumeDict
-	for la,lo,data in zip(self.loadFromshelve(sh,'x_lat'),self.loadFromshelve(sh,'x_lon'), sh[key]):
+	for la,lo,data in zip(self.loadFromshelve(sh,'x_lat'),self.loadFromshelve(sh,'x_lon'), self.loadFromshelve(sh,key)):
 		#print la,lo,data, [(round(la,3),round(lo,3))]
 		#print self.volumeDict[(round(la,3),round(lo,3))]
 		totalConc += self.volumeDict[(round(la,3),round(lo,3))]*data
@@ -189,7 +190,7 @@ class makePatternStatsPlots:
 	totalConc = 0.
 	totalVolume = 0.
 	
-	for la,lo,data in zip(self.loadFromshelve(sh,'x_lat'),self.loadFromshelve(sh,'x_lon'), sh[key]):
+	for la,lo,data in zip(self.loadFromshelve(sh,'x_lat'),self.loadFromshelve(sh,'x_lon'), self.loadFromshelve(sh,key)):
 		vol = self.volumeDict[(round(la,3),round(lo,3))]
 		totalConc += vol*data
 		totalVolume+=vol
@@ -261,7 +262,10 @@ class makePatternStatsPlots:
   def loadFromshelve(self,sh, sh_key):
   	#####
   	# Simple code to return mask if can't load the shelve
-  	try:	return sh[sh_key]
+  	# The point fields are rebuilt from the matched files (see slicePoints.py).
+  	try:	
+  		if sh_key in pointKeys: return loadSliceField(sh, sh_key)
+  		return sh[sh_key]
   	except: return np.ma.masked
 
   def loadMetrics(self,):
@@ -50,6 +50,7 @@ from calendar import month_name
 
 from bgcvaltools import bgcvalpython as bvp
 from longnames.longnames import getLongName
+from p2p.slicePoints import loadSliceField
 
 from bgcvaltools.StatsDiagram import TaylorDiagram, TargetDiagram,TaylorDiagramMulti
 from bgcvaltools.robust import TargetDiagram as robustTargetDiagram #, TargetDiagram,TaylorDiagramMulti
@@ -155,7 +156,7 @@ class makeTargets:
 			rp  = s['robust.p']
 		except:
 			print "makeTagets.py:\tWARNING: robustStatsDiagram CALCULATED WITH DEFAULT PRECISION (0.01)"
-			mrobust = robustStatsDiagram(s['datax'],s['datay'],0.01)
+			mrobust = robustStatsDiagram(loadSliceField(s,'datax'),loadSliceField(s,'datay'),0.01)
 			rE0 	= mrobust.E0
 			rE 	= mrobust.E
 			rR	= mrobust.R
@@ -45,6 +45,7 @@ import numpy as np
 # local imports
 from bgcvaltools import bgcvalpython as bvp 
 from bgcvaltools.extractLayer import extractLayer
+from bgcvaltools.nearestIndex import loadNearestIndex
 
 #####	
 # These are availalble in the module:
@@ -138,7 +139,6 @@ class matchDataAndModel:
 	print "matchDataAndModel:\tINFO:\tGrid File:  \t",gridFile
 	
 	self.matchedShelve 	= bvp.folder(self.workingDir)+self.model+'-'+self.jobID+'_'+self.year+'_'+self.dataType+'_'+self.layer+'_matched.shelve'
-	self.matchesShelve 	= bvp.folder(self.workingDir)+self.model+'-'+self.jobID+'_'+self.year+'_'+self.dataType+'_'+self.layer+'_matches.shelve'
 	
 	self.workingDirTmp 	= bvp.folder(self.workingDir+'tmp')
 	self.DataFilePruned	= self.workingDirTmp+'Data_' +self.dataType+'_'+self.layer+'_'+self.model+'-'+self.jobID+'-'+self.year+'_pruned.nc'
@@ -400,10 +400,15 @@ class matchDataAndModel:
 		
   	
   def _matchModelToData_(self,):
+	"""
+	Matches each in situ point to a model grid cell: (t,z,la,lo).
+	All the remaining points are matched at once, using array operations:
+	the nearest grid cell index for lat and lon, matchDepths for the depth and matchTimes for the time.
+	The points are then grouped by grid cell with addMatches.
+	"""
   	print "matchModelToData:\tOpened MAREDAT netcdf:", self.DataFile1D
   	
   	ncIS = dataset(self.DataFile1D,'r')
-  	#ncIS = ncdfView(self.DataFile1D,Quiet=True)  	
 	is_i	= ncIS.variables['index'][:]
 	
 	try:
@@ -425,29 +430,6 @@ class matchDataAndModel:
 		print "matchModelToData:\tStarting from maxindex",maxIndex,"\tfinished:",len(self.matches), " already matched. Mask:",self.maremask.sum()
 		print "matchModelToData:\tCreating shelve:", self.matchedShelve
 
-	try:
-		if self.clean: assert 0	
-		s = shOpen(self.matchesShelve)		
-		lldict  = s['lldict']
-		s.close()
-	except:
-		lldict={}
-	finds = 0	
-	
-	#####
-	# Figure out which type of data this is.
-	#self.ytype = []
-	#Models = [m.upper() for m in ['Diat-HadOCC', 'ERSEM','HadOCC', 'MEDUSA','PlankTOM6','PlankTOM10','NEMO','IMARNET','CMIP5',]] # skip these to find in situ data types.
-	#Models.extend(['IMARNET_' +m.upper() for m in ['Diat-HadOCC', 'ERSEM','HadOCC', 'MEDUSA','PlankTOM6','PlankTOM10','NEMO',]])	
-	#Models.extend(['CMIP5_' +m.upper() for m in CMIP5models])		
-	#for key in mt.keys():
-	#	#key = key.upper()
-	#	if key.upper() in Models:continue
-	#	try:
-	#		if self.dataType in mt[key].keys() and key not in self.ytype:
-	#			self.ytype.append(key)
-	#	except:pass
-
 	#####
 	# Check if there is any data left to match. 
 	# This makes it easier to stop and start the longer analyses.
@@ -455,168 +437,100 @@ class matchDataAndModel:
 		ncIS.close()
 		print "matchModelToData:\tNo need to do further matches, Finsished with ",maxIndex+1,"\tfinished:",len(self.matches)
 		return 		
-		
-	#if maxIndex+1 <len(is_i):
-	zdict={}
-	tdict={}
-  	is_t		= ncIS.variables[self.datacoords['t']][:]
-  	is_index_t	= ncIS.variables['index_t'][:]  	
-  	
-	if self.datacoords['z']  in ['', None,"''"]:  	pass		# No Depth in data file.
-	else:  	is_z 	= ncIS.variables[self.datacoords['z']][:]
-  	is_la	= ncIS.variables[self.datacoords['lat']][:]
-	is_lo 	= bvp.makeLonSafeArr(ncIS.variables[self.datacoords['lon']][:])
+
+  	is_t		= ncIS.variables[self.datacoords['t']][maxIndex:]
+  	is_index_t	= ncIS.variables['index_t'][maxIndex:]  	
+	if self.datacoords['z']  in ['', None,"''"]:  	
+		is_z 	= np.zeros(len(is_t))		# No Depth in data file.
+	else:  	is_z 	= ncIS.variables[self.datacoords['z']][maxIndex:]
+  	is_la	= ncIS.variables[self.datacoords['lat']][maxIndex:]
+	is_lo 	= ncIS.variables[self.datacoords['lon']][maxIndex:]
 
 	tdict   = self.datacoords['tdict']
 	if is_index_t.min() == is_index_t.max():
-		#tdict[is_index_t.min()] = is_t.min()
-		print is_t.min() #, tdict[is_t.min()]
-		#if np.ma.is_masked(is_t.min()): pass
-		#else:
+		print is_t.min() 
 		tdict[is_t.min()]	= is_index_t.min()
-		
-	#tdict   = {i:i for i in xrange(12)}
 	ncIS.close()	     
-
-
 	print "tdict:", tdict
-	#####
-	# This list could be removed by adding a check dimensionality of data after it was been pruned.	
-	#flatDataOnly =  ['pCO2','seawifs','Seawifs','mld_DT02', 'mld_DR003','mld_DReqDTm02','mld',
-	#		  'dms_and','dms_ara','dms_hal','dms_sim',]
-	#for d in ['dms_p_and','dms_p_ara','dms_p_hal','dms_p_sim',]:
-	#  for i in ['','1','2']:
-	#	flatDataOnly.append(d+i)
-		
-	#if self.dataType in flatDataOnly: 
-  	#   	is_z 	= np.ma.zeros(len(is_t))[:]
-	#   	zdict = {0:0, 0.:0}  
 
 	if not self._meshLoaded_:self.loadMesh()
-	    
-	for i,ii in enumerate(is_i[maxIndex:]):
-		i+=maxIndex
-		wt  = is_t[i]
-		wt_index  = is_index_t[i]
-		try:	wz  = is_z[i]
-		except:	wz = 0
-		wla = is_la[i]
-		wlo = is_lo[i] 
-
-		#####		
-		# Match Latitude and Longitude
-		try:
-			la,lo = lldict[(wla,wlo)]
-		except:
-			la,lo = self.getOrcaIndexCC(wla,wlo,i=i,debug=False)
-			if la == lo == -1:
-				print "STRICT ERROR: Could not find, ",wla,wlo
-				continue
-			lldict[(wla,wlo)] = la,lo
-			finds+=1
-
-			if self.debug and i%10000==0:
-			    print "matchModelToData:\t",i,'New match:\tlon:',[wlo,self.loncc[la,lo]],'\tlat:',[wla,self.latcc[la,lo]],[finds,len(lldict)]
-
-			if abs(self.latcc[la,lo] - wla)>90.: 
-			    print "Come again? this should never happen:",self.latcc[la,lo],  wla
-			    print "matchModelToData:\t",i,'New match:\tlon:',[wlo,self.loncc[la,lo]],'\tlat:',[wla,self.latcc[la,lo]],[finds,len(lldict)]
-			    assert False
-			    
-		#####
-		#Match Depth
-		try:
-			z = zdict[wz]
-		except:	 
-			z = bvp.getORCAdepth(wz,self.depthcc,debug=True)
-			zdict[wz]	= z
-			if self.debug: print "matchModelToData:\t",i, 'Found new depth:',wz,'m-->',self.depthcc[z], ['z=',z]
-
-		#####			
-		#Match Time	
-		try: 
-			t = tdict[wt_index]
-		except:
-			try:
-				t = tdict[wt]	
-			except:
-				print "matchModelToData:\tunable to find time match in longnames, mt[",self.dataType,"]['tdict']", wt
-				print "tdict:",tdict
-				assert False 
-			
-				t = getMonthFromSecs(wt)
-				tdict[wt] = t
-				if self.debug:	print "matchModelToData:\t",i, 'Found new month:', wt, '-->',t
-
-		#####
-		# Add match into array
-		try:
-			tmp = self.matches[(t,z,la,lo)][0]
-			self.matches[(t,z,la,lo)].append(i)
-			self.imatches[i] = (t,z,la,lo)
-			self.maremask[i] = tmp
-			#if self.debug: print "matchModelToData:\tWARNING:",i,[wt,wz,wla,wlo], '-->',(t,z,la,lo),'already matched', self.matches[(t,z,la,lo)]
-				#for a in self.matches[(t,z,la,lo)]:
-					#print '\t',i, a, self.imatches[a]
-		except:
-			# if this location in the model grid (t,z,la,lo) has not yet been found,
-			# self.matches gets a list of all the in situ points that match that location.
-			# Conversely, self.maremask's i-th value location of the first time it was found.
-			self.matches[(t,z,la,lo)]=[i,]
-			self.imatches[i] = (t,z,la,lo)			
-			self.maremask[i] = i
-			#if self.debug: print "matchModelToData:\tfirst match:",i,[wt,wz,wla,wlo], '-->',(t,z,la,lo)
-		
-		#####
-		# test match up:
-		fail=0
-		if abs(wz-self.depthcc[z]) >500.:
-			print 'depth DOESNT MATCH:',wz,self.depthcc(z)
-			fail+=1
-		# These tests are already done in getOrcaIndexCC. No need to be done twice.
-		#if abs(wla-self.latcc[la,lo]) >2.:
-		#	print 'Latitude DOESNT MATCH:',wla, self.latcc[la,lo]
-		#	fail+=1		
-		#if abs(wlo-self.loncc[la,lo]) >2.:
-		#	print 'Longitude DOESNT MATCH:',wlo,self.loncc[la,lo]
-		#	fail+=1						
-		if fail>0:assert False
-		
-		
-		#####			
-		#increment by 1 to save/ end, as it has finished, but i is used as a starting point.
-		i+=1
-		if i%10000==0:
-			if self.debug: print "matchModelToData:\t", i,ii,self.dataType,self.layer,':\t',[wt,wz,wla,wlo] ,'--->',[t,z,la,lo]
-			
-		if i>1 and i%50000000==0:
-			if self.debug: print "matchModelToData:\tSaving Shelve: ", self.matchedShelve
-			s = shOpen(self.matchedShelve)
-			s['matches']  = self.matches
-			s['maxIndex'] = i
-			s['maremask'] = self.maremask	
-			s['imatches']  = self.imatches
-			s.close()
-			s = shOpen(self.matchesShelve)		
-			s['lldict'] = lldict 
-			s.close()				
-	maxIndex = i
-	#assert False
+	points = np.arange(maxIndex, len(is_i))
+	
+	#####		
+	# Match Latitude and Longitude
+	la,lo = self.nearest.query(is_la, is_lo)
+	found = (la > -1) * (lo > -1)
+	if not found.all():
+		print "STRICT ERROR: Could not find", (~found).sum(), "points, ie:", is_la[~found][:5], is_lo[~found][:5]
+	points, la, lo, is_z, is_t, is_index_t = points[found], la[found], lo[found], is_z[found], is_t[found], is_index_t[found]
+	
+	#####
+	# Match Depth
+	z = matchDepths(is_z, self.depthcc)
+	
+	#####
+	# test match up:
+	depthcc = np.array(self.depthcc).squeeze()
+	if depthcc.ndim == 0: depthcc = depthcc.reshape(1)
+	depthFail = np.ma.filled(np.ma.abs(is_z - depthcc[z]) > 500., False)
+	if depthFail.any():
+		raise AssertionError("matchModelToData:\tdepth DOESNT MATCH: "+str(is_z[depthFail][:5])+' '+str(depthcc[z[depthFail]][:5]))
+	
+	#####			
+	# Match Time	
+	t = matchTimes(is_index_t, is_t, tdict)
+	
+	#####
+	# Add matches.
+	self.addMatches(points, t, z, la, lo)
+	maxIndex = len(is_i)
+	if self.debug and len(points): 
+		print "matchModelToData:\t", points[-1], self.dataType,self.layer,':\t',[is_t[-1],is_z[-1],is_la[found][-1],is_lo[found][-1]] ,'--->',[t[-1],z[-1],la[-1],lo[-1]]
 		
 	print "matchDataAndModel:\tSaving Shelve", self.matchedShelve	
 	s = shOpen(self.matchedShelve)
 	s['matches']  = self.matches
 	s['imatches']  = self.imatches	
-	s['maxIndex'] = i
+	s['maxIndex'] = maxIndex
 	s['maremask'] = self.maremask
 	s.close()
-	    
-	s = shOpen(self.matchesShelve)		
-	s['lldict'] = lldict 
-	s.close()
-	print "matchModelToData:\tFinsished with ",maxIndex+1,"\tfinished:",len(self.matches) #, "Mask:",self.maremask.sum()
+	print "matchModelToData:\tFinsished with ",maxIndex,"\tfinished:",len(self.matches) 
+
+  def addMatches(self, points, t, z, la, lo):
+	"""
+	Groups the in situ points by model grid cell (t,z,la,lo).
+	self.matches gets a list of all the in situ points that match each location,
+	self.imatches gets the location of each point,
+	and self.maremask's i-th value is the first point that was found in the same location.
+	"""
+	if not len(points): return
+	keys = np.column_stack([t,z,la,lo]).astype(np.int64)
 	
+	#####
+	# Pack the four indices into a single integer, and group them.
+	offset = keys.min(axis=0)
+	dims = keys.max(axis=0) - offset + 1
+	packed = np.ravel_multi_index(tuple((keys - offset).T), tuple(dims))
+	unique, first, inverse = np.unique(packed, return_index=True, return_inverse=True)
+	
+	groupKeys = [tuple(k) for k in keys[first].tolist()]
+	firstPoint = points[first]
+	order = np.argsort(inverse, kind='mergesort') 	# stable, so points stay in order within each group.
+	sortedPoints = points[order].tolist()
+	bounds = np.concatenate([[0,], np.cumsum(np.bincount(inverse))]).tolist()
+	
+	for g, key in enumerate(groupKeys):
+		group = sortedPoints[bounds[g]:bounds[g+1]]
+		if key in self.matches:
+			# This location was already matched in a previous run.
+			firstPoint[g] = self.matches[key][0]
+			self.matches[key].extend(group)
+		else:
+			self.matches[key] = group
 	
+	self.imatches.update(zip(points.tolist(), [groupKeys[g] for g in inverse]))
+	self.maremask[points] = firstPoint[inverse]
+
   def _convertModelToOneD_(self,):
 	if not bvp.shouldIMakeFile(self.ModelFilePruned,self.Model1D,debug=True):
 		print "convertModelToOneD:\tconvertModelToOneD:\talready exists:",self.Model1D
@@ -738,38 +652,22 @@ class matchDataAndModel:
 		self.loncc,self.latcc = np.meshgrid(self.loncc,self.latcc)
 			
 	ncER.close()
+	
+	#####
+	# Nearest grid cell index, built once per grid file.
+	self.nearest = loadNearestIndex(self.gridFile, lat = self.modelcoords['lat'], lon = self.modelcoords['lon'], debug = self.debug)
  	print "matchModelToData:\tloaded mesh.", self.grid, 'lat:',self.latcc.shape, 'lon:',self.loncc.shape,'depth:',self.depthcc.shape
 	self._meshLoaded_ = 1
 	
   def getOrcaIndexCC(self,lat,lon,debug=True,slowMethod=False,i=''):#llrange=5.):
-	""" takes a lat and long coordinate, an returns the position of the closest coordinate in the NemoERSEM grid.
-	    uses the bathymetry file.
+	""" takes a lat and long coordinate, an returns the position of the closest coordinate in the model grid.
+	    uses the nearest grid cell index of the grid file.
 	"""
-	km = 10.E20
-	la_ind, lo_ind = -1,-1
-	latrangeCutoff=2.
-	lonrangeCutoff=5.
-	lat = bvp.makeLatSafe(lat)
-	lon = bvp.makeLonSafe(lon)	
-	
 	if not self._meshLoaded_:self.loadMesh()
-	#if abs(lat) <70.:
-	c = (self.latcc - lat)**2 + (self.loncc - lon)**2
-	#else:   c =  myhaversineArr(lon,lat,self.loncc,self.latcc)
-		
-
-	(la_ind,lo_ind) =  np.unravel_index(c.argmin(),c.shape)
+	
+	(la_ind,lo_ind) = self.nearest.query(lat,lon)
 
-	#km2 = abs(haversine((lon, lat), (locc,lacc)))
 	if debug: print 'location ', [la_ind,lo_ind],'(',self.latcc[la_ind,lo_ind],self.loncc[la_ind,lo_ind],') is closest to:',[lat,lon]
-	"""if abs(self.latcc[la_ind,lo_ind] -lat ) > latrangeCutoff or abs(self.loncc[la_ind,lo_ind] -lon ) > lonrangeCutoff:
-		d = myhaversine(self.loncc[la_ind,lo_ind],self.latcc[la_ind,lo_ind],lon,lat)
-		print "getOrcaIndexCC:\t",i,"\tERROR:\tDISTANCE IS VERY FAR:",[self.latcc[la_ind,lo_ind],'-->',  lat,], [self.loncc[la_ind,lo_ind], '-->', lon],'distance:',d
-		if d>350.:
-			print "getOrcaIndexCC:\t",i,"\tdistance too great:",d, 
-			#assert False
-			return -1,-1
-	"""	
 	return la_ind,lo_ind
 		
 
@@ -778,6 +676,67 @@ class matchDataAndModel:
 
 
 	
+#########################################
+# Vectorised matching of depth and time:
+def matchDepths(depths, depthcc):
+	"""
+	The index of the closest model depth to each in situ depth.
+	This gives the same result as bvp.getORCAdepth for each point: 
+	the first closest depth, or -1 if the point is masked or no depth is within 1000m.
+	"""
+	depthcc = np.abs(np.array(depthcc, dtype=np.float64).squeeze())
+	if depthcc.ndim == 0: depthcc = depthcc.reshape(1)
+	depths = np.ma.array(depths, dtype=np.float64)
+	absz = np.abs(np.ma.filled(depths, np.nan))
+	if len(depthcc) == 1: return np.zeros(len(absz), dtype=np.int64)
+
+	out = np.zeros(len(absz), dtype=np.int64) - 1
+	valid = np.isfinite(absz)
+	if not valid.any(): return out
+	
+	if (np.diff(depthcc) > 0.).all():
+		#####
+		# Sorted depths: look at the neighbours either side of each point. 
+		# Ties go to the shallower one, as in getORCAdepth.
+		right = np.clip(np.searchsorted(depthcc, absz[valid]), 0, len(depthcc)-1)
+		left  = np.clip(right - 1, 0, len(depthcc)-1)
+		useLeft = np.abs(absz[valid] - depthcc[left]) <= np.abs(absz[valid] - depthcc[right])
+		best = np.where(useLeft, left, right)
+	else:
+		#####
+		# Unsorted depths: compare every unique depth with every model depth.
+		uniq, inverse = np.unique(absz[valid], return_inverse=True)
+		best = np.abs(uniq[:,None] - depthcc[None,:]).argmin(axis=1)[inverse]
+	distance = np.abs(absz[valid] - depthcc[best])
+	out[valid] = np.where(distance < 1000., best, -1)
+	return out
+	
+def matchTimes(index_t, times, tdict):
+	"""
+	The model time index of each in situ point, from the time dictionary.
+	As in the original loop, the index_t of each point is looked up first, then the time itself.
+	"""
+	out = np.zeros(len(index_t), dtype=np.int64)
+	unmatched = np.ones(len(index_t), dtype=bool)
+	
+	for arr in [index_t, times]:
+		arr = np.ma.array(arr)
+		valid = unmatched * ~np.ma.getmaskarray(arr)
+		if not valid.any(): continue
+		uniq, inverse = np.unique(np.ma.getdata(arr)[valid], return_inverse=True)
+		inDict = np.array([u in tdict for u in uniq], dtype=bool)
+		mapped = np.array([tdict.get(u, 0) for u in uniq], dtype=np.int64)
+		where = np.flatnonzero(valid)[inDict[inverse]]
+		out[where] = mapped[inverse][inDict[inverse]]
+		unmatched[where] = False
+		
+	if unmatched.any():
+		print "matchModelToData:\tunable to find time match in longnames, mt[",np.ma.array(times)[unmatched][:5],"]['tdict']"
+		print "tdict:",tdict
+		raise AssertionError("matchModelToData:\tunable to find time match for "+str(unmatched.sum())+" points.")
+	return out
+	
+	
 #########################################
 # Coords and Depth:
 def myhaversine(lon1, lat1, lon2, lat2):
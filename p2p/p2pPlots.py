@@ -44,17 +44,16 @@ import cartopy
 
 from calendar import month_name
 from itertools import product
-from scipy.stats import linregress
 from scipy.stats.mstats import scoreatpercentile
 import numpy as np 
 
 #local imports
-import bgcvaltools.unbiasedSymmetricMetrics as usm
-from bgcvaltools.StatsDiagram import StatsDiagram
-from bgcvaltools.robust import StatsDiagram as robustStatsDiagram
 from bgcvaltools import bgcvalpython as bvp 
-from regions.makeMask import makeMask,loadMaskMakers
+from bgcvaltools.renderQueue import renderQueue
+from regions.makeMask import makeMask,makeCachedMask,loadMaskMakers,coordinateHash
 from p2p.slicesDict import populateSlicesList, slicesDict
+from p2p.slicePoints import getPointsFn, savePointsFile, packPoints
+from p2p.sliceStatistics import sliceStatistics, subsetSorter
 from longnames.longnames import getLongName, fancyUnits,titleify # getmt
 from functions.stdfunctions import extractData
 
@@ -1118,7 +1117,8 @@ class makePlots:
   		compareCoords	= True,  		
   		noPlots		= False,
 		clean		= False,  		
-  		dpi = 100): #xfilename,yfilename,saveShelve=True,
+  		dpi = 100,
+  		nproc = 1,): #xfilename,yfilename,saveShelve=True,
 
 	""" This is the class that loads all the information and sends it to the plotting tools, above."""
   
@@ -1147,6 +1147,7 @@ class makePlots:
   	self.datacoords 	= datacoords
   	self.datadetails 	= datadetails
   	self.dpi 		= dpi
+  	self.nproc		= nproc
   	
   	self.newSlices, self.maskingfunctions	= loadMaskMakers(regions = self.newSlices)
 
@@ -1174,8 +1175,11 @@ class makePlots:
 	if self.compareCoords: self.CompareCoords()
 	#self.defineSlices(self.plotallcuts)
 	
-	
+	#####
+	# The plots are rendered on a pool of nproc processes, while the next slice is loaded.
+	self.renderQueue = renderQueue(nproc = self.nproc)
 	self.plotWithSlices()
+	self.renderQueue.wait()
 
   	self.xnc.close()
   	self.ync.close()  	
@@ -1287,21 +1291,108 @@ class makePlots:
 	self.yy = np.ma.array(self.ync.variables[self.datacoords['lat']][:])
 	self.xx = bvp.makeLonSafeArr(np.ma.array(self.xnc.variables[self.modelcoords['lon']][:]))
 	self.yx = bvp.makeLonSafeArr(np.ma.array(self.ync.variables[self.datacoords['lon']][:]))
+	self.xhash = coordinateHash(self.xy,self.xx)
+	self.yhash = coordinateHash(self.yy,self.yx)
+	self.pointsSaved = []
 	
-	for newSlice in self.newSlices:	
+	for xkey,ykey in product(xkeys,ykeys):
+		#####
+		# Don't make Plots for transects with two spacial cuts.
+		#if self.layer.lower().find('transect') >-1 and newSlice not in transectSlices: continue	
+		slices = [newSlice for newSlice in self.newSlices if self.shouldMakeSlice(newSlice,xkey,ykey)]
+		if len(slices)==0: continue
+		
+		#####
+		# The matched model and data are loaded once, and the masks of all the slices 
+		# are built together as a boolean matrix, with one row per slice.
+		xd, yd = self.loadMatchedData(xkey,ykey)
+		masks = self.sliceMasks(slices, xd, yd)
+		
+		#####
+		# The model and data are sorted once, and each slice reuses this sort 
+		# for its median, IQR and rank statistics.
+		xorder = np.argsort(np.ma.getdata(xd))
+		yorder = np.argsort(np.ma.getdata(yd))
+		
+		for newSlice,mask in zip(slices,masks):
+			print "plotWithSlices:\t", newSlice, xkey,ykey
+			self.plotsFromKeys(newSlice,xkey,ykey,xd=xd,yd=yd,mask=mask,xorder=xorder,yorder=yorder)
 
-	    #####
-	    # Don't make Plots for transects with two spacial cuts.
-	    #if self.layer.lower().find('transect') >-1 and newSlice not in transectSlices: continue	
-	    
-	    for xkey,ykey in product(xkeys,ykeys):
-	    	print "plotWithSlices:\t", newSlice, xkey,ykey
-		self.plotsFromKeys(newSlice,xkey,ykey)
+
+  def shouldMakeSlice(self,newSlice,xkey,ykey):
+	"""
+	Returns True if the plot or the shelve of this slice need to be made.
+	"""
+	if type(newSlice) in [type(['a','b',]),type(('a','b',))]:	
+		ns = ''.join(newSlice)
+	else: ns = newSlice
+	shelveName = self.shelveDir +self.name+'_'+ns+'_'+xkey+'vs'+ykey+'.shelve'
+	filename = self.plotname([newSlice,])
+	if bvp.shouldIMakeFile([self.xfn,self.yfn],shelveName,debug=False): return True
+	if bvp.shouldIMakeFile([self.xfn,self.yfn],filename,debug=False): return True
+	return False
+
+
+  def loadMatchedData(self,xkey,ykey):
+	"""
+	Extracts the model and data values from the matched files (already know lat,lon,time,depth).
+	The model and data values of all the points are saved once per run, 
+	and each slice shelve only holds the index of its points.
+	"""
+	xd = extractData(self.xnc,self.modeldetails,) 
+	yd = extractData(self.ync,self.datadetails, ) 
+	pointsFn = getPointsFn(self.shelveDir,self.name,xkey,ykey)
+	if pointsFn not in self.pointsSaved:
+		savePointsFile(pointsFn, xd, yd)
+		self.pointsSaved.append(pointsFn)
+	return xd, yd
 
 
+  def sliceCuts(self,newSlice):
+	"""
+	Returns the list of slices that are combined to make newSlice.
+	"""
+	if type(newSlice) in [type(['a',]),type(('a',))]:    	# newSlice is actaully a list of multiple slices.
+		return list(newSlice)
+	if newSlice == 'Standard':				# Standard is a shorthand for my favourite cuts.
+		cuts = []
+	  	for stanSlice in slicesDict['StandardCuts']: 
+			if self.name in ['tempSurface','tempTransect', 'tempAll'] and stanSlice in ['aboveZero',]:continue 
+			cuts.append(stanSlice)
+		return cuts
+	return [newSlice,]	# newSlice is a simple slice.
 
-  def plotsFromKeys(self,newSlice,xkey,ykey):	     
 
+  def sliceMasks(self,slices,xd,yd):
+	"""
+	Returns a boolean matrix, with one row per slice, which is True where a point is masked in that slice.
+	The points that are masked or not finite in either field are masked in every slice.
+	"""
+	baseMask = np.ma.getmaskarray(xd) | np.ma.getmaskarray(yd) 
+	baseMask |= ~np.isfinite(np.ma.getdata(xd)) | ~np.isfinite(np.ma.getdata(yd))
+        if self.name in ['mld','mld_DT02','mld_DR003','mld_DReqDTm02']:
+        	mldMask = self.ync.variables['mask'][:]
+        	baseMask |= np.ma.getmaskarray(np.ma.masked_where(mldMask==0.,mldMask))
+        	
+	masks = np.zeros((len(slices),len(baseMask)),dtype=bool)
+	for i,newSlice in enumerate(slices):
+		masks[i] = baseMask
+		for cut in self.sliceCuts(newSlice):
+	  		xmask = makeCachedMask(self.maskingfunctions,self.name,cut,self.xt,self.xz,self.xy,self.xx,xd,gridHash=self.xhash)
+	  		ymask = makeCachedMask(self.maskingfunctions,self.name,cut,self.yt,self.yz,self.yy,self.yx,yd,gridHash=self.yhash)
+	  		masks[i] |= np.ma.filled(np.ma.array(xmask).astype(bool), True)
+	  		masks[i] |= np.ma.filled(np.ma.array(ymask).astype(bool), True)
+		print 'plotWithSlices:\t',newSlice, masks[i].sum()
+	return masks
+	
+
+
+  def plotsFromKeys(self,newSlice,xkey,ykey,xd=None,yd=None,mask=None,xorder=None,yorder=None):	     
+	"""
+	Makes the plots and the shelve of one slice.
+	The matched data, the slice mask and the sorts of the data can be passed in by plotWithSlices, 
+	so that they are only made once per run. Otherwise, they are made here.
+	"""
 	#####
 	# check that the plot and shelve should be made 
 	if type(newSlice) in [type(['a','b',]),type(('a','b',))]:	
@@ -1311,46 +1402,20 @@ class makePlots:
  	#filename = self.getFileName(newSlice,xkey,ykey)
  	filename = self.plotname([newSlice,])
 	print "plotWithSlices:\tINFO:\tinvestigating:",(newSlice), filename
-	if not bvp.shouldIMakeFile([self.xfn,self.yfn],self.shelveName,debug=False) \
-		and not bvp.shouldIMakeFile([self.xfn,self.yfn],filename,debug=False): return
-	
+	if not self.shouldMakeSlice(newSlice,xkey,ykey): return
 	
 	#####
-	# Extract remaining data (already know lat,lon,time,depth)
-	xd = extractData(self.xnc,self.modeldetails,) 
-	yd = extractData(self.ync,self.datadetails, ) 
- 
-	
-	#####
-	# Build mask
-	fullmask = xd.mask.astype(int) + yd.mask.astype(int) + np.ma.masked_invalid(xd).mask.astype(int) + np.ma.masked_invalid(yd).mask.astype(int)
-	
-	if type(newSlice) in [type(['a',]),type(('a',))]:    	# newSlice is actaully a list of multiple slices.
-	   	for n in newSlice:
-	  		fullmask += makeMask(self.maskingfunctions,self.name,n,self.xt,self.xz,self.xy,self.xx,xd).astype(int)	  
-		  	fullmask += makeMask(self.maskingfunctions,self.name,n,self.yt,self.yz,self.yy,self.yx,yd).astype(int)	  
-		  	
-	elif newSlice == 'Standard':				# Standard is a shorthand for my favourite cuts.
-	  	for stanSlice in slicesDict['StandardCuts']: 
-			if self.name in ['tempSurface','tempTransect', 'tempAll'] and stanSlice in ['aboveZero',]:continue 
-				    						
-	  		fullmask += makeMask(self.maskingfunctions,self.name,stanSlice,self.xt,self.xz,self.xy,self.xx,xd).astype(int)
-	  	 	fullmask += makeMask(self.maskingfunctions,self.name,stanSlice,self.yt,self.yz,self.yy,self.yx,yd).astype(int)	
-	  	 	
-	else:  	# newSlice is a simple slice.
-	  	fullmask += makeMask(self.maskingfunctions,self.name,newSlice,self.xt,self.xz,self.xy,self.xx,xd).astype(int)
-	  	fullmask += makeMask(self.maskingfunctions, self.name,newSlice,self.yt,self.yz,self.yy,self.yx,yd).astype(int)
-	  	print 'plotWithSlices:\t',fullmask.sum()
-
-	  
-        if self.name in ['mld','mld_DT02','mld_DR003','mld_DReqDTm02']:
-        	mldMask = self.ync.variables['mask'][:]
-        	fullmask += np.ma.masked_where(mldMask==0.,mldMask).mask        
-	  
+	# Extract remaining data and build mask
+	if xd is None or yd is None:
+		xd, yd = self.loadMatchedData(xkey,ykey)
+		xorder, yorder = None, None
+	if mask is None: mask = self.sliceMasks([newSlice,],xd,yd)[0]
+	pointsFn = getPointsFn(self.shelveDir,self.name,xkey,ykey)
+	fullmask = mask
 	
 	N = len(self.xt)			
 
-	maskcoverpc = 100.*np.clip(fullmask,0,1).sum()/float(N)
+	maskcoverpc = 100.*fullmask.sum()/float(N)
 	if maskcoverpc==100.:
 		print "plotWithSlices:\tNew Mask,",newSlice,", covers entire dataset.",maskcoverpc,'%', N
 		try:	self.shelves[newSlice][xk][yk] = ''
@@ -1441,7 +1506,7 @@ class makePlots:
 			else:	
 				doLog=True
 			print "plotWithSlices:\tROBIN QUAD:",[ti1,ti2],False,dmin,dmax
-			robinPlotQuad(nmxx, nmxy, 
+			self.renderQueue.plot(robinPlotQuad, nmxx, nmxy, 
 					datax,
 					datay,
 					robfnquad,
@@ -1467,7 +1532,7 @@ class makePlots:
 			else:	
 				doLog=True
                         print "plotWithSlices:\tPlate Carre quad:",[ti1,ti2],False,dmin,dmax
-			robinPlotQuad(nmxx, nmxy, 
+			self.renderQueue.plot(robinPlotQuad, nmxx, nmxy, 
 					datax,
 					datay,
 					platecquad,
@@ -1495,7 +1560,7 @@ class makePlots:
 				doLog=True
 			print "plotWithSlices:\tROBIN QUAD:",[ti1,ti2],False,dmin,dmax
 			try:
-				robinPlotQuad(nmxx, nmxy, 
+				self.renderQueue.plot(robinPlotQuad, nmxx, nmxy, 
 					datax,
 					datay,
 					robfncartopy,
@@ -1522,7 +1587,7 @@ class makePlots:
 				doLog=True
 			print "plotWithSlices:\ttransect quad:",[ti1,ti2],False,dmin,dmax
 			if self.layer in ['ArcTransect','AntTransect','CanRusTransect',]:
-				ArcticTransectPlotQuad(nmxx,nmxy, nmxz, 
+				self.renderQueue.plot(ArcticTransectPlotQuad, nmxx,nmxy, nmxz, 
 					datax,
 					datay,
 					transectquadfn,
@@ -1537,7 +1602,7 @@ class makePlots:
 					transectName  	= self.layer,
 					)			
 			else:
-				HovPlotQuad(nmxx,nmxy, nmxz, 
+				self.renderQueue.plot(HovPlotQuad, nmxx,nmxy, nmxz, 
 					datax,
 					datay,
 					transectquadfn,
@@ -1566,8 +1631,8 @@ class makePlots:
 				histxaxis = 'DMS, '+ xunits
 				
 			if self.name in noXYLogs or dmin*dmax <=0.:				
-				histPlot(datax, datay,  histfnxy, Title=histtitle, labelx=labelx,labely=labely,dpi=self.dpi,xaxislabel =histxaxis)	
-			else:	histPlot(datax, datay,  histfnxy, Title=histtitle, labelx=labelx,labely=labely,dpi=self.dpi,xaxislabel =histxaxis, logx = True, )
+				self.renderQueue.plot(histPlot, datax, datay,  histfnxy, Title=histtitle, labelx=labelx,labely=labely,dpi=self.dpi,xaxislabel =histxaxis)	
+			else:	self.renderQueue.plot(histPlot, datax, datay,  histfnxy, Title=histtitle, labelx=labelx,labely=labely,dpi=self.dpi,xaxislabel =histxaxis, logx = True, )
 
 		# Simultaneous histograms plot	- triple
 		#if bvp.shouldIMakeFile([self.xfn,self.yfn],histsfnxy,debug=False):
@@ -1592,55 +1657,32 @@ class makePlots:
 				pass
 			
 			if self.name in noXYLogs or dmin*dmax <=0.:
-				scatterPlot(datax, datay,  scatterfn, Title=scattitle, labelx=slabelx,labely=slabely,dpi=self.dpi, bestfitLine=True,gridsize=gs)
-			else:	scatterPlot(datax, datay,  scatterfn, Title=scattitle, labelx=slabelx,labely=slabely,dpi=self.dpi, bestfitLine=True,gridsize=gs,logx = True, logy=True,)
+				self.renderQueue.plot(scatterPlot, datax, datay,  scatterfn, Title=scattitle, labelx=slabelx,labely=slabely,dpi=self.dpi, bestfitLine=True,gridsize=gs)
+			else:	self.renderQueue.plot(scatterPlot, datax, datay,  scatterfn, Title=scattitle, labelx=slabelx,labely=slabely,dpi=self.dpi, bestfitLine=True,gridsize=gs,logx = True, logy=True,)
 
 	#####
 	# Save fit in a shelve file.		
 	s = shOpen(self.shelveName)
 	print "plotWithSlices:\tSaving ",self.shelveName	
-	b1, b0, rValue, pValue, stdErr = linregress(datax, datay)
-	print "plotWithSlices:\tlinear regression: \n\tb1:",b1, "\n\tb0:", b0, "\n\trValue:",rValue, "\n\tpValue:",pValue, "\n\tstdErr:",stdErr
-	s['b1'] 	=  b1
-	s['b0'] 	=  b0
-	s['rValue'] 	=  rValue
-	s['pValue'] 	=  pValue
-	s['stdErr'] 	=  stdErr						
-	s['N'] 	    	=  len(datax)
-					
-  	mtaylor = StatsDiagram(datax,datay)
-	s['Taylor.E0'] 	= mtaylor.E0
-	s['Taylor.E']	= mtaylor.E
-	s['Taylor.R']	= mtaylor.R
-	s['Taylor.p']	= mtaylor.p							
-	s['Taylor.gamma']=mtaylor.gamma
-
-
-	s['MNAFE'] = usm.MNAFE(datax,datay)
-	s['MNFB' ] = usm.MNFB( datax,datay)
-	s['NMAEF'] = usm.NMAEF(datax,datay)
-	s['NMBF' ] = usm.NMBF( datax,datay)	
-			
-				
-	mrobust = robustStatsDiagram(datax,datay,0.01)
+	#####
+	# The sorts of the slice are taken from the sorts of the full data, when they are known.
+	keep = ~fullmask
+	xsorter, ysorter = None, None
+	if xorder is not None and yorder is not None:
+		xsorter = subsetSorter(xorder, keep)
+		ysorter = subsetSorter(yorder, keep)
 	print "makePlots.py:\tWARNING: robustStatsDiagram CALCULATED WITH DEFAULT PRECISION (0.01)"
-	s['robust.E0'] 	= mrobust.E0
-	s['robust.E']	= mrobust.E
-	s['robust.R']	= mrobust.R
-	s['robust.p']	= mrobust.p							
-	s['robust.gamma']=mrobust.gamma	
+	stats = sliceStatistics(datax,datay,0.01,xsorter=xsorter,ysorter=ysorter)
+	for key,value in stats.items(): s[key] = value
 		
-	s['datax'] = datax
-	s['datay'] = datay
-
-	s['x_lon'] = nmxx
-	s['x_lat'] = nmxy
-	s['x_depth'] = nmxz
-	s['x_time'] = nmxt			
-	s['y_lon'] = nmyx
-	s['y_lat'] = nmyy
-	s['y_depth'] = nmyz
-	s['y_time'] = nmyt					
+	#####
+	# The points of the slice are saved as an index or a bitmap into the matched files. 
+	# The datax, datay, x_lon, etc fields are rebuilt from the points file 
+	# and the matched netcdfs by slicePoints.loadSliceField.
+	for key,value in packPoints(keep).items(): s[key] = value
+	s['pointsFile'] = pointsFn
+	s['xcoords'] = {k:self.modelcoords[k] for k in ['t','z','lat','lon']}
+	s['ycoords'] = {k:self.datacoords[k]  for k in ['t','z','lat','lon']}
 			
 	s['title'] = 	title
 	s['labelx'] = 	labelx
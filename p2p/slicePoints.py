@@ -0,0 +1,140 @@
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license. 
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: slicePoints
+   :platform: Unix
+   :synopsis: Compact storage of the matched points in each p2p slice shelve.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+import os
+import numpy as np
+from netCDF4 import Dataset
+
+from bgcvaltools import bgcvalpython as bvp 
+
+#####
+# The point fields of a slice, as they were saved in the slice shelves by p2pPlots.
+# The x fields come from the matched model file, and the y fields from the matched data file.
+pointKeys = ['datax', 'datay', 'x_lon', 'x_lat', 'x_depth', 'x_time', 'y_lon', 'y_lat', 'y_depth', 'y_time',]
+coordKeys = {'lon':'lon', 'lat':'lat', 'depth':'z', 'time':'t',}
+
+def getPointsFn(shelveDir, name, xkey, ykey):
+	"""
+	The name of the file that holds the model and data values of all the matched points,
+	which are shared by all the slices.
+	"""
+	return shelveDir+name+'_'+xkey+'vs'+ykey+'_points.npz'
+
+def savePointsFile(fn, xd, yd):
+	"""
+	:param fn: The points file name, from getPointsFn.
+	:param xd: The model values of all the matched points, as returned by extractData.
+	:param yd: The data values of all the matched points.
+	
+	Saves the values of all the points once, via a temporary file, so that parallel jobs don't read a partial file.
+	The masked points are never part of a slice, so the mask is not saved.
+	"""
+	tmpfn = fn.replace('.npz','_'+str(os.getpid())+'.tmp.npz')
+	np.savez(tmpfn, datax = np.ma.getdata(xd), datay = np.ma.getdata(yd))
+	os.rename(tmpfn, fn)
+
+def packPoints(keep):
+	"""
+	:param keep: A boolean array, True for the points in the slice.
+	
+	Returns a dictionairy to save in the shelve, with the points of the slice either as
+	an index array or, if more than 1 in 32 points are in the slice, as a packed bitmap.
+	"""
+	keep = np.asarray(keep, dtype=bool).ravel()
+	count = int(keep.sum())
+	if count*32 < len(keep):	return {'pointIndex': np.flatnonzero(keep).astype(np.int32), 'pointTotal': len(keep)}
+	return {'pointBits': np.packbits(keep), 'pointTotal': len(keep)}
+
+def unpackPoints(sh):
+	"""
+	Returns the index array of the points of a slice, from the shelve.
+	"""
+	if 'pointIndex' in sh: return np.asarray(sh['pointIndex'], dtype=np.int64)
+	keep = np.unpackbits(sh['pointBits'])[:sh['pointTotal']].astype(bool)
+	return np.flatnonzero(keep)
+
+
+#####
+# The points files and matched netcdf fields that were already loaded by this process.
+loadedFields = {}
+
+def loadPointsField(fn, key):
+	"""
+	Loads a field from a points file, (datax or datay), and keeps it in memory.
+	"""
+	cacheKey = (fn, os.path.getmtime(fn), key)
+	if cacheKey not in loadedFields:
+		npz = np.load(fn)
+		loadedFields[cacheKey] = npz[key]
+		npz.close()
+	return loadedFields[cacheKey]
+	
+def loadCoordField(fn, coords, key):
+	"""
+	Loads a coordinate field from a matched netcdf, in the same way as p2pPlots.makePlots, and keeps it in memory.
+	"""
+	cacheKey = (fn, os.path.getmtime(fn), key)
+	if cacheKey in loadedFields: return loadedFields[cacheKey]
+	nc = Dataset(fn,'r')
+	if key == 'z':
+		try:	arr = np.ma.array(nc.variables[coords['z']][:])
+		except:	arr = np.zeros_like(np.ma.array(nc.variables[coords['t']][:]))
+	else:	arr = np.ma.array(nc.variables[coords[key]][:])
+	nc.close()
+	if key == 'lon': arr = bvp.makeLonSafeArr(arr)
+	loadedFields[cacheKey] = arr
+	return arr
+
+def loadSliceField(sh, key):
+	"""
+	:param sh: An open slice shelve, made by p2pPlots.
+	:param key: One of the pointKeys, ie: 'datax' or 'x_lat'.
+	
+	Returns the field for the points of the slice.
+	Old shelves hold a copy of each field, new shelves only hold the points of the slice,
+	and the fields are rebuilt from the points file and the matched netcdfs.
+	"""
+	if key in sh: return sh[key]
+	if key not in pointKeys:
+		raise AssertionError("slicePoints.py:\tloadSliceField:\tNot a point field: "+str(key))
+	index = unpackPoints(sh)
+	if key in ['datax','datay',]:
+		return loadPointsField(sh['pointsFile'], key)[index]
+	
+	xy, coord = key.split('_')
+	if xy == 'x':	fn, coords = sh['xfn'], sh['xcoords']
+	else:		fn, coords = sh['yfn'], sh['ycoords']
+	return loadCoordField(fn, coords, coordKeys[coord])[index].compressed()
+
+def loadSlicePoints(sh, keys = pointKeys):
+	"""
+	Returns a dictionairy of the fields for the points of the slice (see loadSliceField).
+	"""
+	return {key: loadSliceField(sh, key) for key in keys}
@@ -0,0 +1,169 @@
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license. 
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: sliceStatistics
+   :platform: Unix
+   :synopsis: The statistics that are saved in each p2p slice shelve, calculated with one sort per field.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+import numpy as np
+from scipy.stats import linregress, distributions
+
+#local imports
+import bgcvaltools.unbiasedSymmetricMetrics as usm
+from bgcvaltools.StatsDiagram import StatsDiagram
+from bgcvaltools.robust import StatsDiagram as robustStatsDiagram
+from bgcvaltools.RobustStatistics import MAE
+
+
+def sortedQuantiles(x, prob, alphap=.4, betap=.4):
+	"""
+	:param x: A sorted 1D array.
+	:param prob: A list of quantiles.
+	
+	The same as scipy.stats.mstats.mquantiles, with the default plotting positions,
+	but the data is already sorted.
+	"""
+	n = len(x)
+	p = np.array(prob, copy=False, ndmin=1)
+	m = alphap + p*(1.-alphap-betap)
+	aleph = (n*p + m)
+	k = np.floor(aleph.clip(1, n-1)).astype(int)
+	gamma = (aleph-k).clip(0,1)
+	return (1.-gamma)*x[(k-1).tolist()] + gamma*x[k.tolist()]
+
+def sortedIQR(x):
+	"""
+	The inter quartile range of a sorted array, the same as RobustStatistics.IQR.
+	"""
+	q25,q75 = sortedQuantiles(x, [.25,.75])
+	return q75-q25
+
+def averageRanks(x, sorter):
+	"""
+	:param x: A 1D array.
+	:param sorter: The argsort of x.
+	
+	The ranks of x, with ties given the average rank, the same as scipy.stats.rankdata.
+	"""
+	inv = np.empty(sorter.size, dtype=np.intp)
+	inv[sorter] = np.arange(sorter.size, dtype=np.intp)
+	arr = x[sorter]
+	obs = np.r_[True, arr[1:] != arr[:-1]]
+	dense = obs.cumsum()[inv]
+	count = np.r_[np.nonzero(obs)[0], len(obs)]
+	return .5 * (count[dense] + count[dense - 1] + 1)
+	
+def spearmanFromRanks(xranks, yranks):
+	"""
+	The Spearman rank correlation and p-value, the same as scipy.stats.spearmanr, from the ranks.
+	"""
+	rs = np.corrcoef(np.column_stack((xranks, yranks)), rowvar=0)
+	dof = len(xranks) - 2
+	olderr = np.seterr(divide='ignore')
+	try:	t = rs * np.sqrt((dof/((rs+1.0)*(1.0-rs))).clip(0))
+	finally:np.seterr(**olderr)
+	prob = 2 * distributions.t.sf(np.abs(t), dof)
+	return rs[1,0], prob[1,0]
+	
+def subsetSorter(order, keep):
+	"""
+	:param order: The argsort of a full array.
+	:param keep: A boolean array, True for the points in the subset.
+	
+	Returns the argsort of the subset, full[keep], without sorting it again.
+	"""
+	local = np.cumsum(keep) - 1
+	return local[order[keep[order]]]
+	
+def robustStatistics(data, refdata, precision, datSorter=None, refSorter=None):
+	"""
+	:param data: The model values of the slice.
+	:param refdata: The data values of the slice.
+	:param precision: The precision of the reference data (see robust.StatsDiagram).
+	:param datSorter, refSorter: The argsorts of data and refdata, if they are already known.
+	
+	Returns the E0, E, R, p and gamma of robust.StatsDiagram.
+	Each field is sorted once, and the sort is used for both the IQR and the Spearman ranks.
+	"""
+	dat = np.array(data).ravel()
+	ref = np.array(refdata).ravel()
+	if len(dat) < 2 or np.isnan(dat).any() or np.isnan(ref).any():
+		mrobust = robustStatsDiagram(data,refdata,precision)
+		return mrobust.E0, mrobust.E, mrobust.R, mrobust.p, mrobust.gamma
+		
+	if datSorter is None: datSorter = np.argsort(dat)
+	if refSorter is None: refSorter = np.argsort(ref)
+	scale = sortedIQR(ref[refSorter])
+	if scale<precision:
+		print "Reference scale lesser than measurment precision!"
+		scale = precision
+		print "\treplaced by precision",precision
+	bias = np.median(dat-ref)
+	E0 = bias/scale
+	gamma = sortedIQR(dat[datSorter])/scale
+	R, p = spearmanFromRanks(averageRanks(dat, datSorter), averageRanks(ref, refSorter))
+	E = MAE(data-bias,ref)/scale
+	return E0, E, R, p, gamma
+	
+def sliceStatistics(datax, datay, precision = 0.01, xsorter=None, ysorter=None):
+	"""
+	:param datax: The model values of the slice.
+	:param datay: The data values of the slice.
+	:param xsorter, ysorter: The argsorts of datax and datay (see subsetSorter).
+	
+	Returns a dictionairy of all the statistics that p2pPlots saves in the slice shelve:
+	the linear regression, the Taylor and robust diagram metrics and the unbiased symmetric metrics.
+	"""
+	stats = {}
+	b1, b0, rValue, pValue, stdErr = linregress(datax, datay)
+	print "sliceStatistics:\tlinear regression: \n\tb1:",b1, "\n\tb0:", b0, "\n\trValue:",rValue, "\n\tpValue:",pValue, "\n\tstdErr:",stdErr
+	stats['b1'] 	=  b1
+	stats['b0'] 	=  b0
+	stats['rValue'] =  rValue
+	stats['pValue'] =  pValue
+	stats['stdErr'] =  stdErr						
+	stats['N'] 	=  len(datax)
+
+	mtaylor = StatsDiagram(datax,datay)
+	stats['Taylor.E0'] 	= mtaylor.E0
+	stats['Taylor.E']	= mtaylor.E
+	stats['Taylor.R']	= mtaylor.R
+	stats['Taylor.p']	= mtaylor.p							
+	stats['Taylor.gamma']	= mtaylor.gamma
+
+	stats['MNAFE'] = usm.MNAFE(datax,datay)
+	stats['MNFB' ] = usm.MNFB( datax,datay)
+	stats['NMAEF'] = usm.NMAEF(datax,datay)
+	stats['NMBF' ] = usm.NMBF( datax,datay)	
+
+	E0, E, R, p, gamma = robustStatistics(datax,datay,precision,datSorter=xsorter,refSorter=ysorter)
+	print "sliceStatistics:\trobust: \n\tE0:",E0, "\n\tE:", E, "\n\tR:",R, "\n\tp:",p, "\n\tgamma:",gamma
+	stats['robust.E0'] 	= E0
+	stats['robust.E']	= E
+	stats['robust.R']	= R
+	stats['robust.p']	= p
+	stats['robust.gamma']	= gamma
+	return stats
@@ -34,6 +34,7 @@ from calendar import month_name
 
 #Specific local code:
 from bgcvaltools import bgcvalpython as bvp
+from bgcvaltools.timeIndex import timeIndex, getTimeIndexFn
 from bgcvaltools.dataset import dataset
 from p2p import matchDataAndModel,makePlots,makeTargets, makePatternStatsPlots
 from p2p.slicesDict import populateSlicesList, slicesDict
@@ -66,6 +67,7 @@ def testsuite_p2p(
 			noPlots 	= False,
 			noTargets 	= False,
 			clean 		= False,
+			nproc		= 1,
 			):
 
 	"""
@@ -119,6 +121,9 @@ def testsuite_p2p(
 	    	noPlots is a boolean value to turn off the production of images.
 	    	This can streamline the analysis routine, if plots are not needed.
 	    	
+	    nproc:
+	    	nproc is the number of processes used to render the plots.
+	    	
 	Returns:
 		shelvesAV:
 		another AutoVivification with the following structure:
@@ -173,20 +178,11 @@ def testsuite_p2p(
 		    yr = float(year)
 		    if float(year) == int(year): yr = yr + 0.55
 		    
-		    for fn in modelFiles:
-		    
-			nc = dataset(fn,'r')
-			ts = bvp.getTimes(nc,modelcoords)
+		    #####
+		    # The time index is used to find the files within a year of yr, without opening every file.
+		    index = timeIndex(getTimeIndexFn(modelFiles), modelcoords)
+		    for fn in index.filesInRange(modelFiles, yr-1., yr+1.):
 			# assert False	#i don't think that this is correct #please think about it some more.
-			if ts.max()+1 < yr:
-				print "p2p:\t File outside time range",yr,':',[int(ts.min()),'->',int(ts.max())]
-				nc.close()
-				continue
-			if ts.min()-1 > yr:
-				print "p2p:\t File outside time range",yr,':',[int(ts.min()),'->',int(ts.max())]		
-				nc.close()
-				continue
-                        print "p2p:\t File  inside time range",yr,':',[int(ts.min()),'->',int(ts.max())], "Found it!"
 			print "Found p2p file:",fn
 			modelFile = fn
 			found+=1
@@ -289,6 +285,7 @@ def testsuite_p2p(
 					compareCoords	= True,
 					noPlots		= noPlots,
 					clean		= clean,
+					nproc		= nproc,
 				     )
 
 			#shelvesAV[model][name][layer] = m.shelvesAV
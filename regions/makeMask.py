@@ -29,12 +29,13 @@
 """
 import numpy as np
 import os, inspect
+import hashlib
 from calendar import month_name
 from glob import glob
 
 from bgcvaltools import bgcvalpython as bvp
 from bgcvaltools.dataset import dataset
-from bgcvaltools.configparser import AnalysisKeyParser, GlobalSectionParser
+from bgcvaltools.configparser import AnalysisKeyParser, GlobalSectionParser, loadGlobalSectionParser
 
 package_directory = os.path.dirname(os.path.abspath(__file__))
 
@@ -421,6 +422,24 @@ std_maskers['AMJ'] 		= AMJ
 std_maskers['JAS'] 		= JAS
 std_maskers['OND'] 		= OND
 
+#####
+# Spatial masks only depend on the latitude and longitude, so they can be evaluated once per grid 
+# and cached (see loadCachedMask below). Time, depth and data dependent masks are always evaluated live.
+# Custom masks can be added to this list by setting the attribute: myRegion.spatial = True
+spatialMaskers = [	NorthHemisphere, SouthHemisphere, Tropics, Equatorial, Temperate,
+			NorthTropics, SouthTropics, NorthTemperate, SouthTemperate,
+			AtlanticTransect, PacificTransect, tenN, tenS, SouthernTransect,
+			Arctic, Antarctic, NorthArctic, SouthernOcean, AntarcticOcean,
+			ignoreArtics, ignoreMidArtics, ignoreMoreArtics, ignoreExtraArtics,
+			NorthAtlanticOcean, SouthAtlanticOcean, EquatorialAtlanticOcean,
+			ArcticOcean, NorthernSubpolarAtlantic, NordicSea, LabradorSea, NorwegianSea,
+			YevgenyNordicSea, YevgenyLabradorSea, YevgenyNorwegianSea,
+			NorthernSubpolarPacific, Remainder, Equator10, NorthPacificOcean,
+			EquatorialPacificOcean, SouthPacificOcean, CCI_JJA, CCI_DJF,
+			BlackSea, ignoreBlackSea, BalticSea, ignoreBalticSea, RedSea, ignoreRedSea,
+			PersianGulf, ignorePersianGulf, ignoreCaspian, ignoreMediteranean,
+			ignoreInlandSeas, IndianOcean,]
+
 #####
 # Add lower case, upper, Title, etc...
 std_maskers = bvp.altSpellingDict(std_maskers)
@@ -477,9 +496,9 @@ def loadMaskMakersConfig(configfile = ''):
 	#####
 	# First, make a list of all possible regions requested.
 	maskingfunctions = []
-	globalKeys =  GlobalSectionParser(configfile)
+	globalKeys =  loadGlobalSectionParser(configfile)
 	for key in globalKeys.ActiveKeys:
-		akp = AnalysisKeyParser(configfile, key, debug=True)
+		akp = globalKeys.AnalysisKeyParser[(globalKeys.models[0],globalKeys.jobIDs[0],globalKeys.years[0],globalKeys.scenarios[0],key)]
 		maskingfunctions.extend(akp.regions)
 	
 	#####
@@ -558,11 +577,115 @@ def makeMask(maskingfunctions, name,region, xt,xz,xy,xx,xd,debug=False):
 	"""	
 	if debug:print "makeMask:\tmakeMask:\tinitialise:\t",name, '\t',"\""+region+"\""
 	return maskingfunctions[region](name,region, xt,xz,xy,xx,xd,debug=debug)
-  	
-
 
 
 
+#####
+# Region mask cache.
+# The masks are stored in memory and on disk as packed bitsets, keyed by the hash of the 
+# coordinates, the region name and the hash of the masking function code.
+maskCacheDir = 'shelves/regionMasks/'
+loadedMasks = {}
 
+def isSpatialMask(maskingfunction):
+	"""
+	:param maskingfunction: A function from the std_maskers dict.
+	
+	Returns True if the mask only depends on latitude and longitude.
+	"""
+	if getattr(maskingfunction, 'spatial', False): return True
+	return maskingfunction in spatialMaskers
 
+def coordinateHash(xy,xx):
+	"""
+	:param xy: An array of latitudes, either a 2D grid or a 1D array of points.
+	:param xx: An array of longitudes, the same shape as xy.
 	
+	Produces a hash of the coordinates, so that masks can be reused by any file on the same grid.
+	"""
+	md5 = hashlib.md5()
+	for a in [xy,xx]:
+		a = np.ma.array(a)
+		md5.update(str(a.shape))
+		md5.update(np.ascontiguousarray(np.ma.getdata(a),dtype=np.float64).tostring())
+		md5.update(np.ascontiguousarray(np.ma.getmaskarray(a)).tostring())
+	return md5.hexdigest()
+
+def maskerHash(maskingfunction):
+	"""
+	Produces a short hash of the masking function code, so that the cache is rebuilt if the region definition changes.
+	"""
+	code = maskingfunction.__code__
+	md5 = hashlib.md5()
+	md5.update(code.co_code)
+	for const in code.co_consts:
+		if hasattr(const, 'co_code'):	md5.update(const.co_code)
+		else:				md5.update(repr(const))
+	md5.update(repr(code.co_names))
+	return md5.hexdigest()[:8]
+
+def getMaskCacheFn(gridHash,region,maskingfunction):
+	return maskCacheDir+gridHash+'_'+region+'_'+maskerHash(maskingfunction)+'.npz'
+
+def loadCachedMask(maskingfunctions,name,region,xy,xx,gridHash='',debug=False):
+	"""
+	:param maskingfunctions: The dictionairy of masking functions, from loadMaskMakers.
+	:param name: The name of the data. (useful for debugging)
+	:param region: The name of a spatial region.
+	:param xy: The latitude, either a 2D grid or a 1D array of points.
+	:param xx: The longitude, in the range +/-180, and the same shape as xy.
+	:param gridHash: The coordinateHash of xy and xx, if it is already known.
+
+	Returns the boolean mask of region, with the same shape as xy. 
+	The mask is evaluated once per set of coordinates, then reused from memory or disk. 
+	Unlike makeMask, the mask of the data is not included.
+	"""
+	maskingfunction = maskingfunctions[region]
+	if not isSpatialMask(maskingfunction):
+		raise AssertionError("makeMask.py:\tloadCachedMask:\tRegion is not a spatial mask: "+str(region))
+
+	if gridHash == '': gridHash = coordinateHash(xy,xx)
+	fn = getMaskCacheFn(gridHash,region,maskingfunction)
+	if fn in loadedMasks: return loadedMasks[fn]
+
+	if os.path.exists(fn):
+		try:
+			npz = np.load(fn)
+			shape = tuple(npz['shape'])
+			mask = np.unpackbits(npz['bits'])[:int(np.prod(shape))].reshape(shape).astype(bool)
+			npz.close()
+			if debug: print "makeMask.py:\tloadCachedMask:\tLoaded",region,'from',fn
+			loadedMasks[fn] = mask
+			return mask
+		except: print "makeMask.py:\tloadCachedMask:\tUnable to load",fn,", remaking it."
+
+	#####
+	# Evaluate the region once on the flattened coordinates.
+	# The longitude is copied, as some masks call makeLonSafeArr, which works in place.
+	shape = np.shape(xy)
+	flatxy = np.ma.array(xy).ravel()
+	flatxx = np.ma.array(xx,copy=True).ravel()
+	zeros = np.ma.zeros(flatxy.shape)
+	mask = makeMask(maskingfunctions,name,region,zeros,zeros,flatxy,flatxx,zeros,debug=debug)
+	mask = (np.zeros(flatxy.shape,dtype=bool) + np.asarray(mask,dtype=bool)).reshape(shape)
+	loadedMasks[fn] = mask
+
+	#####
+	# Save as a packed bitset, via a temporary file, so that parallel jobs don't read a partial file.
+	try:
+		bvp.folder(maskCacheDir)
+		tmpfn = fn.replace('.npz','_'+str(os.getpid())+'.tmp.npz')
+		np.savez(tmpfn, bits=np.packbits(mask.ravel()), shape=np.array(shape))
+		os.rename(tmpfn,fn)
+		if debug: print "makeMask.py:\tloadCachedMask:\tSaved",region,'to',fn
+	except:	print "makeMask.py:\tloadCachedMask:\tUnable to save",fn
+	return mask
+
+def makeCachedMask(maskingfunctions, name,region, xt,xz,xy,xx,xd,gridHash='',debug=False):
+	"""
+	The same as makeMask, except that spatial regions are loaded with loadCachedMask.
+	The mask of the data is not included for spatial regions, so the caller needs to apply it.
+	"""
+	if isSpatialMask(maskingfunctions[region]):
+		return loadCachedMask(maskingfunctions,name,region,xy,xx,gridHash=gridHash,debug=debug)
+	return makeMask(maskingfunctions, name,region, xt,xz,xy,xx,xd,debug=debug)
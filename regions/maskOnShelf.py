@@ -32,52 +32,28 @@ from bgcvaltools.dataset import dataset
 import numpy as np
 import os
 from bgcvaltools import bgcvalpython as bvp
+from bgcvaltools.nearestIndex import loadNearestIndex
 
 package_directory = os.path.dirname(os.path.abspath(__file__))
 
-bathync = dataset(package_directory+"/../data/ORCA1bathy.nc")
+bathyFn = package_directory+"/../data/ORCA1bathy.nc"
+bathync = dataset(bathyFn)
 bathy = np.ma.abs(bathync.variables["bathymetry"][:])
-latcc, loncc =  bathync.variables["lat"][:], bathync.variables["lon"][:]	
 bathync.close()
 		
 def maskOnShelf(name,newSlice, xt,xz,xy,xx,xd,debug=False): 	
 	shelfDepth=500.
-	shelveFn = bvp.folder("shelves/MatchingMasks/")+"shelfmask.shelve"
-	try:
-		s = shOpen(shelveFn)		
-		lldict  = s['lldict']
-		s.close()
-	except:	lldict={}
-	nmask = np.zeros_like(xd)
 	
-	count = 0
-	for i,z in enumerate(xz):
-			try:
-				la,lo = lldict[(xy[i],xx[i])]
-			except:
-				la,lo = bvp.getOrcaIndexCC(xy[i],xx[i],latcc,loncc,debug=False)
-				lldict[(xy[i],xx[i])] = la,lo
-			
-			if la==lo==-1:
-				print "Corner case:", la,lo,bathy[la,lo] 
-				nmask[i]=1
-				
-			if  bathy[la,lo] <= shelfDepth: nmask[i]=1	
-			count+=1
-			if count%100000==0:# or i==(len(xz)+1):
-			    try:
-				s = shOpen(shelveFn)		
-				s['lldict'] = lldict 
-				s.close()
-				count=0
-			    except:
-			    	print "makeMask:\tWARNING:\tUnable to save lldict at this time"
-	try:
-		s = shOpen(shelveFn)		
-		s['lldict'] = lldict 
-		s.close()
-   	except:
-   	 	print "makeMask:\tWARNING:\tUnable to save lldict at this time"
+	#####
+	# Find the closest bathymetry cell to every point at once.
+	la,lo = loadNearestIndex(bathyFn, lat = 'lat', lon = 'lon', debug=debug).query(xy, xx)
+	
+	nmask = np.zeros_like(xd)
+	if (la==-1).any():
+		print "Corner case:", (la==-1).sum(), 'points'
+		nmask[la==-1]=1
+	onShelf = np.ma.filled(bathy[la,lo] <= shelfDepth, False) * (la!=-1)
+	nmask[onShelf]=1	
    	 	
 	print "maskOnShelf:", newSlice, nmask.sum(), 'of', len(nmask)
-	return nmask	
+	return nmask
@@ -43,6 +43,12 @@ if __name__=="__main__":
 		configfn = 'runconfig.ini'
 		print "run.py:\tNo config file provided, using default: ", configfn
 
+	#####
+	# Optional number of processes, overrides the nproc option in the [Global] section.
+	try:	nproc = int(argv[2])
+	except:	nproc = None
+
 	analysis_parser(
 		configfile= configfn,
+		nproc	= nproc,
 		)
@@ -37,6 +37,7 @@ from sys import argv,exit
 import os
 import numpy as np
 from longnames.longnames import getLongName
+from timeseries.resultStore import loadModelData, getStoreFilename
 
 def printableName(field,region, layer, metric):
 	#####
@@ -66,19 +67,11 @@ def analysis_level0(jobID='',field= "AMOC_26N",region='regionless', layer='layer
 	#####
 	# Start and load shelve
 	if debug:print 'analysis_level0:',jobID,field,region, layer, metric
-	shelvefn = shelvedir+"/timeseries/"+jobID+"/"+jobID+"_"+field+".shelve"
-
-	if debug:print 'analysis_level0:',shelvefn, os.path.exists(shelvefn)
-	if not os.path.exists(shelvefn):
-		print "This shelve fn doesn't exists",shelvefn
-		return name, False,False
-	try:
-		s = shopen(shelvefn)
-		modeldata = s['modeldata']
-		readFiles = s['readFiles']
-		s.close()
-	except:
-		print "This shelve fn doesn't work properly",shelvefn
+	workingDir = shelvedir+"/timeseries/"+jobID+"/"
+	modeldata = loadModelData(workingDir, jobID, field, keys = [(region, layer, metric),])
+	if debug:print 'analysis_level0:',getStoreFilename(workingDir, jobID, field), modeldata is not None
+	if modeldata is None:
+		print "This result store doesn't exist or doesn't work properly",getStoreFilename(workingDir, jobID, field)
 		return name, False,False
 
 	#####
@@ -40,9 +40,11 @@ import numpy as np
 #####	
 # Load specific local code:
 from bgcvaltools import bgcvalpython as bvp
+from bgcvaltools.renderQueue import renderQueue
 from longnames.longnames import getLongName, fancyUnits,titleify 
 from timeseries import timeseriesPlots as tsp 
-from bgcvaltools.configparser import GlobalSectionParser
+from timeseries.resultStore import loadModelData, getStoreFilename
+from bgcvaltools.configparser import GlobalSectionParser, loadGlobalSectionParser
 
 
 #colourList = ['green','blue','red','orange','purple','black',]
@@ -74,7 +76,7 @@ def makeCSV(configfile):
 	
 	#####
 	# open config file.	
-	globalkeys =  GlobalSectionParser(configfile)	
+	globalkeys =  loadGlobalSectionParser(configfile)	
 	
 	#####
 	# This looping forces the report to match the order.
@@ -100,19 +102,11 @@ def makeCSV(configfile):
 		akp = globalkeys.AnalysisKeyParser[(model,jobID,globalkeys.years[0],scenario,key)]
 		if akp.makeCSV == False: continue		
  	    	#if not akp.makeTS: continue 
-	  	shelvefn 		= bvp.folder(akp.postproc_ts)+'_'.join([akp.jobID,akp.name,])+'.shelve'
-
 		regions.update({r:True for r in akp.regions})
 		layers.update({r:True for r in akp.layers})
-		print "comparisonAnalysis:\topening: ",shelvefn
-		sh = shopen(shelvefn)
-		print sh.keys()
-		try:
-			modeldataD = sh['modeldata']
-			sh.close()			
-		except:	
-			sh.close()
-			continue
+		print "comparisonAnalysis:\topening: ",getStoreFilename(akp.postproc_ts, akp.jobID, akp.name)
+		modeldataD = loadModelData(akp.postproc_ts, akp.jobID, akp.name, keys = list(product(akp.regions, akp.layers, ['mean' , 'metricless',])))
+		if modeldataD is None: continue
 		data[(key,model,scenario, jobID)] = modeldataD
 		print "Loaded", (key,model,scenario, jobID)		
 
@@ -299,7 +293,7 @@ def comparisonAnalysis(configfile, writeCSV=True):
 
 	#####
 	# open config file.	
-	globalkeys =  GlobalSectionParser(configfile)	
+	globalkeys =  loadGlobalSectionParser(configfile)	
 	
 	#####
 	# This looping forces the report to match the order.
@@ -327,19 +321,11 @@ def comparisonAnalysis(configfile, writeCSV=True):
 		akp = globalkeys.AnalysisKeyParser[(model,jobID,globalkeys.years[0],scenario,key)]
 		
  	    	if not akp.makeTS: continue 
-	  	shelvefn 		= bvp.folder(akp.postproc_ts)+'_'.join([akp.jobID,akp.name,])+'.shelve'
-
 		regions.update({r:True for r in akp.regions})
 		layers.update({r:True for r in akp.layers})
-		print "comparisonAnalysis:\topening: ",shelvefn
-		sh = shopen(shelvefn)
-		print sh.keys()
-		try:
-			modeldataD = sh['modeldata']
-			sh.close()			
-		except:	
-			sh.close()
-			continue
+		print "comparisonAnalysis:\topening: ",getStoreFilename(akp.postproc_ts, akp.jobID, akp.name)
+		modeldataD = loadModelData(akp.postproc_ts, akp.jobID, akp.name, keys = list(product(akp.regions, akp.layers, ['mean' , 'metricless','median',])))
+		if modeldataD is None: continue
 		data[(key,model,scenario, jobID)] = modeldataD
 		print "Loaded", (key,model,scenario, jobID)		
 
@@ -354,6 +340,11 @@ def comparisonAnalysis(configfile, writeCSV=True):
 	linestyles = ['DataOnly','movingav1year','movingav5years',]
 	
 	colourList = tsp.cmipcolours
+	
+	#####
+	# The plots are rendered on a pool of processes.
+	queue = renderQueue(nproc = globalkeys.nproc)
+	
 	#####
 	# Make the plots, comparing differnet jobIDs
 	if leadmetric=='jobID' and len(jobIDs)>1:
@@ -395,9 +386,12 @@ def comparisonAnalysis(configfile, writeCSV=True):
 				title = titleify([model, scenario, region, layer, metric, key])	
 				filename =  bvp.folder(globalkeys.images_comp)+'_'.join([model, scenario, region, layer, metric, key,linestyle])+'.png'
 		
-				tsp.multitimeseries(
+				fingerprint = bvp.plotFingerprint('multitimeseries',timesD,arrD,datarange,datatimes,datasource,title,units,linestyle,colours)
+				if not bvp.shouldIMakePlot(filename,fingerprint,debug=False):continue
+				queue.submit(tsp.multitimeseries, (
 					timesD, 		# model times (in floats)
 					arrD,			# model time series
+					), dict(
 					data 		= datarange,		# in situ data distribution
 					datatimes	= datatimes,		# in situ time range
                                         datasource      = datasource,           # in situ data source
@@ -407,7 +401,7 @@ def comparisonAnalysis(configfile, writeCSV=True):
 					plotStyle 	= 'Together',
 					lineStyle	= linestyle,
 					colours		= colours,
-				)
+					), fingerprint = fingerprint)
 			
 	#####
 	# Make the plots, comparing differnet models
@@ -449,9 +443,12 @@ def comparisonAnalysis(configfile, writeCSV=True):
 				title = titleify([scenario,jobID, region, layer, metric, key])
 				filename =  bvp.folder(globalkeys.images_comp)+'_'.join([ scenario, jobID, region, layer, metric, key,linestyle])+'.png'
 					
-				tsp.multitimeseries(
+				fingerprint = bvp.plotFingerprint('multitimeseries',timesD,arrD,datarange,datatimes,datasource,title,units,linestyle,colours)
+				if not bvp.shouldIMakePlot(filename,fingerprint,debug=False):continue
+				queue.submit(tsp.multitimeseries, (
 					timesD, 		# model times (in floats)
 					arrD,			# model time series
+					), dict(
 					data 		= datarange,		# in situ data distribution
                                         datatimes       = datatimes,
 					datasource	= datasource,
@@ -461,7 +458,7 @@ def comparisonAnalysis(configfile, writeCSV=True):
 					plotStyle 	= 'Together',
 					lineStyle	= linestyle,
 					colours		= colours,
-				)			
+					), fingerprint = fingerprint)
 
 	#####
 	# Make the plots, comparing differnet scenarios
@@ -505,9 +502,12 @@ def comparisonAnalysis(configfile, writeCSV=True):
 				title = titleify([model, jobID, region, layer, metric, key])	
 				filename =  bvp.folder(globalkeys.images_comp)+'_'.join([model, jobID, region, layer, metric, key,linestyle])+'.png'
 		
-				tsp.multitimeseries(
+				fingerprint = bvp.plotFingerprint('multitimeseries',timesD,arrD,datarange,datatimes,datasource,title,units,linestyle,colours)
+				if not bvp.shouldIMakePlot(filename,fingerprint,debug=False):continue
+				queue.submit(tsp.multitimeseries, (
 					timesD, 		# model times (in floats)
 					arrD,			# model time series
+					), dict(
 					data 		= datarange,		# in situ data distribution
                                         datatimes       = datatimes,		# in situ time range
                                         datasource      = datasource,		# in situ data source
@@ -517,6 +517,9 @@ def comparisonAnalysis(configfile, writeCSV=True):
 					plotStyle 	= 'Together',
 					lineStyle	= linestyle,
 					colours		= colours,
-				)
-			
-			
+					), fingerprint = fingerprint)
+				
+	#####
+	# Wait for all the plots to be rendered.
+	queue.wait()
+	
@@ -547,9 +547,11 @@ class extentMaps:
 		    	print "Interinnual extended map already exists:", interannualExtendfilename	    	
 	    		continue
 	    			    	
-	    	realdata = dataDL.load[(r,l,)]
-	    	reallat = dataDL.load[(r,l,'lat')]
-	    	reallon = dataDL.load[(r,l,'lon')]
+	    	#####
+	    	# Only the points inside the region are used, (see tst.regionPointCache.regionPoints).
+	    	realdata = dataDL.load.regionPoints(r,l).astype(np.float64)
+	    	reallat = dataDL.load.regionPoints(r,l,'lat').astype(np.float64)
+	    	reallon = dataDL.load.regionPoints(r,l,'lon').astype(np.float64)
 		
 		transects = {'Equator':0.,'10 N':10., '10 S':-10.,'Atlantic28W':-28., 'Pacific135W':-135., 'all':0.}
 		for transect in transects.keys():
@@ -581,27 +583,26 @@ class extentMaps:
 				meantime = int(np.mean(ts))
 				print "\tmodel have one time step:",meantime
 		
-		    		modelTimes = modelDL.load[(r,l,'t')]
+		    		modelTimes = modelDL.load.regionPoints(r,l,'t')
 		    		print modelTimes.min(), modelTimes.max(), bvp.getTimes(nc,self.modelcoords)
 		    		
 		    		
-				modeldata[meantime] = modelDL.load[(r,l)]
-				modellat[meantime] = modelDL.load[(r,l,'lat')]
-				modellon[meantime] = modelDL.load[(r,l,'lon')]
+				modeldata[meantime] = modelDL.load.regionPoints(r,l).astype(np.float64)
+				modellat[meantime] = modelDL.load.regionPoints(r,l,'lat').astype(np.float64)
+				modellon[meantime] = modelDL.load.regionPoints(r,l,'lon').astype(np.float64)
 
 			else:
 				#####
 				# For models with more than one time step per file.
 				print "times: (models with more than one time step per file.)",ts
-				tsmodeldat 	= modelDL.load[(r,l)]
-			    	tsmodellat	= modelDL.load[(r,l,'lat')]
-			    	tsmodellon	= modelDL.load[(r,l,'lon')]
-			    	tsmodeltime	= modelDL.load[(r,l,'t')]			    	
+				tsmodeldat 	= modelDL.load.regionPoints(r,l).astype(np.float64)
+			    	tsmodellat	= modelDL.load.regionPoints(r,l,'lat').astype(np.float64)
+			    	tsmodellon	= modelDL.load.regionPoints(r,l,'lon').astype(np.float64)
+			    	tsmodeltime	= modelDL.load.regionPoints(r,l,'t')
 			    	for t,meantime in enumerate(ts):
-			    	
-					modeldata[meantime] = np.ma.masked_where(tsmodeltime != t, tsmodeldat).compressed()
-					modellat[meantime] = np.ma.masked_where(tsmodeltime != t, tsmodellat).compressed()
-					modellon[meantime] = np.ma.masked_where(tsmodeltime != t, tsmodellon).compressed()										
+					modeldata[meantime] = tsmodeldat[tsmodeltime == t]
+					modellat[meantime] = tsmodellat[tsmodeltime == t]
+					modellon[meantime] = tsmodellon[tsmodeltime == t]
 			nc.close()
 				
 	    		for mesh in [1,]:
@@ -41,6 +41,7 @@ import timeseriesTools as tst
 import timeseriesPlots as tsp 
 from bgcvaltools.makeMaskNC import makeMaskNC
 from bgcvaltools.dataset import dataset
+from bgcvaltools.timeIndex import timeIndex, getTimeIndexFn
 from longnames.longnames import getLongName
 from functions.stdfunctions import extractData
 
@@ -68,6 +69,7 @@ class profileAnalysis:
 		clean		= True,
 		debug		= True,
 		strictFileCheck = False,
+		pointCacheDir	= '',		# folder for memory mapped point tables, ('': in memory).
 		):
 		
 	#####
@@ -96,6 +98,7 @@ class profileAnalysis:
   	self.imageDir 		= imageDir
 	self.debug		= debug
 	self.clean		= clean
+	self.pointCacheDir	= pointCacheDir
 
 	self.timerange		= np.array([float(t) for t in sorted(timerange)]) 	
 	
@@ -230,8 +233,12 @@ class profileAnalysis:
 	###############
 	# Load files, and calculate fields.
 	openedFiles = 0					
-	for fn in self.modelFiles:
-		if fn in readFiles:continue
+	
+	#####
+	# Skip the files outside the time range, using the time index instead of opening every file.
+	index = timeIndex(getTimeIndexFn(self.modelFiles), self.modelcoords, debug = self.debug)
+	newFiles = index.filesInRange([fn for fn in self.modelFiles if fn not in readFiles], self.timerange[0], self.timerange[1])
+	for fn in newFiles:
 		
 		if not self._masksLoaded_: 
 			self.loadMasks()		
@@ -255,51 +262,28 @@ class profileAnalysis:
 		nc = dataset(fn,'r')
 		dataAll = extractData(nc,self.modeldetails).squeeze()
 		
-		for r in self.regions:
+		#####
+		# Calculate the profiles of every region, time and metric at once.
+		if len(ts) == 1 or dataAll.ndim == 3: dataAll = dataAll.reshape((1,)+dataAll.shape)
+		profiles = self.profileEngine.calculate(dataAll, self.metrics)
+		
+		for ri,r in enumerate(self.regions):
 		  for m in self.metrics:
-		    	if m =='mean':		  
-		  	    if len(ts) == 1:
-				#####
-				# One time step per file.
-				
-				data = bvp.mameanaxis(np.ma.masked_where((self.modelMasks[r] != 1) + dataAll.mask,dataAll), axis=(1,2))
-				
-				if self.debug: print "profileAnalysis:\tloadModel.",r,m,self.dataType,'\tyear:',int(meantimes), 'mean:',data.mean(),data.shape
-				#if self.debug:print "profileAnalysis:\tloadModel.",self.dataType, data.shape, data.min(),data.max(), dataAll.shape ,self.modelMasks[r].shape, dataAll.min(),dataAll.max()
+			for t, meantime in enumerate(ts):
+				if len(ts) == 1: meantime = meantimes
+				data = profiles[m][ri,t]
+				if self.debug: print "profileAnalysis:\tloadModel.",r,m,self.dataType,'\tyear:',int(meantime), m+':',data.mean(),data.shape
 				alllayers = []
 				for l,d in enumerate(data):
-					#print "Saving model data profile",r,m,l,d
-					modeldataD[(r,l,m)][meantimes] = d
+					if l not in self.mlayers: continue
+					modeldataD[(r,l,m)][meantime] = d
 					alllayers.append(l)
 					
 				#####
 				# Add a masked value in layers where there is no data.
 				for l in self.mlayers:
 					if l in alllayers:continue
-					modeldataD[(r,l,m)][meantimes] = np.ma.masked
-					
-		  	    else:
-				#####
-				# multiple time steps per file.
-				for t, meantime in enumerate(ts):
-					dataAllt  = dataAll[t]
-					data = bvp.mameanaxis(np.ma.masked_where((self.modelMasks[r] != 1) + dataAllt.mask,dataAllt), axis=(1,2))
-				
-					if self.debug: print "profileAnalysis:\tloadModel.",r,m,self.dataType,'\tyear:',int(meantime), 'mean:',data.mean(),data.shape
-					alllayers = []
-					for l,d in enumerate(data):
-						#print "Saving model data profile",r,m,l,d,t,meantime
-						modeldataD[(r,l,m)][meantime] = d
-						alllayers.append(l)
-					
-					#####
-					# Add a masked value in layers where there is no data.
-					for l in self.mlayers:
-						if l in alllayers:continue
-						modeldataD[(r,l,m)][meantime] = np.ma.masked					
-			else:
-				print 'ERROR:',m, "not implemented in profile"
-				assert 0
+					modeldataD[(r,l,m)][meantime] = np.ma.masked
 								
 		readFiles.append(fn)
 		openedFiles+=1			
@@ -327,35 +311,39 @@ class profileAnalysis:
 	# Here we load the masks file.
 	self.maskfn = bvp.folder(self.workingDir+'/masks')+self.grid+'_masks.nc'
 	
-	if not os.path.exists(self.maskfn):
-		print "Making mask file",self.maskfn, 'from',self.gridFile
-
-		makeMaskNC(self.maskfn, self.regions, self.grid,self.modelcoords,gridfn= self.gridFile)
-	else:
-		print "Mask file exists:",self.maskfn
+	#####
+	# Any regions that are not yet in the mask file are added to it.
+	print "Checking mask file",self.maskfn, 'from',self.gridFile
+	makeMaskNC(self.maskfn, self.regions, self.grid,self.modelcoords,gridfn= self.gridFile)
 	self.modelMasks= {}
 	
 	ncmasks = dataset(self.maskfn,'r')
-	
 	for r in self.regions:
-		if r in ncmasks.variables.keys():
-			print "Loading mask",r
-			self.modelMasks[r] = ncmasks.variables[r][:]
-			
-		else:
-			newmask = bvp.folder(self.workingDir+'/masks')+self.grid+'_masks_'+r+'.nc'
-
-			if not os.path.exists(newmask):
-				makeMaskNC(newmask, [r,], self.grid,self.modelcoords,gridfn= self.gridFile)
-			nc = dataset(newmask,'r')
-			self.modelMasks[r] = nc.variables[r][:]
-			nc.close()			
+		print "Loading mask",r
+		self.modelMasks[r] = ncmasks.variables[r][:]
 			
 	print "Loaded masks",self.modelMasks.keys()
 
 	ncmasks.close()
+	self.loadModelArea()
+	self.profileEngine = tst.profileEngine(self.modelMasks, self.modelArea, self.regions)
 	self._masksLoaded_ = True
 
+  def loadModelArea(self,):
+  	"""
+  	Loads the area of each model grid cell, to weight the profiles.
+  	"""
+	nc = dataset(self.gridFile,'r')
+	try:	area  = nc.variables['area' ][:]		
+	except:	
+		try:	area = nc.variables['e2t'][:] * nc.variables['e1t'][:]
+		except: 
+			print "profileAnalysis:\tloadModelArea:\tWARNING: No area in grid file, setting area to flat:",self.gridFile
+			area = np.ones_like(nc.variables[self.modelcoords['lat']][:])
+	nc.close()
+	self.modelArea = np.ma.array(area).squeeze()
+	if self.debug: print "profileAnalysis:\tloadModelArea.\tarea:",self.modelArea.shape
+
 
 
 	
@@ -420,7 +408,9 @@ class profileAnalysis:
 	
 	###############
 	# Loading data for each region.
-	dl = tst.DataLoader(self.dataFile,'',self.datacoords,self.datadetails, regions = self.regions, layers = self.dlayers[:],)
+	# Only the points inside each region are used, (see tst.regionPointCache.regionPoints).
+	dl = tst.DataLoader(self.dataFile,'',self.datacoords,self.datadetails, regions = self.regions, layers = self.dlayers[:],pointTable=True,
+				memmapDir = self.pointCacheDir)
 	
 									    	
 	maskedValue = np.ma.masked # -999.# np.ma.array([-999.,],mask=[True,])
@@ -429,7 +419,7 @@ class profileAnalysis:
 	count =0
     	for l in sorted(self.dlayers)[:]:
 	    for r in self.regions:
-	    	dataDarray = dl.load[(r,l,)]	
+	    	dataDarray = np.ma.array(dl.load.regionPoints(r,l).astype(np.float64), mask = False)
 	    	try:   	
 	    		meandatad = dataDarray.mean()
 	    		datadmask = (~np.ma.array(dataDarray).mask).sum()
@@ -450,26 +440,24 @@ class profileAnalysis:
     			print "profileAnalysis:\t loadData\tproblem with ",(r,l)
     			
 				
-	    	dataDlat = dl.load[(r,l,'lat')]		    	
-	    	dataDlon = dl.load[(r,l,'lon')]		
-	    	dataDarea = self.loadDataAreas(dataDlat,dataDlon)
+	    	dataDarea = self.loadDataAreas(dl.load.regionPoints(r,l,'j'),dl.load.regionPoints(r,l,'i'))
 		    	
     		print "profileAnalysis:\t loadData,\tloading ",(r,l), '\tmean (pre weighting):\t',meandatad
 
 		if 'mean' in self.metrics:
 			dataD[(r,l,'mean')] = np.average(dataDarray, weights = dataDarea)
 		
-		if 'median' in self.metrics:
-			out_pc = bvp.weighted_percentiles(dataDarray, [50.,], weights = dataDarea)
-			
-			for pc,dat in zip(percentiles, out_pc):
-				if pc==50.: dataD[(r,l,'median')][meantime] = dat
+		for m in self.metrics:
+			if m == 'median': 	pc = 50.
+			elif m.find('pc')>-1: 	pc = float(m.replace('pc',''))
+			else:			continue
+			dataD[(r,l,m)] = bvp.weighted_percentiles(dataDarray.compressed(), [pc,], weights = np.ma.array(dataDarea)[~np.ma.getmaskarray(dataDarray)])[0]
 				
 		if 'min' in self.metrics:
-			dataD[(r,l,'min')] = np.ma.min(dataslice)
+			dataD[(r,l,'min')] = np.ma.min(dataDarray)
 			
 		if 'max' in self.metrics:
-			dataD[(r,l,'max')] = np.ma.max(dataslice)
+			dataD[(r,l,'max')] = np.ma.max(dataDarray)
 			
 				
 				
@@ -521,37 +509,22 @@ class profileAnalysis:
 
   def AddDataArea(self,):
   	"""
-  	Adding Area dictionany
+  	Adding Area array for the data grid.
   	"""
   	if not self.dataFile:
-  		self.dataAreaDict = {}
+  		self.dataArea = None
   		return
-  	area = tst.makeArea(self.dataFile,self.datacoords)
-	nc = dataset(self.dataFile,'r')
-	lats = nc.variables[self.datacoords['lat']][:]	
-	lons = nc.variables[self.datacoords['lon']][:]	
-	nc.close()
-	print "timeseriesAnalysis:\tAddDataArea:\t",area.shape,lats.shape,lons.shape
-	self.dataAreaDict = {}
-	if lats.ndim ==2:
-		for (i,j), a in np.ndenumerate(area):
-			#if np.ma.is_masked(a):continue
-			self.dataAreaDict[(lats[i,j],lons[i,j])] = a
-	if lats.ndim ==1:
-		for (i,j), a in np.ndenumerate(area):
-			#if np.ma.is_masked(a):continue
-			self.dataAreaDict[(lats[i],lons[j])] = a
+  	self.dataArea = tst.makeArea(self.dataFile,self.datacoords)
+	print "profileAnalysis:\tAddDataArea:\t",self.dataArea.shape
 	self.__madeDataArea__ = True
 	
-  def loadDataAreas(self,lats,lons):
+  def loadDataAreas(self,j,i):
   	"""
-  	Adding Area for each region.
+  	Adding Area for each region, using the grid indices of each point.
   	"""
-	areas =   []
-	for la,lo in zip(lats,lons):
-		try:	areas.append(self.dataAreaDict[(la,lo)] )
-		except: areas.append(0.)
-	return 	np.ma.array(areas)			
+  	if self.dataArea is None:
+  		return np.ma.zeros(np.ma.array(j).shape)
+	return tst.gatherWeights(self.dataArea, j, i)
  	
 
 
@@ -0,0 +1,241 @@
+#
+# Copyright 2017, Plymouth Marine Laboratory
+#
+# This file is part of the bgc-val library.
+#
+# bgc-val is free software: you can redistribute it and/or modify it
+# under the terms of the Revised Berkeley Software Distribution (BSD) 3-clause license. 
+
+# bgc-val is distributed in the hope that it will be useful, but
+# without any warranty; without even the implied warranty of merchantability
+# or fitness for a particular purpose. See the revised BSD license for more details.
+# You should have received a copy of the revised BSD license along with bgc-val.
+# If not, see <http://opensource.org/licenses/BSD-3-Clause>.
+#
+# Address:
+# Plymouth Marine Laboratory
+# Prospect Place, The Hoe
+# Plymouth, PL1 3DH, UK
+#
+# Email:
+# ledm@pml.ac.uk
+#
+"""
+.. module:: resultStore
+   :platform: Unix
+   :synopsis: A columnar netcdf store for the time series metrics.
+.. moduleauthor:: Lee de Mora <ledm@pml.ac.uk>
+
+"""
+
+import os
+from sys import argv
+from ast import literal_eval
+from shelve import open as shOpen
+import numpy as np
+from netCDF4 import Dataset
+
+from bgcvaltools import bgcvalpython as bvp
+
+
+def getStoreFilename(workingDir, jobID, dataType):
+	"""
+	The result store file name for a jobID and a dataType. 
+	(The old shelve was the same name, with .shelve instead of .nc)
+	"""
+	return bvp.folder(workingDir)+'_'.join([jobID,dataType,])+'.nc'
+
+def getShelveFilename(workingDir, jobID, dataType):
+	return bvp.folder(workingDir)+'_'.join([jobID,dataType,])+'.shelve'
+
+
+class resultStore:
+  """
+  A columnar store for the time series metrics of one jobID and dataType.
+
+  The results are held in a netcdf as a table with one row per (region, layer, metric, time):
+  	key:		the list of (region, layer, metric) keys, 
+  	keyIndex:	the index of the key of each row,
+  	time, value:	the time and value of each row.
+  A second table holds the model files that have been read: filename, fileRead. 
+  
+  Both tables are only ever appended to, so adding the results of one file
+  does not rewrite the whole file. When a (key, time) pair or a filename appears
+  more than once, the last row wins.
+  
+  The results are read and written as the usual modeldataD dictionary:
+  	{(region, layer, metric): {time: value}}
+  """
+  def __init__(self, fn, debug = True):
+	self.fn = fn
+	self.debug = debug
+	if not os.path.exists(self.fn): self.__create__()
+
+  def __create__(self):
+	if self.debug: print "resultStore:\tCreating:", self.fn
+	nc = Dataset(self.fn, 'w')
+	nc.createDimension('key',  None)
+	nc.createDimension('row',  None)
+	nc.createDimension('file', None)
+	nc.createVariable('key',	str,	('key',))
+	nc.createVariable('keyIndex',	'i4',	('row',), zlib=True)
+	nc.createVariable('time',	'f8',	('row',), zlib=True)
+	nc.createVariable('value',	'f8',	('row',), zlib=True)
+	nc.createVariable('filename',	str,	('file',))
+	nc.createVariable('fileRead',	'i1',	('file',))
+	nc.variables['key'].long_name 		= '(region, layer, metric)'
+	nc.variables['keyIndex'].long_name 	= 'index of the (region, layer, metric) key'
+	nc.variables['fileRead'].long_name 	= '1 if the model file has been read, 0 if it needs to be read again'
+	nc.description = 'bgc-val time series results'
+	nc.close()
+
+  def __loadKeys__(self, nc):
+	if len(nc.dimensions['key']) == 0: return []
+	return [literal_eval(k) for k in nc.variables['key'][:]]
+		
+  def keys(self):
+	nc = Dataset(self.fn, 'r')
+	keys = self.__loadKeys__(nc)
+	nc.close()
+	return keys
+	
+  def append(self, modeldata, readFile = ''):
+	"""
+	Add the rows of a {(region, layer, metric): {time: value}} dictionary,
+	and optionally mark the model file that they came from as read.
+	"""
+	nc = Dataset(self.fn, 'a')
+	keys = self.__loadKeys__(nc)
+	keyIndices = {k:i for i,k in enumerate(keys)}
+	
+	keyIndex, times, values, masked = [], [], [], []
+	for key in modeldata.keys():
+		if not len(modeldata[key]): continue
+		if key not in keyIndices:
+			keyIndices[key] = len(keys)
+			nc.variables['key'][len(keys)] = repr(tuple(key))
+			keys.append(key)
+		for t in sorted(modeldata[key].keys()):
+			v = modeldata[key][t]
+			keyIndex.append(keyIndices[key])
+			times.append(t)
+			if np.ma.is_masked(v):
+				values.append(0.)
+				masked.append(True)
+			else:
+				values.append(float(v))
+				masked.append(False)
+	if len(keyIndex):			
+		n = len(nc.dimensions['row'])
+		nc.variables['keyIndex'][n:n+len(keyIndex)] 	= np.array(keyIndex)
+		nc.variables['time'][n:n+len(keyIndex)] 	= np.array(times, dtype=np.float64)
+		nc.variables['value'][n:n+len(keyIndex)] 	= np.ma.array(values, mask = masked, dtype=np.float64)
+	nc.close()	
+	if readFile: self.setFileStatus([readFile,], True)
+	if self.debug: print "resultStore:\tAdded", len(keyIndex), "rows to", self.fn
+
+  def setFileStatus(self, filenames, read = True):
+	"""
+	Mark model files as read (or as needing to be read again).
+	"""
+	if not len(filenames): return
+	nc = Dataset(self.fn, 'a')
+	n = len(nc.dimensions['file'])
+	for i, fn in enumerate(filenames):
+		nc.variables['filename'][n+i] = fn
+	nc.variables['fileRead'][n:n+len(filenames)] = np.zeros(len(filenames), dtype=np.int8) + int(read)
+	nc.close()
+
+  def readFiles(self):
+	"""
+	The list of model files that have been read, in the order that they were read.
+	"""
+	nc = Dataset(self.fn, 'r')
+	if len(nc.dimensions['file']) == 0:
+		nc.close()
+		return []
+	filenames = list(nc.variables['filename'][:])
+	status = nc.variables['fileRead'][:]
+	nc.close()
+	latest = dict(zip(filenames, status))
+	readFiles = []
+	for fn in filenames:
+		if latest[fn] and fn not in readFiles: readFiles.append(fn)
+	return readFiles
+		
+  def read(self, keys = None):
+	"""
+	Read the {(region, layer, metric): {time: value}} dictionary, for all keys or only the requested keys.
+	Only the rows of the requested keys are converted.
+	"""
+	nc = Dataset(self.fn, 'r')
+	allKeys = self.__loadKeys__(nc)
+	if keys is None:	keys = allKeys
+	wanted = [allKeys.index(k) for k in keys if k in allKeys]
+	
+	out = {}
+	if len(wanted) and len(nc.dimensions['row']):
+		keyIndex = nc.variables['keyIndex'][:]
+		rows = np.where(np.in1d(keyIndex, wanted))[0]
+		times = nc.variables['time'][:][rows]
+		values = np.ma.array(nc.variables['value'][:][rows])
+		mask = np.ma.getmaskarray(values)
+		values = np.ma.getdata(values)
+		for k, t, v, m in zip(keyIndex[rows], times, values, mask):
+			key = allKeys[k]
+			if key not in out: out[key] = {}
+			if m:	out[key][t] = np.ma.masked
+			else:	out[key][t] = v
+	nc.close()
+	for k in wanted:
+		if allKeys[k] not in out: out[allKeys[k]] = {}
+	return out
+
+
+def migrateShelve(shelvefn, storefn, debug = True):
+	"""
+	Import the modeldata and readFiles of an old time series shelve into a result store.
+	"""
+	sh = shOpen(shelvefn)
+	modeldata 	= sh['modeldata']
+	try: 	readFiles = sh['readFiles']
+	except:	readFiles = []
+	sh.close()
+	
+	store = resultStore(storefn, debug = debug)
+	store.append(modeldata)
+	store.setFileStatus(readFiles, True)
+	print "migrateShelve:\tImported", len(modeldata.keys()), "keys and", len(readFiles), "read files:", shelvefn, '-->', storefn
+	return store
+	
+def loadModelData(workingDir, jobID, dataType, keys = None):
+	"""
+	Loads the time series results of a jobID and dataType, from the result store, 
+	or from the old shelve if the store does not exist.
+	Returns None if neither exist.
+	"""
+	storefn = getStoreFilename(workingDir, jobID, dataType)
+	if os.path.exists(storefn):
+		return resultStore(storefn, debug = False).read(keys = keys)
+		
+	shelvefn = getShelveFilename(workingDir, jobID, dataType)
+	try:
+		sh = shOpen(shelvefn)
+		modeldata = sh['modeldata']
+		sh.close()
+	except:	return None
+	if keys is None: return modeldata
+	return {k:modeldata[k] for k in keys if k in modeldata}
+	
+
+if __name__=="__main__":
+	#####
+	# Migrate old time series shelves into result stores:
+	#	./resultStore.py shelves/timeseries/jobID/*.shelve
+	for shelvefn in argv[1:]:
+		if shelvefn.find('insitu')>-1: continue
+		storefn = shelvefn.replace('.shelve', '.nc')
+		if os.path.exists(storefn): 
+			print "resultStore:\tAlready exists:", storefn
+			continue
+		migrateShelve(shelvefn, storefn)
@@ -34,14 +34,188 @@ from shelve import open as shOpen
 #from netCDF4 import num2date
 import os
 import shutil
+from glob import glob
 
 #Specific local code:
 from bgcvaltools import bgcvalpython as bvp
 from longnames.longnames import getLongName
 from bgcvaltools.dataset import dataset
 from regions.makeMask import loadMaskMakers
+from bgcvaltools.extractLayer import layerDepthIndex
+from functions.stdfunctions import extractData, extractDataChunks, chunkable
 import timeseriesTools as tst 
 import timeseriesPlots as tsp 
+from bgcvaltools.renderQueue import renderQueue
+from bgcvaltools.timeIndex import timeIndex, getTimeIndexFn
+from bgcvaltools.scheduler import jobProcessLimit
+from resultStore import resultStore, migrateShelve, getStoreFilename, getShelveFilename
+
+try:	from multiprocessing import Pool, current_process
+except:	Pool = None
+
+
+def extractFileMetrics(fn, modelcoords, modeldetails, regions, layers, metrics, timerange, modelArea, modelVolume,
+		done	= {},
+		redo	= False,
+		timeChunk = None,
+		memmapDir = '',
+		):
+	"""
+	Calculates the regional metrics of a single model file.
+	
+	This function only reads the file and does not change any state, so it can be run on a worker process.
+	done is a dictionary of (region, layer) : times that are already calculated for every metric, 
+	these region and layers are skipped, unless redo is True.
+	
+	The file is read timeChunk time steps at a time, and layers at a single depth (ie numbered layers, Surface, 100m) 
+	only read that depth level, so the memory needed is one layer of one time chunk, not the full file.
+	By default (timeChunk is None or 0), each chunk is the whole file, or as many time steps as fit in 
+	stdfunctions.defaultChunkPoints, so that the metrics of every time in a chunk are calculated in one pass.
+	Only the std_functions convert functions are read in chunks (see stdfunctions.chunkable), 
+	files with other convert functions are read in one go.
+	If memmapDir is set, the DataLoader point tables are memory mapped files in that folder (see tst.regionPointCache).
+	
+	Returns None if the file is outside the time range,
+	otherwise a dictionary of (region, layer, metric) : {time: value}.
+	"""
+	print "timeseriesAnalysis:\textractFileMetrics:\tloading new file:",fn,
+	nc = dataset(fn,'r')
+	ts = bvp.getTimes(nc,modelcoords)
+	if ts.max() < timerange[0]:
+		print "Time Series:\t File outside time range",(timerange),':',ts.max()
+		nc.close()
+		return None
+	if ts.min() > timerange[1]:
+		print "Time Series:\t File outside time range",(timerange),':',ts.min()		
+		nc.close()
+		return None
+	print "\ttime:",np.mean(ts)
+
+	percentiles = {}
+  	for m in metrics:
+		if m.find('pc')>-1:
+			pc = float(m.replace('pc',''))
+			percentiles[pc] = True
+		if m == 'median': percentiles[50.] = True
+	percentiles = sorted(percentiles.keys())
+	
+	#####
+	# Check wherether you can skip loading this metric,region,layer
+	results = {}
+	todo = {}
+	for l in layers:		
+	    for r in regions:
+	    	if not redo and not len(set(ts) - set(done.get((r,l), []))):
+			print "timeseriesAnalysis:\textractFileMetrics\tAlready created ",int(np.mean(ts)),':\t',(r,l)
+	    		continue
+		todo[(r,l)] = True
+		for m in metrics:
+			results[(r,l,m)] = {}
+
+	#####
+	# Group the layers by the depth level that they need.
+	# Layers at a single depth only read that level (and are layer 0 in the DataLoader),
+	# the other layers (All, transects, etc) share the full depth chunks.
+	# If the convert function can not be applied to chunks, the whole file is read once, for every layer.
+	todoLayers = [l for l in layers if len([r for r in regions if (r,l) in todo])]
+	useChunks = len(todoLayers) and chunkable(nc, modeldetails)
+	layerGroups = []
+	fullDepthLayers = []
+	for l in todoLayers:
+		if useChunks:	level = layerDepthIndex(nc,modelcoords,modeldetails,l)
+		else:		level = None
+		if level is None: 	fullDepthLayers.append(l)
+		else:			layerGroups.append((level,[l,]))
+	if len(fullDepthLayers): layerGroups.append((None,fullDepthLayers))
+	
+	for level, groupLayers in layerGroups:
+	  groupRegions = [r for r in regions if len([l for l in groupLayers if (r,l) in todo])]
+	  if useChunks:	chunks = extractDataChunks(nc, modeldetails, timeChunk = timeChunk, level = level)
+	  else:		chunks = [(0, len(ts), extractData(nc, modeldetails)),]
+	  for t0,t1,data in chunks:
+	    chunkTimes = ts[t0:t1]
+	    if level is None:	
+	    	DL = tst.DataLoader(fn,nc,modelcoords,modeldetails, regions = groupRegions, layers = groupLayers[:],data = data, memmapDir = memmapDir)
+	    else:	
+	    	DL = tst.DataLoader(fn,nc,modelcoords,modeldetails, regions = groupRegions, layers = [0,],data = data, memmapDir = memmapDir)
+	    	
+	    for l in groupLayers:
+	    	if level is None:	dl = l
+	    	else:			dl = 0
+	    	
+	        for r in regions:
+			if (r,l) not in todo: continue
+		    	#####
+		    	# can't skip it, need to load it.
+		    	# The compact points of the region are used, rather than the full length masked arrays.
+			layerdata = DL.load.regionPoints(r,dl).astype(np.float64)
+			timesIndex = DL.load.regionPoints(r,dl,'t')
+				
+			#####
+			# get Weights:
+			volumeWeightedLayers = ['All', 'Transect']
+		
+			if len(bvp.intersection(['mean','median','sum',], metrics)):
+				if l in volumeWeightedLayers:
+					weights = tst.gatherWeights(modelVolume, DL.load.regionPoints(r,dl,'j'), DL.load.regionPoints(r,dl,'i'), k = DL.load.regionPoints(r,dl,'z'))
+				else:
+					weights = tst.gatherWeights(modelArea, DL.load.regionPoints(r,dl,'j'), DL.load.regionPoints(r,dl,'i'))
+				
+				#####
+				# Points without a weight are removed.
+				weights = np.ma.filled(weights, 0.)
+				keep = weights != 0.
+				weights 	= weights[keep]
+				layerdata 	= layerdata[keep]
+				timesIndex 	= timesIndex[keep]
+			else:	weights = np.ones_like(layerdata)
+						
+			if len(layerdata)==0:
+				for m in metrics:
+					for meantime in chunkTimes:
+						results[(r,l,m)][meantime] = np.ma.masked 
+				continue
+
+			#####
+			# Calculate every metric for each time in one pass.
+			# If there is only one time, the whole layer is used, (3D files have no time index).
+			if len(chunkTimes) == 1: timesIndex = np.zeros(len(layerdata),dtype=int)
+			groups, groupMetrics = tst.groupedMetrics(layerdata, weights, timesIndex, percentiles = percentiles)
+			for m in ['mean','sum','min','max']:
+				if m not in metrics: continue
+				for g,t in enumerate(groups):	results[(r,l,m)][chunkTimes[t]] = groupMetrics[m][g]
+			if 'metricless' in metrics:
+				for g,t in enumerate(groups):	results[(r,l,'metricless')][chunkTimes[t]] = groupMetrics['sum'][g]
+			for pc in percentiles:
+				for m in [bvp.mnStr(pc)+'pc', 'median']:
+					if m == 'median' and pc != 50.: continue
+					if (r,l,m) not in results: continue
+					for g,t in enumerate(groups):	results[(r,l,m)][chunkTimes[t]] = groupMetrics[pc][g]
+			
+			#####
+			# Times without any data are masked.
+			for t,meantime in enumerate(chunkTimes):
+				if t in groups: continue
+				for m in metrics:	results[(r,l,m)][meantime] = np.ma.masked 
+				
+			for t in groups:
+		  		try:print "timeseriesAnalysis:\textractFileMetrics\tLoaded metric:", round(chunkTimes[t],2),'\t',[(r,l,'mean')], '\t',results[(r,l,'mean')][chunkTimes[t]]
+		  		except: pass
+	nc.close()
+	return results
+
+#####
+# The arguments that are shared by every file of a timeseriesAnalysis.
+# These are set in each worker process when the pool starts, 
+# so that the large area and volume arrays and the done times are not sent with every file.
+fileMetricsArgs = {}
+def initFileMetricsWorker(kwargs):
+	fileMetricsArgs.clear()
+	fileMetricsArgs.update(kwargs)
+
+def fileMetricsWorker(job):
+	fn, redo = job
+	return fn, extractFileMetrics(fn, redo = redo, **fileMetricsArgs)
 
 
 
@@ -70,6 +244,9 @@ class timeseriesAnalysis:
 		debug		= True,
 		noNewFiles	= False,	# stops loading new files
 		strictFileCheck = True,
+		nproc		= 1,		# number of processes used to load the model files.
+		timeChunk	= None,		# number of time steps read at once, (None: automatic).
+		pointCacheDir	= '',		# folder for memory mapped point tables, ('': in memory).
 		):
 		
 	#####
@@ -127,10 +304,14 @@ class timeseriesAnalysis:
 	self.debug		= debug
 	self.clean		= clean
 	self.noNewFiles		= noNewFiles
+	self.nproc		= nproc
+	self.timeChunk		= timeChunk
+	self.pointCacheDir	= pointCacheDir
 
 	self.timerange		= np.array([float(t) for t in sorted(timerange)]) 	
 
-  	self.shelvefn 		= bvp.folder(self.workingDir)+'_'.join([self.jobID,self.dataType,])+'.shelve'
+  	self.shelvefn 		= getShelveFilename(self.workingDir, self.jobID, self.dataType)	# Old results, only used for migration.
+  	self.storefn 		= getStoreFilename(self.workingDir, self.jobID, self.dataType)
 	self.shelvefn_insitu	= bvp.folder(self.workingDir)+'_'.join([self.jobID,self.dataType,])+'_insitu.shelve'
 
 	#####
@@ -141,7 +322,7 @@ class timeseriesAnalysis:
 	
 	#####
 	# Load Model File
-	self.loadModelWeightsDict()
+	self.loadModelWeights()
   	self.loadModel()  	
 	#assert 0
   	
@@ -161,24 +342,22 @@ class timeseriesAnalysis:
 	if self.debug: print "timeseriesAnalysis:\tloadModel."		
 	####
 	# load and calculate the model info
-	try:
-		if self.clean: 
-			print "timeseriesAnalysis:\tloadModel\tUser requested clean run. Wiping old data."
-			assert 0		
-		sh = shOpen(self.shelvefn)
-		readFiles 	= sh['readFiles']
-		modeldataD 	= sh['modeldata']
-		sh.close()
-		print "timeseriesAnalysis:\tloadModel\tOpened shelve:", self.shelvefn, '\tread', len(readFiles)
-	except:
-		readFiles = []
-		modeldataD = {}
-		for r in self.regions:
-		 for l in self.layers:
-		  for m in self.metrics:
-		   	modeldataD[(r,l,m)] = {}
-		   	
-		print "timeseriesAnalysis:\tloadModel\tCould not open shelve:", self.shelvefn, '\tread', len(readFiles)	
+	if self.clean and os.path.exists(self.storefn): 
+		print "timeseriesAnalysis:\tloadModel\tUser requested clean run. Wiping old data."
+		os.remove(self.storefn)
+	if not self.clean and not os.path.exists(self.storefn) and len(glob(self.shelvefn+'*')):
+		try:	migrateShelve(self.shelvefn, self.storefn)
+		except:	print "timeseriesAnalysis:\tloadModel\tCould not import old shelve:", self.shelvefn
+		
+	store = resultStore(self.storefn, debug = self.debug)
+	readFiles 	= store.readFiles()
+	modeldataD 	= store.read()
+	for r in self.regions:
+	 for l in self.layers:
+	  for m in self.metrics:
+	   	if (r,l,m) not in modeldataD: modeldataD[(r,l,m)] = {}
+	storedReadFiles = readFiles[:]
+	print "timeseriesAnalysis:\tloadModel\tOpened result store:", self.storefn, '\tread', len(readFiles)
 
 	###############
 	# Check whether there has been a change in what was requested:
@@ -201,7 +380,7 @@ class timeseriesAnalysis:
         reDoFiles = []
 	for fn in sorted(readFiles):
                 if self.debug:print "timeseriesAnalysis:\tloadModel\tChecking: ",fn
-		if bvp.shouldIMakeFile(fn, self.shelvefn,debug=False): 
+		if bvp.shouldIMakeFile(fn, self.storefn,debug=False): 
 			print "timeseriesAnalysis:\tloadModel\t:this file should be re-analysed:", fn
 			readFiles.remove(fn)
 		        reDoFiles.append(fn)
@@ -209,7 +388,7 @@ class timeseriesAnalysis:
 	#####
 	# Check if the Input file has changed since the shelve file last changed.
 	for fn in sorted(readFiles):
-		if bvp.shouldIMakeFile(fn, self.shelvefn): 
+		if bvp.shouldIMakeFile(fn, self.storefn): 
 			print "timeseriesAnalysis:\tloadModel\t:this file should be re-analysed:", fn
 			readFiles.remove(fn)
 			
@@ -218,7 +397,7 @@ class timeseriesAnalysis:
 	if self.debug:	
 		print "timeseriesAnalysis:\tloadModel:\tpost checks..."
 		#print "modeldataD:",modeldataD
-		print "timeseriesAnalysis:\tloadModel\tshelveFn:",self.shelvefn
+		print "timeseriesAnalysis:\tloadModel\tstorefn:",self.storefn
 		print "timeseriesAnalysis:\tloadModel\treadFiles: contains ",len(readFiles), 
 		try: 	print "files.\tUp to ", sorted(readFiles)[-1]
 		except: print "files."
@@ -232,187 +411,86 @@ class timeseriesAnalysis:
 		return
 
 
-	percentiles = {}
-  	for m in self.metrics:
-		if m.find('pc')>-1:
-			pc = float(m.replace('pc',''))
-			percentiles[pc] = True
-		if m == 'median': percentiles[50.] = True
-	percentiles = sorted(percentiles.keys())
-			
-					
-		
+	#####
+	# The (region, layer) pairs that have already been calculated for every metric.
+	done = {}
+	for r in self.regions:
+	  for l in self.layers:
+		times = None
+		for m in self.metrics:
+			if times is None:	times = set(modeldataD[(r,l,m)].keys())
+			else:			times = times & set(modeldataD[(r,l,m)].keys())
+		done[(r,l)] = sorted(times)
+
+	#####
+	# Files that need to be read again.
+	store.setFileStatus([fn for fn in storedReadFiles if fn not in readFiles], False)
+
+	newFiles = [fn for fn in sorted(self.modelFiles) if fn not in readFiles]
+	
+	#####
+	# Skip the files outside the time range, using the time index instead of opening every file.
+	index = timeIndex(getTimeIndexFn(self.modelFiles), self.modelcoords, debug = self.debug)
+	newFiles = index.filesInRange(newFiles, self.timerange[0], self.timerange[1])
+	jobs = [(fn, fn in reDoFiles) for fn in newFiles]
+	fileArgs = {	'modelcoords':	self.modelcoords,
+			'modeldetails':	self.modeldetails,
+			'regions':	self.regions,
+			'layers':	self.layers,
+			'metrics':	self.metrics,
+			'timerange':	self.timerange,
+			'modelArea':	self.modelArea,
+			'modelVolume':	self.modelVolume,
+			'timeChunk':	self.timeChunk,
+			'done':		done,
+			'memmapDir':	self.pointCacheDir,}
+
+	#####
+	# Pick the number of processes.
+	# The pool is not used inside a daemonic process, as these can not start their own workers,
+	# and inside a JobScheduler job, it is capped at the processes given to that job.
+	nproc = jobProcessLimit(min(self.nproc, len(jobs)))
+	if Pool is None or current_process().daemon: nproc = 1
 
 	###############
 	# Load files, and calculate fields.
-	openedFiles = 0					
-	for fn in sorted(self.modelFiles):
-		if fn in readFiles:continue
-		print "timeseriesAnalysis:\tloadModel:\tloading new file:",fn,
-		nc = dataset(fn,'r')
-		ts = bvp.getTimes(nc,self.modelcoords)
-		if ts.max() < self.timerange[0]:
-			print "Time Series:\t File outside time range",(self.timerange),':',ts.max()
-			nc.close()
-			continue
-		if ts.min() > self.timerange[1]:
-			print "Time Series:\t File outside time range",(self.timerange),':',ts.min()		
-			nc.close()
-			continue			
-		dates = bvp.getDates(nc,self.modelcoords) 
-		meantime = np.mean(ts)
-		print "\ttime:",meantime
+	# The files are processed in order, and the results are merged into modeldataD
+	# and appended to the result store after each file, so that an interupted run can be continued.
+	# If anything fails, the pool workers are stopped before the error is raised.
+	pool = None
+	if nproc > 1:
+		print "timeseriesAnalysis:\tloadModel:\tloading", len(jobs),"files with", nproc, "processes."
+		pool = Pool(processes = nproc, initializer = initFileMetricsWorker, initargs = (fileArgs,))
+		results = pool.imap(fileMetricsWorker, jobs)
+	else:
+		initFileMetricsWorker(fileArgs)
+		results = (fileMetricsWorker(job) for job in jobs)
 		
-		DL = tst.DataLoader(fn,nc,self.modelcoords,self.modeldetails, regions = self.regions, layers = self.layers,)
+	try:
+		for fn, fileResults in results:
+			if fileResults is None: continue
+			for (r,l,m), values in fileResults.items():
+				modeldataD[(r,l,m)].update(values)
+			readFiles.append(fn)
+		
+			print "timeseriesAnalysis:\tloadModel\tSaving results:", self.storefn, '\tread', len(readFiles)				
+			store.append(fileResults, readFile = fn)
+	except:
+		if pool is not None: pool.terminate()
+		raise
+	finally:
+		if pool is not None:
+			pool.close()
+			pool.join()
 		
-	
-		for l in self.layers:		
-		    for r in self.regions:
-		    	
-		    	#####
-		    	# Check wherether you can skip loading this metric,region,layer
-			skip = True
-			for m in self.metrics:
-		      	    for meantime in ts:				
-				if skip == False:continue
-				try: 
-					a = modeldataD[(r,l,m)][meantime]
-					print "timeseriesAnalysis:\tloadModel\tAlready created ",int(meantime),':\t',(r,l,m),'\t=',a
-				except: 
-					skip = False
-					print "timeseriesAnalysis:\tloadModel\tNeed to create ",int(meantime),':\t',(r,l,m)
-			if fn in reDoFiles: 
-                                print "timeseriesAnalysis:\tloadModel\tNeed to re-load ",int(meantime),':\t',(r,l,m)
-				skip = False
-			if skip: continue
-			
-		    	#####
-		    	# can't skip it, need to load it.
-			layerdata = DL.load[(r,l)]
-			timesIndex = DL.load[(r,l,'t')]
-					
-			#####
-			# get Weights:
-			volumeWeightedLayers = ['All', 'Transect']
-			
-			if len(bvp.intersection(['mean','median','sum',], self.metrics)):
-				lats = DL.load[(r,l,'lat')]
-				lons = DL.load[(r,l,'lon')]
-
-				if l in volumeWeightedLayers:
-					depths = DL.load[(r,l,'z')]					
-					weights = np.array([self.weightsDict[(la,lo,z)] for la,lo in zip(lats,lons,depths)])
-				else:
-					#weights = np.array([self.weightsDict[(la,lo)] for la,lo in zip(lats,lons)])				
-					weights = []
-					for la,lo,da in zip(lats,lons,layerdata):
-						try:	weights.append(self.weightsDict[(la,lo)] )
-						except: 
-							#print "timeseriesAnalysis:\tloadModel\tunable to load area",la,lo,da, 'adding 0. weight'
-							weights.append(0.)
-							
-			else:	weights = np.ones_like(layerdata)
-			
-			
-			#print "1 len(layerdata):",len(layerdata),'\tlen(weights):', len(weights)
-			
-			if type(layerdata) == type(np.ma.array([1,-999,],mask=[False, True,])):
-				weights = np.ma.array(weights)
-				#print weights.mean(),weights.min(),weights.max()
-				weights = np.ma.masked_where((weights==0.)+weights.mask+layerdata.mask,weights)#.compressed()
-				layerdata = np.ma.masked_where((weights==0.)+weights.mask+layerdata.mask,layerdata)#.compressed()				
-				timesIndex  = np.ma.masked_where((weights==0.)+weights.mask+layerdata.mask,timesIndex)			
-				weights = weights.compressed()				
-				layerdata = layerdata.compressed()
-				timesIndex = timesIndex.compressed()
-				if len(	layerdata)!= len(weights):
-					print "1.b len(	layerdata)!= len(weights)", len(layerdata),'!=', len(weights)
-					assert 0				
-
-			#print "2 len(layerdata):",len(layerdata),'\tlen(weights):', len(weights)
-							
-			if len(layerdata)==0:
-				for m in self.metrics:
-					modeldataD[(r,l,m)][meantime] = np.ma.masked #np.ma.array([-999,],mask=[True,])
-				continue
-#		  	for m in self.metrics:
-#		  		try:
-#		  			a = modeldataD[(r,l,m)][meantime]
-#		  			continue
-#		  		except:pass
-#				if m == 'mean':   	modeldataD[(r,l,m)][meantime] = np.ma.average(layerdata,weights=weights)
-#				if m == 'median':   	modeldataD[(r,l,m)][meantime] = np.ma.median(layerdata)
-#				if m == 'sum':   	modeldataD[(r,l,m)][meantime] = np.ma.sum(layerdata)
-#				if m == 'metricless':  	modeldataD[(r,l,m)][meantime] = np.ma.sum(layerdata)	# same as sum			
-#				if m == 'min':   	modeldataD[(r,l,m)][meantime] = np.ma.min(layerdata)
-#				if m == 'max':   	modeldataD[(r,l,m)][meantime] = np.ma.max(layerdata)
-#				if m.find('pc')>-1:
-#					pc = int(m.replace('pc',''))
-#					modeldataD[(r,l,m)][meantime] = np.percentile(layerdata,pc)
-#					
-#		  		print "timeseriesAnalysis:\tloadModel\tLoaded metric:", int(meantime),'\t',[(r,l,m)], '\t',modeldataD[(r,l,m)][meantime]
-			if len(ts) == 1:
-				meantime = ts.mean()
-				if 'mean' 	in self.metrics:	modeldataD[(r,l,'mean')][meantime] = np.ma.average(layerdata,weights=weights)
-				if 'sum' 	in self.metrics:   	modeldataD[(r,l,'sum') ][meantime] = np.ma.sum(layerdata)			
-				if 'min'	in self.metrics:   	modeldataD[(r,l,'min') ][meantime] = np.ma.min(layerdata)
-				if 'max'	in self.metrics:   	modeldataD[(r,l,'max') ][meantime] = np.ma.max(layerdata)
-				if 'metricless' in self.metrics:	modeldataD[(r,l,'metricless') ][meantime] = np.ma.sum(layerdata)
-			
-				if len(percentiles)==0: continue
-				out_pc = bvp.weighted_percentiles(layerdata, percentiles, weights = weights)
-			
-				for pc,dat in zip(percentiles, out_pc):
-					modeldataD[(r,l,bvp.mnStr(pc)+'pc')][meantime] = dat
-					if pc==50.:	modeldataD[(r,l,'median')][meantime] = dat
-		  		print "timeseriesAnalysis:\tloadModel\tLoaded metric:", int(meantime),'\t',[(r,l,m)], '\t',modeldataD[(r,l,m)][meantime]			
-			else:
-			    for t,meantime in enumerate(ts):
-				ts_layerdata = np.ma.masked_where(timesIndex != t, layerdata).compressed()
-				ts_weights   = np.ma.masked_where(timesIndex != t, weights  ).compressed()			
-				
-				if 'mean' 	in self.metrics:	modeldataD[(r,l,'mean')][meantime] = np.ma.average(ts_layerdata,weights=ts_weights)
-				if 'sum' 	in self.metrics:   	modeldataD[(r,l,'sum') ][meantime] = np.ma.sum(ts_layerdata)			
-				if 'min'	in self.metrics:   	modeldataD[(r,l,'min') ][meantime] = np.ma.min(ts_layerdata)
-				if 'max'	in self.metrics:   	modeldataD[(r,l,'max') ][meantime] = np.ma.max(ts_layerdata)
-				if 'metricless' in self.metrics:	modeldataD[(r,l,'metricless') ][meantime] = np.ma.sum(ts_layerdata)
-			
-				if len(percentiles)==0: continue
-				out_pc = bvp.weighted_percentiles(ts_layerdata, percentiles, weights = ts_weights)
-			
-				for pc,dat in zip(percentiles, out_pc):
-					modeldataD[(r,l,bvp.mnStr(pc)+'pc')][meantime] = dat
-					if pc==50.:	modeldataD[(r,l,'median')][meantime] = dat
-						  		
-		  		try:print "timeseriesAnalysis:\tloadModel\tLoaded metric:", round(meantime,2),'\t',[(r,l,'mean')], '\t',modeldataD[(r,l,'mean')][meantime]
-		  		except: pass
-										
-		readFiles.append(fn)		
-		openedFiles+=1			
-
-
-		nc.close()
-		if openedFiles:
-			print "timeseriesAnalysis:\tloadModel\tSaving shelve:", self.shelvefn, '\tread', len(readFiles)				
-			sh = shOpen(self.shelvefn)
-			sh['readFiles']		= readFiles
-			sh['modeldata'] 	= modeldataD
-			sh.close()
-			openedFiles=0	
-	if openedFiles:
-		print "timeseriesAnalysis:\tloadModel\tSaving shelve:", self.shelvefn, '\tread', len(readFiles)
-		sh = shOpen(self.shelvefn)
-		sh['readFiles']		= readFiles
-		sh['modeldata'] 	= modeldataD
-		sh.close()
-	
 	self.modeldataD = modeldataD
 	if self.debug: print "timeseriesAnalysis:\tloadModel.\t Model loaded:",	self.modeldataD.keys()[:3], '...', len(self.modeldataD.keys())	
 
 
-  def loadModelWeightsDict(self,):
+  def loadModelWeights(self,):
   	"""
-  	Adding Area dictionany for Model.
+  	Loads the area and volume of each model grid cell.
+  	The weight of each point is taken from these arrays using the grid indices from the DataLoader.
   	"""
   	  
 	nc = dataset(self.gridFile,'r')
@@ -425,70 +503,31 @@ class timeseriesAnalysis:
 		pvol = nc.variables['e3t'][:] *area
 	area  = np.ma.masked_where(tmask[0]==0,area )
 	pvol = np.ma.masked_where(tmask==0,pvol)	
-	
-	#print "timeseriesAnalysis:\t loadModelWeightsDict\tWARNING:\t this is a hack added at the last minute for the nemo-medusa ukesm run and will not work elsewhere."
-	lats = nc.variables[self.modelcoords['lat']][:]
-	lons = nc.variables[self.modelcoords['lon']][:]
-	safelons = bvp.makeLonSafeArr(lons)
-	#print area.shape, nc.variables['area'].dimensions
-	print lats.shape, nc.variables[self.modelcoords['lat']].dimensions
-	print lons.shape, nc.variables[self.modelcoords['lon']].dimensions
 	nc.close()
 
-	self.weightsDict={}	
-	if lats.ndim ==2:
-		for (i,j), a in np.ndenumerate(area):
-			#if np.ma.is_masked(a):continue
-			self.weightsDict[(lats[i,j],lons[i,j])] = a
-			self.weightsDict[(lats[i,j],safelons[i,j])] = a			
-			
-			
-	elif lats.ndim ==1:
-		for (i,j), a in np.ndenumerate(area):
-			#if np.ma.is_masked(a):continue
-			self.weightsDict[(lats[i],lons[j])] = a
-			self.weightsDict[(lats[i],safelons[j])] = a			
-	else:
-		assert 0
-	if self.debug: print "timeseriesAnalysis:\t loadModelWeightsDict.",self.weightsDict.keys()[0]		
+	self.modelArea 		= area
+	self.modelVolume	= pvol
+	if self.debug: print "timeseriesAnalysis:\t loadModelWeights.\tarea:",area.shape,'\tvolume:',pvol.shape
 
 
   def AddDataArea(self,):
   	"""
-  	Adding Area dictionany
+  	Adding Area array for the data grid.
   	"""
   	if not self.dataFile:
-  		self.dataAreaDict = {}
+  		self.dataArea = None
   		return
-  	area = tst.makeArea(self.dataFile,self.datacoords)
-	nc = dataset(self.dataFile,'r')
-	lats = nc.variables[self.datacoords['lat']][:]	
-	lons = nc.variables[self.datacoords['lon']][:]	
-	safelons = bvp.makeLonSafeArr(lons)	
-	nc.close()
-	print "timeseriesAnalysis:\tAddDataArea:\t",area.shape,lats.shape,lons.shape
-	self.dataAreaDict = {}
-	if lats.ndim ==2:
-		for (i,j), a in np.ndenumerate(area):
-			#if np.ma.is_masked(a):continue
-			self.dataAreaDict[(lats[i,j],lons[i,j])] = a
-			self.dataAreaDict[(lats[i,j],safelons[i,j])] = a			
-	if lats.ndim ==1:
-		for (i,j), a in np.ndenumerate(area):
-			#if np.ma.is_masked(a):continue
-			self.dataAreaDict[(lats[i],lons[j])] = a
-			self.dataAreaDict[(lats[i],safelons[j])] = a			
+  	self.dataArea = tst.makeArea(self.dataFile,self.datacoords)
+	print "timeseriesAnalysis:\tAddDataArea:\t",self.dataArea.shape
 	self.__madeDataArea__ = True
 	
-  def loadDataAreas(self,lats,lons):
+  def loadDataAreas(self,j,i):
   	"""
-  	Adding Area for each region.
+  	Adding Area for each region, using the grid indices of each point.
   	"""
-	areas =   []
-	for la,lo in zip(lats,lons):
-		try:	areas.append(self.dataAreaDict[(la,lo)] )
-		except: areas.append(0.)
-	return 	np.ma.array(areas)							
+  	if self.dataArea is None:
+  		return np.ma.zeros(np.ma.array(j).shape)
+	return tst.gatherWeights(self.dataArea, j, i)
 	  	
   def loadData(self):
   	
@@ -547,11 +586,13 @@ class timeseriesAnalysis:
 	
 	###############
 	# Loading data for each region.
-	dl = tst.DataLoader(self.dataFile,'',self.datacoords,self.datadetails, regions = self.regions, layers = self.layers,)
+	# Only the points inside each region are kept, (see tst.regionPointCache.regionPoints).
+	dl = tst.DataLoader(self.dataFile,'',self.datacoords,self.datadetails, regions = self.regions, layers = self.layers,
+				memmapDir = self.pointCacheDir)
 	if not self.__madeDataArea__: self.AddDataArea()
 	for r in self.regions:
 	    for l in self.layers:
-	    	dataD[(r,l)] = dl.load[(r,l,)]	
+	    	dataD[(r,l)] = np.ma.array(dl.load.regionPoints(r,l).astype(np.float64), mask = False)
 	    	try:   	
 	    		meandatad = dataD[(r,l)].mean()
 	    		datadmask = (~np.ma.array(dataD[(r,l)]).mask).sum()
@@ -560,10 +601,10 @@ class timeseriesAnalysis:
 	    		datadmask = False
 		    	
     		print "timeseriesAnalysis:\t load in situ data,\tloaded ",(r,l),  'mean:',meandatad    	
-	    	dataD[(r,l,'lat')] = dl.load[(r,l,'lat')]		    	
-	    	dataD[(r,l,'lon')] = dl.load[(r,l,'lon')]
+	    	dataD[(r,l,'lat')] = np.ma.array(dl.load.regionPoints(r,l,'lat').astype(np.float64), mask = False)
+	    	dataD[(r,l,'lon')] = np.ma.array(dl.load.regionPoints(r,l,'lon').astype(np.float64), mask = False)
 		if len(bvp.intersection(['mean','median','sum',], self.metrics)):	    	
-		    	dataD[(r,l,'area')] = self.loadDataAreas(dataD[(r,l,'lat')],dataD[(r,l,'lon')])
+		    	dataD[(r,l,'area')] = self.loadDataAreas(dl.load.regionPoints(r,l,'j'),dl.load.regionPoints(r,l,'i'))
 		else:	dataD[(r,l,'area')] = np.ones_like(dataD[(r,l,'lon')])
 		
 		if not meandatad and not datadmask: #np.ma.is_masked(dataD[(r,l)]):
@@ -611,19 +652,19 @@ class timeseriesAnalysis:
 		if type(l) in [type(0),type(0.)]:continue
 	 	mapfilename = self.plotname([r,l,'map',])	    				   
  
-   		modeldata	= mDL.load[(r,l)]
-   		modellat	= mDL.load[(r,l,'lat')]
-   		modellon	= mDL.load[(r,l,'lon')]
-		modelt		= mDL.load[(r,l,'t')]
+   		modeldata	= mDL.load.regionPoints(r,l).astype(np.float64)
+   		modellat	= mDL.load.regionPoints(r,l,'lat').astype(np.float64)
+   		modellon	= mDL.load.regionPoints(r,l,'lon').astype(np.float64)
+		modelt		= mDL.load.regionPoints(r,l,'t')
 
 		maxtime 	= ts.max()
 		maxtime_index 	= mDL.timedict_ti[maxtime]
                 timestr         = str(int(maxtime))
 
-		timemask 	= np.ma.masked_where(modelt!=maxtime_index,modelt).mask
-                modeldata 	= np.ma.masked_where(timemask,modeldata).compressed()
-                modellat 	= np.ma.masked_where(timemask,modellat).compressed()
-                modellon 	= np.ma.masked_where(timemask,modellon).compressed()
+		timemask 	= modelt == maxtime_index
+                modeldata 	= modeldata[timemask]
+                modellat 	= modellat[timemask]
+                modellon 	= modellon[timemask]
 
   	
 		if not len(modeldata): continue
@@ -650,20 +691,25 @@ class timeseriesAnalysis:
 		titles = [' '.join([getLongName(t) for t in [self.model,'('+self.jobID+')',str(l),self.modeldetails['name'],timestr]]),
 			  ' '.join([getLongName(t) for t in [self.datasource,str(l),self.datadetails['name']]])]
 			  
-	  	tsp.mapPlotPair(modellon, modellat, modeldata,
+	  	self.renderQueue.submit(tsp.mapPlotPair, 
+	  			(modellon, modellat, modeldata,
 	  			datalon,datalat,datadata,
-	  			mapfilename,
-	  			titles	= titles,
+	  			mapfilename,),
+	  			dict(titles	= titles,
 	  			lon0=0.,
 				drawCbar=True,
 				cbarlabel=cbarlabel,
-				dpi=100,)
+				dpi=100,))
 
 	
 	
   def makePlots(self):
 	if self.debug: print "timeseriesAnalysis:\t makePlots."		  
 
+	#####
+	# The plots are rendered on a pool of processes while the next plots are prepared.
+	self.renderQueue = renderQueue(nproc = self.nproc)
+
 
 	#####
 	# Trafficlight and percentiles plots:
@@ -723,8 +769,9 @@ class timeseriesAnalysis:
 			#filename = bvp.folder(self.imageDir)+'_'.join(['percentiles',self.jobID,self.dataType,r,str(l),greyband])+'.png'
                         if self.debug: print "timeseriesAnalysis:\t makePlots.\tInvestigating:",filename
 
-			if not bvp.shouldIMakeFile([self.shelvefn, self.shelvefn_insitu],filename,debug=False):continue
-			tsp.percentilesPlot(timesDict,modeldataDict,dataslice,dataweights=dataweights,title = title,filename=filename,units =self.modeldetails['units'],greyband=greyband)
+			fingerprint = bvp.plotFingerprint('percentilesPlot',timesDict,modeldataDict,dataslice,dataweights,title,self.modeldetails['units'],greyband)
+			if not bvp.shouldIMakePlot(filename,fingerprint,debug=False):continue
+			self.renderQueue.submit(tsp.percentilesPlot, (timesDict,modeldataDict,dataslice,), dict(dataweights=dataweights,title = title,filename=filename,units =self.modeldetails['units'],greyband=greyband), fingerprint = fingerprint)
  	    
 	  	#####
 	    	# Percentiles plots.		  	    
@@ -734,8 +781,6 @@ class timeseriesAnalysis:
 			#filename = bvp.folder(self.imageDir)+'_'.join([m,self.jobID,self.dataType,r,str(l),m,])+'.png'
                         if self.debug: print "timeseriesAnalysis:\t makePlots.\tInvestigating:",filename
 
-			if not bvp.shouldIMakeFile([self.shelvefn, self.shelvefn_insitu],filename,debug=False):	continue
-				    		
 			modeldataDict = self.modeldataD[(r,l,m)]
 			times = []
 			modeldata = []
@@ -753,7 +798,9 @@ class timeseriesAnalysis:
 
 			
 			#tsp.trafficlightsPlot(times,modeldata,dataslice,dataweights=dataweights,metric = m, title = title,filename=filename,units = self.modeldetails['units'],greyband=False)
-                        tsp.simpletimeseries(times,modeldata,datamean,title = title,filename=filename,units = self.modeldetails['units'],greyband=False)
+			fingerprint = bvp.plotFingerprint('simpletimeseries',times,modeldata,datamean,title,self.modeldetails['units'])
+			if not bvp.shouldIMakePlot(filename,fingerprint,debug=False):	continue
+			self.renderQueue.submit(tsp.simpletimeseries, (times,modeldata,datamean,), dict(title = title,filename=filename,units = self.modeldetails['units'],greyband=False), fingerprint = fingerprint)
 	    
 	    	#####
 	    	# Mean plots.
@@ -762,8 +809,6 @@ class timeseriesAnalysis:
 	 		filename = self.plotname([r,l,m,])	    		
 			#filename = bvp.folder(self.imageDir)+'_'.join([m,self.jobID,self.dataType,r,str(l),m,])+'.png'
 		        if self.debug: print "timeseriesAnalysis:\t makePlots.\tInvestigating:",filename
-			if not bvp.shouldIMakeFile([self.shelvefn, self.shelvefn_insitu],filename,debug=False):	continue
-			    		
 			modeldataDict = self.modeldataD[(r,l,m)]
 			times = []
 			modeldata = []
@@ -778,7 +823,9 @@ class timeseriesAnalysis:
 				datamean = np.average(dataslice, weights = dataweights)
 			else:	datamean = np.mean(dataslice)
 			
-			tsp.simpletimeseries(times,modeldata,datamean,title = title,filename=filename,units = self.modeldetails['units'],greyband=False)
+			fingerprint = bvp.plotFingerprint('simpletimeseries',times,modeldata,datamean,title,self.modeldetails['units'])
+			if not bvp.shouldIMakePlot(filename,fingerprint,debug=False):	continue
+			self.renderQueue.submit(tsp.simpletimeseries, (times,modeldata,datamean,), dict(title = title,filename=filename,units = self.modeldetails['units'],greyband=False), fingerprint = fingerprint)
 							
 	#####
 	# map plots for specific regions:	
@@ -790,6 +837,7 @@ class timeseriesAnalysis:
 			if bvp.shouldIMakeFile(self.modelFiles[-1],mapfilename,debug=False):runmapplots = True
  	if runmapplots:
 		self.mapplotsRegionsLayers() 		
+	self.renderQueue.wait()
 
 			
 			
@@ -25,13 +25,14 @@
 import numpy as np
 #from netCDF4 import num2date
 import os 
+import tempfile
 #from pyproj import Proj
 
 #Specific local code:
 from bgcvaltools import bgcvalpython as bvp
 from bgcvaltools.dataset import dataset
-from bgcvaltools.extractLayer import extractLayer
-from regions.makeMask import loadMaskMakers, makeMask
+from bgcvaltools.extractLayer import extractLayer, determineZ
+from regions.makeMask import loadMaskMakers, makeMask, isSpatialMask, loadCachedMask, coordinateHash
 from functions.stdfunctions import extractData
 
 """
@@ -179,9 +180,320 @@ def getHorizontalSlice(nc,coords,details,layer,data = ''):
 
 
 
+#####
+# Names of the latitude and longitude dimensions, used to determine the order of the dimensions.
+latnames = ['lat','latitude','latbnd','nav_lat','y',u'lat','j','rlat',]
+lonnames = ['lon','longitude','lonbnd','nav_lon','x',u'lon','i','rlon',]
+
+
+def flattenLayerLoop(dat,lat,lon,dims,name='',layer=''):
+	"""
+	:param dat: A masked array of a layer of data, with time as the first dimension.
+	:param lat: The latitude array (1D or 2D).
+	:param lon: The longitude array (1D or 2D).
+	:param dims: The netcdf dimensions of the data variable.
+
+	Iterates over every unmasked point in the layer and makes seven lists of points:
+	the data, the time index, the depth index, the latitude, the longitude
+	and the j and i indices of the grid cell (-1 when the data is not on a grid).
+	This is the original, slow, point by point method. It is kept as a reference for flattenLayer.
+	"""
+	#####
+	# Create Temporary Output Arrays.
+  	arr 	= []
+  	arr_lat = []
+  	arr_lon = []
+  	arr_t 	= []  	  		
+  	arr_z 	= []  	
+  	arr_j 	= []
+  	arr_i 	= []
+
+	####
+	# Different data has differnt shapes, and order or dimensions, this takes those differences into account.
+	if dat.ndim > 2:
+	  if dims[-2].lower() in latnames and dims[-1].lower() in lonnames:
+	  
+  	    #print 'createDataArray',self.details['name'],layer, "Sensible dimsions order:",dims		
+ 	    for index,v in bvp.maenumerate(dat):
+
+  			try:	(t,z,y,x) 	= index
+  			except: 
+  				(t,y,x) 	= index 
+  				z = 0
+ 			
+  			try:	la = lat[y,x]  			
+  			except:	la = lat[y]
+  			try:	lo = lon[y,x]  			
+  			except:	lo = lon[x]  			
+  			
+  			arr.append(v)
+  			arr_t.append(t)
+  			arr_z.append(z)
+  			arr_lat.append(la)
+  			arr_lon.append(lo)
+  			arr_j.append(y)
+  			arr_i.append(x)
+  			  			  			  			
+	  elif dims[-2].lower() in lonnames and dims[-1].lower() in latnames:
+	  
+  	    #print 'createDataArray',self.details['name'],layer, "Ridiculous dimsions order:",dims				
+ 	    for index,v in bvp.maenumerate(dat):
+  			try:	(t,z,x,y) 	= index
+  			except: 
+  				(t,x,y) 	= index 
+				z = 0	  				
+ 			
+  			try:	la = lat[y,x]  			
+  			except:	la = lat[y]
+  			try:	lo = lon[y,x]  			
+  			except:	lo = lon[x]  			
+  			
+  			arr.append(v)
+  			arr_t.append(t)
+  			arr_z.append(z)
+  			arr_lat.append(la)
+  			arr_lon.append(lo)
+  			arr_j.append(y)
+  			arr_i.append(x)
+  			  			
+  	  else:
+  		raise AssertionError("timeseriestools.py:\tflattenLayerLoop:\tUnknown dimensions order: "+str(dims))
+  		  			
+  	elif dat.ndim == 1:
+   	  if dims[0] == 'index':
+  	    print 'createDataArray',name,layer, "1 D data:",dims,dat.shape
+ 	    for i,v in enumerate(dat):
+  			la = lat[i]  			
+  			lo = lon[i]  			
+  			
+  			arr.append(v)  	
+  			arr_t.append(0)
+  			arr_z.append(0)
+  			arr_lat.append(la)
+  			arr_lon.append(lo)
+  			arr_j.append(-1)
+  			arr_i.append(-1)
+  	  elif len(dat)==1:
+  	    	print 'createDataArray',name,layer, "single point data:",dims,dat.shape
+  		arr = dat  	
+  		arr_t = [0,]
+  		arr_z = [0.,]
+  		arr_lat = [0.,]
+  		arr_lon = [0.,]
+  		arr_j = [-1,]
+  		arr_i = [-1,]
+  	    		  	
+  	  else:
+  	  	
+  	  	for t,d  in enumerate(dat):
+  			arr.append(d)
+  			arr_t.append(t)
+  			arr_z.append(0)
+  			arr_lat.append(0)
+  			arr_lon.append(0)
+  			arr_j.append(-1)
+  			arr_i.append(-1)
+
+  		#print "Unknown dimensions order: "+str(dims)
+  		#assert 0
+  	else:
+  		print "Unknown dimensions order: "+str(dims)
+  		assert 0
+	return arr, arr_t, arr_z, arr_lat, arr_lon, arr_j, arr_i
+
+
+def flattenLayer(dat,lat,lon,dims,name='',layer=''):
+	"""
+	:param dat: A masked array of a layer of data, with time as the first dimension.
+	:param lat: The latitude array (1D or 2D).
+	:param lon: The longitude array (1D or 2D).
+	:param dims: The netcdf dimensions of the data variable.
+
+	A vectorised version of flattenLayerLoop, which produces identical output.
+	The indices of the unmasked points are found with np.nonzero, and the
+	coordinates are gathered with fancy indexing, instead of a python loop.
+	"""
+	if dat.ndim > 2:
+		if dat.ndim > 4:
+			raise AssertionError("timeseriestools.py:\tflattenLayer:\tToo many dimensions: "+str(dat.shape))
+
+		index = np.nonzero(~np.ma.getmaskarray(dat))
+		arr = np.ma.getdata(dat)[index]
+
+		arr_t = index[0]
+		if dat.ndim == 4:	arr_z = index[1]
+		else:			arr_z = np.zeros_like(arr_t)
+
+		#####
+		# Different data has differnt shapes, and order or dimensions, this takes those differences into account.
+		if dims[-2].lower() in latnames and dims[-1].lower() in lonnames:
+			y,x = index[-2], index[-1]
+		elif dims[-2].lower() in lonnames and dims[-1].lower() in latnames:
+			x,y = index[-2], index[-1]
+		else:
+			raise AssertionError("timeseriestools.py:\tflattenLayer:\tUnknown dimensions order: "+str(dims))
+
+		if lat.ndim == 2:	arr_lat = lat[y,x]
+		else:			arr_lat = lat[y]
+		if lon.ndim == 2:	arr_lon = lon[y,x]
+		else:			arr_lon = lon[x]
+		return arr, arr_t, arr_z, arr_lat, arr_lon, y, x
+
+	if dat.ndim == 1:
+		if dims[0] == 'index':
+			print 'createDataArray',name,layer, "1 D data:",dims,dat.shape
+			zeros = np.zeros(len(dat),dtype=int)
+			offgrid = zeros - 1
+			return dat, zeros, zeros, lat[:len(dat)], lon[:len(dat)], offgrid, offgrid
+		if len(dat)==1:
+			print 'createDataArray',name,layer, "single point data:",dims,dat.shape
+			return dat, [0,], [0.,], [0.,], [0.,], [-1,], [-1,]
+		zeros = np.zeros(len(dat),dtype=int)
+		return dat, np.arange(len(dat)), zeros, zeros, zeros, zeros - 1, zeros - 1
+
+	print "Unknown dimensions order: "+str(dims)
+	assert 0
+
+
+
+
+def compactColumn(column, memmapDir = ''):
+	"""
+	:param column: A 1D array of points, ie a column of DataLoader.oneDData.
+	:param memmapDir: If set, the column is saved in this folder and loaded as a read-only memory map.
+
+	Returns a copy of the column with a smaller dtype.
+	Integer columns (time, depth, j and i indices) use the smallest of int16 and int32 that holds them,
+	float columns (data, lat and lon) are stored as float32.
+	"""
+	column = np.ma.getdata(column)
+	column = np.asarray(column)
+	if column.dtype.kind in 'iu':
+		dtype = column.dtype
+		for d in [np.int16, np.int32]:
+			if not len(column) or (column.min() >= np.iinfo(d).min and column.max() <= np.iinfo(d).max): 
+				dtype = d
+				break
+	elif column.dtype.kind == 'f':	dtype = np.float32
+	else:				dtype = column.dtype
+	column = column.astype(dtype)
+	if not memmapDir or not len(column): return column
+
+	#####
+	# The file is removed once it is mapped, so the table does not outlast the process.
+	# (The memory map stays valid on unix.)
+	fd, fn = tempfile.mkstemp(suffix = '.npy', prefix = 'pointCache_', dir = bvp.folder(memmapDir))
+	os.close(fd)
+	np.save(fn, column)
+	column = np.load(fn, mmap_mode = 'r')
+	os.remove(fn)
+	return column
+
+
+class regionPointCache:
+  """
+  The DataLoader.load dictionairy, stored as one compact table of points for each layer,
+  and an index of the points inside each region.
+
+  Previously, each (region, layer) held seven masked float64 arrays (data, t, z, lat, lon, j, i), 
+  each the length of the whole layer. Here, the points of a layer are stored once, (see compactColumn),
+  and each region is an int32 array of the indices of its points in the table, 
+  or a bitmap (np.packbits) if that is smaller. 
+  If memmapDir is set, the tables are memory mapped files, so the memory used does not grow 
+  with the number of regions and layers.
+
+  Indexing works the same way as the old dictionairy: cache[(region,layer)] is the data and 
+  cache[(region,layer,'t')] is the time index, etc. Each of these creates the masked array 
+  (with the original dtype) when it is requested, so it should be kept for as long as it is needed, 
+  rather than requested repeatedly.
+  The points of a single region, without the mask, are returned by regionPoints.
+  """
+  columns = {None: 'arr', 't': 'arr_t', 'z': 'arr_z', 'lat': 'arr_lat', 'lon': 'arr_lon', 'j': 'arr_j', 'i': 'arr_i'}
+  
+  def __init__(self, memmapDir = ''):
+	self.memmapDir	= memmapDir
+	self.tables	= {}	# layer: {column: compact array}
+	self.dtypes	= {}	# layer: {column: original dtype}
+	self.regions	= {}	# (region, layer): ('index', int32 array) or ('bitmap', packed bits)
+	self.masked	= {}	# (region, layer, column): masked array, for the empty regions.
+
+  def addLayer(self, layer, oneDData):
+	"""
+	Stores the compact table of points for this layer, (if it is not already stored).
+	"""
+	if layer in self.tables: return
+	self.tables[layer] = {c: compactColumn(oneDData[c], self.memmapDir) for c in self.columns.values()}
+	self.dtypes[layer] = {c: np.asarray(oneDData[c]).dtype for c in self.columns.values()}
+
+  def addRegion(self, region, layer, oneDData, m):
+	"""
+	:param m: The region mask of the points of the layer, (True outside the region).
+	"""
+	self.addLayer(layer, oneDData)
+	inRegion = ~np.asarray(m, dtype=bool)
+	index = np.flatnonzero(inRegion).astype(np.int32)
+	if index.nbytes > len(inRegion)/8 + 1:	self.regions[(region,layer)] = ('bitmap', np.packbits(inRegion))
+	else:					self.regions[(region,layer)] = ('index', index)
+	for k in self.columns: self.masked.pop((region,layer,k), None)
+
+  def addMasked(self, region, layer, maskedValue):
+	self.regions.pop((region,layer), None)
+	for k in self.columns: self.masked[(region,layer,k)] = maskedValue
+
+  def __key__(self, key):
+  	region, layer = key[:2]
+  	if len(key) == 2:	return region, layer, None
+  	return region, layer, key[2]
+
+  def __contains__(self, key):
+	region, layer, k = self.__key__(key)
+	if k not in self.columns: return False
+	return (region,layer) in self.regions or (region,layer,k) in self.masked
+
+  def keys(self):
+	keys = []
+	for region, layer in self.regions.keys():
+		keys.extend([(region, layer, k) if k else (region,layer) for k in self.columns])
+	keys.extend([(r,l,k) if k else (r,l) for r,l,k in self.masked.keys()])
+	return keys
+
+  def __regionMask__(self, region, layer):
+	kind, index = self.regions[(region,layer)]
+	length = len(self.tables[layer]['arr'])
+	if kind == 'bitmap': return ~np.unpackbits(index)[:length].astype(bool)
+	mask = np.ones(length, dtype=bool)
+	mask[index] = False
+	return mask
+
+  def __getitem__(self, key):
+	region, layer, k = self.__key__(key)
+	if (region,layer,k) in self.masked: return self.masked[(region,layer,k)]
+	if (region,layer) not in self.regions or k not in self.columns: raise KeyError(key)
+	c = self.columns[k]
+	column = np.asarray(self.tables[layer][c]).astype(self.dtypes[layer][c])
+	return np.ma.masked_where(self.__regionMask__(region,layer), column)
+
+  def __setitem__(self, key, value):
+	raise AssertionError("timeseriesTools.py:\tregionPointCache:\tUse addRegion or addMasked to add points to the cache: "+str(key))
+
+  def regionPoints(self, region, layer, k = None):
+	"""
+	Returns the compact (unmasked) points of one column of a region, ie regionPoints('Global', 'Surface', 'lat').
+	"""
+	if (region,layer) not in self.regions: return np.ma.compressed(self[(region,layer,k)])
+	kind, index = self.regions[(region,layer)]
+	if kind == 'bitmap': index = np.flatnonzero(~self.__regionMask__(region,layer))
+	return self.tables[layer][self.columns[k]][index]
+
+  def nbytes(self):
+	"""
+	The size of the tables and the region indices, in bytes.
+	"""
+	return sum([a.nbytes for t in self.tables.values() for a in t.values()]) + sum([a.nbytes for kind,a in self.regions.values()])
 	
+
 class DataLoader:
-  def __init__(self,fn,nc,coords,details, regions = ['Global',], layers = ['Surface',],data = ''):
+  def __init__(self,fn,nc,coords,details, regions = ['Global',], layers = ['Surface',],data = '',pointTable = False, memmapDir = ''):
   	self.fn = fn
 	if type(nc) == type('filename'):
 		nc = dataset(fn,'r')  
@@ -190,15 +502,19 @@ class DataLoader:
   	self.details 	= details
   	self.layers 	= layers
   	self.name	= self.details['name']
-	if data == '': data = extractData(nc,self.details)
+	if type(data) == type(''): data = extractData(nc,self.details)
   	self.Fulldata 	= data
   	self.__lay__ 	= -999.
+  	self.__oneDLay__ = -999.
+  	self.usePointTable = pointTable
+  	self.pointTable = {}
+  	self.memmapDir	= memmapDir
   	self.regions, self.maskingfunctions = loadMaskMakers(regions = regions )
         self._makeTimeDict_()
 	self.run()
 	
   def run(self):
-  	self.load = {}
+  	self.load = regionPointCache(memmapDir = self.memmapDir)
    	try:	depths = {i:z for i,z in enumerate(self.nc.variables[self.coords['z']][:])} 
    	except: depths = {}
    	#print "self.nc.variables[self.coords[z]][:]", self.nc.variables[self.coords['z']][:]
@@ -209,6 +525,7 @@ class DataLoader:
  #  	assert 0
    	lays = self.layers[:]
    	lays.reverse()
+   	if self.usePointTable: self._makePointTable_()
     	for l in lays:#self.layers: 
     	    try:	layer = int(l)
     	    except:	layer = l
@@ -221,26 +538,30 @@ class DataLoader:
    	    	continue 
    	    
   	    for region in self.regions:
-		arr, arr_t, arr_z, arr_lat, arr_lon 	= self.createDataArray(region,layer)
-		if len(arr) == 0: 
+		m = self.createRegionMask(region,layer)
+		m = np.ma.getmaskarray(np.ma.masked_where(m, self.oneDData['arr']))
+		if len(m) == 0: 
 			self.maskedload(region,layer)
 			continue
 
-		if arr.mask.all(): 
+		if np.all(m): 
 			self.maskedload(region,layer)
 			continue
-						
-   		self.load[(region,layer)] =  arr 
-   		self.load[(region,layer,'t')] =  arr_t
-   		self.load[(region,layer,'z')] =  arr_z
-   		self.load[(region,layer,'lat')] =  arr_lat 
-   		self.load[(region,layer,'lon')] =  arr_lon
+		
+		#####
+		# The points are stored once per layer, and each region is an index into them.
+		self.load.addRegion(region, layer, self.oneDData, m)
+   		arr = np.asarray(self.oneDData['arr'])[~m]
    			   			   			   			
   		print "DataLoader:\tLoaded",self.name, 'in',
   		print '{:<24} layer: {:<8}'.format(region,layer),
-  		print '\tdata length:',len(self.load[(region,layer)]), 
-  		print '\tmean:',self.load[(region,layer)].mean(), 'of', len(self.load[(region,layer)]),
-  		print '\trange:',[self.load[(region,layer)].min(),self.load[(region,layer)].max()]
+  		print '\tdata length:',len(m), 
+  		print '\tmean:',arr.mean(), 'of', len(m),
+  		print '\trange:',[arr.min(),arr.max()]
+
+	#####
+	# The full precision point table is no longer needed, the points are in self.load.
+	self.pointTable = {}
 
   def _makeTimeDict_(self,):
 	""" Make a dictionairy linking the time index with the float time.
@@ -257,11 +578,7 @@ class DataLoader:
   	""" Quick in line tool to set a layer/region to masked.
   	"""
    	maskedValue = np.ma.array([-999.,],mask=[True,])  	
-	self.load[(region,layer)] =  maskedValue 
-	self.load[(region,layer,'t')] =  maskedValue
-	self.load[(region,layer,'z')] =  maskedValue
-	self.load[(region,layer,'lat')] =  maskedValue
-	self.load[(region,layer,'lon')] = maskedValue
+	self.load.addMasked(region,layer,maskedValue)
 	print "DataLoader:\tLoaded empty",self.name, 'in',
 	print '{:<24} layer: {:<8}'.format(region,layer),
 	print '\tdata length:',len(self.load[(region,layer)]) #,
@@ -282,17 +599,110 @@ class DataLoader:
   		 return self.__layDat__
   		 
   	
+  def _loadLatLon_(self,):
+  	""" Load the lat and lon arrays only once, as makeLonSafeArr is slow on large grids.
+  	"""
+  	try:	return self.__lat__, self.__lon__
+  	except AttributeError: pass
+  	self.__lat__ = self.nc.variables[self.coords['lat']][:]
+  	self.__lon__ = bvp.makeLonSafeArr(self.nc.variables[self.coords['lon']][:]) # makes sure it's between +/-180
+  	return self.__lat__, self.__lon__
+
+  def _loadGrid_(self,):
+  	""" Load the 2D lat and lon grid, and its hash, for the region mask cache.
+  	"""
+  	try:	return self.__lat2d__, self.__lon2d__, self.__gridHash__
+  	except AttributeError: pass
+  	lat, lon = self._loadLatLon_()
+  	if lat.ndim == 1 and lon.ndim == 1:
+  		lon, lat = np.meshgrid(lon,lat)
+  	self.__lat2d__, self.__lon2d__ = lat, lon
+  	self.__gridHash__ = coordinateHash(lat,lon)
+  	return self.__lat2d__, self.__lon2d__, self.__gridHash__
+
+  def _makePointTable_(self,):
+  	"""	Flattens the full data field once into a table of points, with a depth index column, 'arr_k'.
+  		The table is sorted by depth index, so each numbered layer is a contiguous slice of the table.
+  		This replaces extracting and flattening the full field once per numbered layer.
+  		Only data with (time, depth, lat, lon) or (depth, lat, lon) dimensions can be tabulated, 
+  		otherwise the layers are loaded one at a time as before.
+  	"""
+  	self.pointTable = {}
+  	data = self.Fulldata
+  	try:	zdim = determineZ(self.nc,self.coords,self.details)
+  	except: zdim = -1
+  	if data.ndim == 3 and zdim == 0: data = data[None,...]
+  	elif data.ndim == 4 and zdim == 1: pass
+  	else:
+  		print "DataLoader:\tmakePointTable:\tCan not make a point table for",self.name, 'with shape:',data.shape, 'and depth dimension:',zdim
+  		return
+
+  	lat, lon = self._loadLatLon_()
+	dims =   self.nc.variables[self.details['vars'][0]].dimensions
+	arr, arr_t, arr_k, arr_lat, arr_lon, arr_j, arr_i = flattenLayer(np.ma.array(data), lat, lon, dims, name = self.name, layer = 'pointTable')
+
+  	arr = np.ma.masked_invalid(np.ma.array(arr))
+  	mask = np.ma.masked_where((arr>1E20) + arr.mask,arr).mask
+
+	#####
+	# A stable sort keeps the (time, lat, lon) order of the points within each layer,
+	# so that each slice is identical to flattening that layer on its own.
+	arr_k = np.ma.masked_where(mask,arr_k).compressed()
+	order = np.argsort(arr_k, kind='mergesort')
+	self.pointTable['arr_k'] = arr_k[order]
+  	self.pointTable['arr_lat'] = np.ma.masked_where(mask,arr_lat).compressed()[order]
+  	self.pointTable['arr_lon'] = np.ma.masked_where(mask,arr_lon).compressed()[order]
+  	self.pointTable['arr_t']   = np.ma.masked_where(mask,arr_t  ).compressed()[order]
+  	self.pointTable['arr']     = np.ma.masked_where(mask,arr    ).compressed()[order]
+  	self.pointTable['arr_j']   = np.ma.masked_where(mask,arr_j  ).compressed()[order]
+  	self.pointTable['arr_i']   = np.ma.masked_where(mask,arr_i  ).compressed()[order]
+  	print "DataLoader:\tmakePointTable:\t",self.name, 'points:',len(arr_k), 'layers:',data.shape[1]
+
+  def _pointTableLayer_(self,layer):
+  	"""	Returns the slice of the point table for a numbered layer, as a oneDData dictionary.
+  		The 'arr_z' column is zero, as it is when a single layer is flattened.
+  	"""
+  	k0 = np.searchsorted(self.pointTable['arr_k'], layer, side='left')
+  	k1 = np.searchsorted(self.pointTable['arr_k'], layer, side='right')
+  	oneDData = {key: a[k0:k1] for key,a in self.pointTable.items() if key != 'arr_k'}
+  	oneDData['arr_z'] = np.zeros_like(oneDData['arr_t'])
+  	return oneDData
+
   def createDataArray(self,region,layer):
   	"""	
-  		This creates a set of 1D arrays of the dat and 4D coordinates for the required region.
+  		This creates a set of 1D arrays of the dat and 4D coordinates for the required region,
+  		as well as the j and i indices of the grid cell of each point.
   		The leg work is done in makeMask.py
   	"""
   	
   	#print 'DataLoader:\tcreateDataArray:\t',self.details['name'],region,layer
   	
+  	m = self.createRegionMask(region,layer)
+
+  	return 	np.ma.masked_where(m,self.oneDData['arr']),\
+  		np.ma.masked_where(m,self.oneDData['arr_t']),\
+  		np.ma.masked_where(m,self.oneDData['arr_z']),\
+  		np.ma.masked_where(m,self.oneDData['arr_lat']),\
+  		np.ma.masked_where(m,self.oneDData['arr_lon']),\
+  		np.ma.masked_where(m,self.oneDData['arr_j']),\
+  		np.ma.masked_where(m,self.oneDData['arr_i'])
+  		  		  		  		
+  def createRegionMask(self,region,layer):
+  	"""	
+  		Returns the mask of the region for the points of the layer, (True outside the region).
+  	"""
   	self.createOneDDataArray(layer)
-  	  	
-  	m = makeMask(
+  	
+  	arr_j, arr_i = self.oneDData['arr_j'], self.oneDData['arr_i']
+  	if isSpatialMask(self.maskingfunctions[region]) and len(arr_j) and np.min(arr_j) > -1 and np.min(arr_i) > -1:
+  		#####
+  		# Spatial regions are evaluated once on the grid, (and cached to disk), 
+  		# then each point takes the value of its grid cell.
+		lat2d, lon2d, gridHash = self._loadGrid_()
+		gridmask = loadCachedMask(self.maskingfunctions, self.details['name'], region, lat2d, lon2d, gridHash=gridHash)
+		m = gridmask[arr_j, arr_i]
+  	else:	
+	  	m = makeMask(
   				self.maskingfunctions,
   				self.details['name'],
   				region, 
@@ -301,12 +711,7 @@ class DataLoader:
   				self.oneDData['arr_lat'],
   				self.oneDData['arr_lon'],
   				self.oneDData['arr'],)
-
-  	return 	np.ma.masked_where(m,self.oneDData['arr']),\
-  		np.ma.masked_where(m,self.oneDData['arr_t']),\
-  		np.ma.masked_where(m,self.oneDData['arr_z']),\
-  		np.ma.masked_where(m,self.oneDData['arr_lat']),\
-  		np.ma.masked_where(m,self.oneDData['arr_lon'])
+  	return m
   		  		  		  		
   	
   def createOneDDataArray(self,layer):
@@ -314,10 +719,20 @@ class DataLoader:
   		These output 1D arrays are then passed to UKESMpython.py's makemasks toolkit.
   	"""
 
+	#####
+	# The same layer is used by each region, so it only needs to be flattened once.
+  	if self.__oneDLay__ == layer: return
+  	
+	#####
+	# Numbered layers are sliced from the point table, if it exists.
+  	if self.pointTable and type(layer) in [type(0),np.int64,]:
+  		self.oneDData = self._pointTableLayer_(layer)
+  		self.__oneDLay__ = layer
+  		return
+
 	#####
 	# load lat, lon and data.
-  	lat = self.nc.variables[self.coords['lat']][:]
-  	lon = bvp.makeLonSafeArr(self.nc.variables[self.coords['lon']][:]) # makes sure it's between +/-180
+  	lat, lon = self._loadLatLon_()
 
 	dims =   self.nc.variables[self.details['vars'][0]].dimensions
   	
@@ -333,102 +748,9 @@ class DataLoader:
 		a = np.ma.array([-999.,],mask=[True,])
 		return a,a,a,a,a
 
-		
 	#####
-	# Create Temporary Output Arrays.
-  	arr 	= []
-  	arr_lat = []
-  	arr_lon = []
-  	arr_t 	= []  	  		
-  	arr_z 	= []  	
-
-
-	latnames = ['lat','latitude','latbnd','nav_lat','y',u'lat','j','rlat',]
-	lonnames = ['lon','longitude','lonbnd','nav_lon','x',u'lon','i','rlon',]
-	
-
-	####
-	# Different data has differnt shapes, and order or dimensions, this takes those differences into account.
-	if dat.ndim > 2:
-	  if dims[-2].lower() in latnames and dims[-1].lower() in lonnames:
-	  
-  	    #print 'createDataArray',self.details['name'],layer, "Sensible dimsions order:",dims		
- 	    for index,v in bvp.maenumerate(dat):
-
-  			try:	(t,z,y,x) 	= index
-  			except: 
-  				(t,y,x) 	= index 
-  				z = 0
- 			
-  			try:	la = lat[y,x]  			
-  			except:	la = lat[y]
-  			try:	lo = lon[y,x]  			
-  			except:	lo = lon[x]  			
-  			
-  			arr.append(v)
-  			arr_t.append(t)
-  			arr_z.append(z)
-  			arr_lat.append(la)
-  			arr_lon.append(lo)
-  			  			  			  			
-	  elif dims[-2].lower() in lonnames and dims[-1].lower() in latnames:
-	  
-  	    #print 'createDataArray',self.details['name'],layer, "Ridiculous dimsions order:",dims				
- 	    for index,v in bvp.maenumerate(dat):
-  			try:	(t,z,x,y) 	= index
-  			except: 
-  				(t,x,y) 	= index 
-				z = 0	  				
- 			
-  			try:	la = lat[y,x]  			
-  			except:	la = lat[y]
-  			try:	lo = lon[y,x]  			
-  			except:	lo = lon[x]  			
-  			
-  			arr.append(v)
-  			arr_t.append(t)
-  			arr_z.append(z)
-  			arr_lat.append(la)
-  			arr_lon.append(lo)
-  			  			
-  	  else:
-  		raise AssertionError("timeseriestools.py:\tcreateOneDDataArray:\tUnknown dimensions order: "+str(dims))
-  		  			
-  	elif dat.ndim == 1:
-   	  if dims[0] == 'index':
-  	    print 'createDataArray',self.name,layer, "1 D data:",dims,dat.shape
- 	    for i,v in enumerate(dat):
-  			la = lat[i]  			
-  			lo = lon[i]  			
-  			
-  			arr.append(v)  	
-  			arr_t.append(0)
-  			arr_z.append(0)
-  			arr_lat.append(la)
-  			arr_lon.append(lo)
-  	  elif len(dat)==1:
-  	    	print 'createDataArray',self.name,layer, "single point data:",dims,dat.shape
-  		arr = dat  	
-  		arr_t = [0,]
-  		arr_z = [0.,]
-  		arr_lat = [0.,]
-  		arr_lon = [0.,]
-  	    		  	
-  	  else:
-  	  	
-  	  	for t,d  in enumerate(dat):
-  			arr.append(d)
-  			arr_t.append(t)
-  			arr_z.append(0)
-  			arr_lat.append(0)
-  			arr_lon.append(0)
-
-  		#print "Unknown dimensions order: "+str(dims)
-  		#assert 0
-  	else:
-  		print "Unknown dimensions order: "+str(dims)
-  		assert 0
-  			
+	# Flatten the layer into 1D arrays of points.
+	arr, arr_t, arr_z, arr_lat, arr_lon, arr_j, arr_i = flattenLayer(dat, lat, lon, dims, name = self.name, layer = layer)
 
   	arr = np.ma.masked_invalid(np.ma.array(arr))
   	mask = np.ma.masked_where((arr>1E20) + arr.mask,arr).mask
@@ -439,14 +761,10 @@ class DataLoader:
   	self.oneDData['arr_z']   = np.ma.masked_where(mask,arr_z  ).compressed() 	
   	self.oneDData['arr_t']   = np.ma.masked_where(mask,arr_t  ).compressed()
   	self.oneDData['arr']     = np.ma.masked_where(mask,arr    ).compressed()
+  	self.oneDData['arr_j']   = np.ma.masked_where(mask,arr_j  ).compressed()
+  	self.oneDData['arr_i']   = np.ma.masked_where(mask,arr_i  ).compressed()
+  	self.__oneDLay__ = layer
 
-	
-  	#print 'createDataArray:',arr.min(),arr.mean(),arr.max(),arr, len(arr)  	
-  	#print 'createDataArray:',region, arr_lat.min(),arr_lat.mean(),arr_lat.max(),arr_lat, len(arr_lat)  	  	
-  	#print 'createDataArray:',region, arr_lon.min(),arr_lon.mean(),arr_lon.max(),arr_lon, len(arr_lon)  	  	  	
-  	#return arr, arr_t,arr_z,arr_lat,arr_lon
-  	
-  	
   	
   
 def makeArea(fn,coordsdict):
@@ -473,6 +791,246 @@ def makeArea(fn,coordsdict):
 		print "timeseriesTools.py:\tNot implemeted makeArea for this grid. ",lats.ndim, coordsdict
 		assert 0 , 'timeseriesTools.py:\tNot implemeted makeArea for this grid. '+str(lats.ndim)
 
+def gatherWeights(weights,j,i,k=None):
+	"""
+	:param weights: An area (2D) or volume (3D) array, on the same grid as the data.
+	:param j: The grid j index of each point, ie DataLoader.load[(region,layer,'j')]
+	:param i: The grid i index of each point, ie DataLoader.load[(region,layer,'i')]
+	:param k: The grid k index of each point, only needed for volume weights.
+
+	Loads the weight of each point with a single fancy index into the weights array.
+	Points that are masked or that are outside the grid are given a weight of zero.
+	"""
+	if k is None:	indices = [j,i]
+	else:		indices = [k,j,i]
+	weights = np.ma.array(weights)
+	if weights.ndim != len(indices):
+		raise AssertionError("timeseriesTools.py:\tgatherWeights:\tWeights shape "+str(weights.shape)+" does not match the number of indices: "+str(len(indices)))
+
+	mask = np.zeros(np.ma.array(j).shape, dtype=bool)
+	safeIndices = []
+	for ind,length in zip(indices, weights.shape):
+		ind = np.ma.array(ind)
+		mask += np.ma.getmaskarray(ind)
+		ind = np.ma.getdata(ind).astype(int)
+		mask += (ind < 0) + (ind >= length)
+		safeIndices.append(ind)
+	safeIndices = tuple([np.where(mask, 0, ind) for ind in safeIndices])
+
+	out = np.ma.filled(weights[safeIndices], 0.).astype(float)
+	out[mask] = 0.
+	return np.ma.array(out)
+
+def groupedMetrics(values,weights,groups,percentiles=[]):
+	"""
+	:param values: A 1D array of data points.
+	:param weights: The weight of each point, (all greater than zero).
+	:param groups: The group index of each point, ie the time index.
+	:param percentiles: A list of percentiles, in the range 0 to 100.
+
+	Calculates the weighted mean, the sum, the min, the max and the weighted percentiles 
+	of every group in one pass, instead of masking and sorting the data once per group.
+	The points are sorted by (group, value), then each group is a contiguous segment of the sorted arrays.
+	The percentiles use the same definition as bgcvalpython.weighted_percentiles.
+	
+	Returns the group indices and a dictionairy of metric: array, with one value per group.
+	The percentiles are in the dictionairy with their float value as the key.
+	"""
+	values  = np.asarray(values,dtype=float)
+	weights = np.asarray(weights,dtype=float)
+	groups  = np.asarray(groups)
+	out = {}
+	if len(values) == 0:
+		return np.array([],dtype=int), out
+		
+	#####
+	# Sort by group, (the points are usually already in time order, so this is often skipped),
+	# then sort the values within each group.
+	# This is the order of np.lexsort((values,groups)), but it is much faster for a few large groups.
+	if np.any(groups[1:] < groups[:-1]):
+		order = np.argsort(groups, kind='mergesort')
+		values  = values[order]
+		weights = weights[order]
+		groups  = groups[order]
+	
+	starts = np.flatnonzero(np.concatenate([[True,],groups[1:] != groups[:-1]]))
+	ends = np.concatenate([starts[1:],[len(values),]])
+	lengths = ends - starts
+	
+	order = np.concatenate([s + np.argsort(values[s:e]) for s,e in zip(starts,ends)])
+	values  = values[order]
+	weights = weights[order]
+	
+	wsum = np.add.reduceat(weights,starts)
+	out['sum']  = np.add.reduceat(values,starts)
+	out['mean'] = np.add.reduceat(values*weights,starts)/wsum
+	out['min']  = values[starts]
+	out['max']  = values[ends-1]
+	
+	if len(percentiles):
+		#####
+		# Segmented cumulative weights, normalised within each group.
+		cumweights = np.cumsum(weights)
+		offsets = np.concatenate([[0.,],cumweights[ends[:-1]-1]])
+		weighted_quantiles = (cumweights - np.repeat(offsets,lengths) - 0.5 * weights)/np.repeat(wsum,lengths)
+		quantiles = np.array(percentiles)/100.
+		pcs = np.array([np.interp(quantiles, weighted_quantiles[s:e], values[s:e]) for s,e in zip(starts,ends)])
+		for p,pc in enumerate(percentiles):
+			out[pc] = pcs[:,p]
+	return groups[starts], out
+
+def weightedRowMetrics(values,weights,percentiles=[]):
+	"""
+	:param values: A 2D masked array of (rows, points).
+	:param weights: The 1D weights of the points, (all greater than zero).
+	:param percentiles: A list of percentiles, in the range 0 to 100.
+
+	Calculates the min, max and the weighted percentiles of each row, ignoring the masked points.
+	The percentiles use the same definition as bgcvalpython.weighted_percentiles,
+	but all the rows are sorted and interpolated at once.
+	Returns a dictionairy of metric: 1D masked array with one value per row. 
+	The percentiles are in the dictionairy with their float value as the key.
+	"""
+	values = np.ma.masked_invalid(np.ma.array(values,dtype=float))
+	mask = np.ma.getmaskarray(values)
+	nrows, npoints = values.shape
+	counts = npoints - mask.sum(axis=1)
+	empty = counts == 0
+	
+	#####
+	# Masked points are sorted to the end of each row, and given a weight of zero.
+	order = np.argsort(np.where(mask, np.inf, np.ma.getdata(values)), axis=1)
+	rows = np.arange(nrows)[:,None]
+	svalues  = np.ma.getdata(values)[rows,order]
+	sweights = np.where(mask, 0., np.asarray(weights,dtype=float)[None,:])[rows,order]
+	
+	last = np.maximum(counts-1,0)
+	out = {}
+	out['min'] = np.ma.masked_where(empty, svalues[:,0])
+	out['max'] = np.ma.masked_where(empty, svalues[np.arange(nrows),last])
+	if len(percentiles) == 0: return out
+	
+	cumweights = np.cumsum(sweights,axis=1)
+	total = cumweights[:,-1:]
+	total = np.where(total == 0., 1., total)
+	weighted_quantiles = (cumweights - 0.5 * sweights)/total
+	valid = np.arange(npoints)[None,:] < counts[:,None]
+	weighted_quantiles = np.where(valid, weighted_quantiles, np.inf)
+	
+	for pc in percentiles:
+		#####
+		# The same interpolation as np.interp, for each row.
+		q = pc/100.
+		j = (weighted_quantiles <= q).sum(axis=1) - 1
+		lo = np.clip(j,0,last)
+		hi = np.clip(j+1,0,last)
+		x0 = weighted_quantiles[np.arange(nrows),lo]
+		x1 = weighted_quantiles[np.arange(nrows),hi]
+		y0 = svalues[np.arange(nrows),lo]
+		y1 = svalues[np.arange(nrows),hi]
+		inside = (j >= 0) * (j < last)
+		slope = np.where(inside, (y1-y0)/np.where(inside, x1-x0, 1.), 0.)
+		result = np.where(inside, y0 + slope * (q - x0), y0)
+		result = np.where(j >= last, svalues[np.arange(nrows),last], result)
+		out[pc] = np.ma.masked_where(empty, result)
+	return out
+
+class profileEngine:
+  """
+  	Calculates the area weighted profiles of several regions, for every time and depth at once.
+  	
+  	The region masks and the area are combined into a sparse matrix of the weight of each 
+  	(depth, y, x) cell in each (region, depth), so the mean profiles of all the regions and time steps 
+  	are a single sparse matrix product with the flattened data.
+  	The other metrics (median, percentiles, min, max) are calculated on the cells in each region's footprint.
+  """
+  def __init__(self,masks,area,regions):
+  	"""
+	:param masks: A dictionairy of region: mask, where 1 is inside the region, (ie profileAnalysis.modelMasks).
+		The masks can be 2D or 3D (depth, y, x).
+	:param area: The 2D area of each grid cell.
+	:param regions: The list of regions.
+  	"""
+  	self.regions = regions
+	self.area = np.ma.filled(np.ma.array(area,dtype=float),0.)
+	self.ny, self.nx = self.area.shape
+	self.masks = {}
+	for r in regions:
+		self.masks[r] = (np.ma.filled(masks[r],0) == 1).reshape(-1, self.ny, self.nx)
+	self.__weights__ = {}
+
+  def regionMask(self,region,nz):
+  	""" Returns the (depth, y, x) mask of the region, with nz depth levels.
+  	"""
+  	mask = self.masks[region]
+  	if mask.shape[0] == nz: return mask
+  	if mask.shape[0] == 1:	return np.repeat(mask, nz, axis=0)
+	raise AssertionError("timeseriesTools.py:\tprofileEngine:\tThe mask of "+str(region)+" has "+str(mask.shape[0])+" depth levels, but the data has "+str(nz))
+
+  def weightMatrix(self,nz):
+  	""" The sparse (depth*y*x, regions*depth) weight matrix, which is only made once for each number of depth levels.
+  	"""
+  	if nz in self.__weights__: return self.__weights__[nz]
+  	from scipy.sparse import csr_matrix
+  	rows, cols, vals = [], [], []
+  	for r,region in enumerate(self.regions):
+  		z,y,x = np.nonzero(self.regionMask(region,nz))
+  		rows.append(np.ravel_multi_index((z,y,x),(nz,self.ny,self.nx)))
+  		cols.append(r*nz + z)
+  		vals.append(self.area[y,x])
+  	rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+  	self.__weights__[nz] = csr_matrix((vals,(rows,cols)), shape = (nz*self.ny*self.nx, len(self.regions)*nz))
+  	return self.__weights__[nz]
+
+  def calculate(self,data,metrics=['mean',]):
+  	"""
+	:param data: A masked array of (time, depth, y, x).
+	:param metrics: A list of metrics: 'mean', 'median', 'min', 'max' or percentiles, ie '10pc'.
+
+	Returns a dictionairy of metric: masked array of (regions, time, depth).
+  	"""
+	data = np.ma.masked_invalid(np.ma.array(data))
+	if data.ndim != 4 or data.shape[2:] != (self.ny,self.nx):
+		raise AssertionError("timeseriesTools.py:\tprofileEngine:\tData shape "+str(data.shape)+" does not match the area "+str(self.area.shape))
+	nt, nz = data.shape[:2]
+	nr = len(self.regions)
+	out = {}
+	
+	if 'mean' in metrics:
+		weights = self.weightMatrix(nz)
+		valid = (~np.ma.getmaskarray(data)).reshape(nt,-1).astype(float)
+		totals = weights.T.dot(np.ma.filled(data,0.).reshape(nt,-1).T)
+		areas  = weights.T.dot(valid.T)
+		means  = totals/np.where(areas == 0., 1., areas)
+		out['mean'] = np.ma.masked_where(areas == 0., means).reshape(nr,nz,nt).transpose(0,2,1)
+
+	#####
+	# A list of (key in weightedRowMetrics output, metric name).
+	rowKeys = []
+	for m in metrics:
+		if m == 'median': 	rowKeys.append((50.,m))
+		elif m.find('pc')>-1: 	rowKeys.append((float(m.replace('pc','')),m))
+		elif m in ['min','max']: rowKeys.append((m,m))
+		elif m in ['mean',]: 	continue
+		else: raise AssertionError("timeseriesTools.py:\tprofileEngine:\tMetric not implemented in profile: "+str(m))
+	if len(rowKeys) == 0: return out
+	
+	pcs = sorted(set([key for key,m in rowKeys if key not in ['min','max']]))
+	for key,m in rowKeys:
+		out[m] = np.ma.masked_all((nr, nt, nz))
+	flatdata = data.reshape(nt, nz, -1)
+	for r,region in enumerate(self.regions):
+		mask = self.regionMask(region,nz).reshape(nz,-1)
+		cells = np.flatnonzero(mask.any(axis=0))
+		if len(cells) == 0: continue
+		outside = ~mask[:,cells]
+		for t in range(nt):
+			values = np.ma.masked_where(outside, flatdata[t][:,cells])
+			rowMetrics = weightedRowMetrics(values, self.area.ravel()[cells], percentiles = pcs)
+			for key,m in rowKeys:
+				out[m][r,t] = rowMetrics[key]
+	return out
+
 #def calculateArea(lat0,lat1,lon0,lon1):
 #		co = {"type": "Polygon", "coordinates": [
 #		    [(lon0, lat0), #('lon', 'lat')